@@ -0,0 +1,431 @@
+import os, os.path
+import re, bisect, collections
+import cPickle, hashlib, tempfile
+import arm, cfg, asmsize
+
+# The results of parsing an assembly file and building its CFGs are kept
+# between runs, keyed by a hash of the file's contents. Bump the version
+# whenever the parser, the CFG construction or the cost model changes, so
+# old entries are ignored.
+#
+# The CFGs depend on the function labels of every file being analysed, so
+# they are only reused if the same set of call sites is given. The entries
+# are flattened into tuples and indices, rather than pickling the linked
+# blocks directly, as pickle recurses down every link. The size and cycles
+# of each block are kept with it.
+#
+# Entries are shared by files with the same text, so the file name saved in
+# each instruction is replaced with the name it is loaded under.
+#
+# When a file has changed, the last entry for the same path is used to
+# reuse the costs of each function whose text is unchanged. Only functions
+# which are closed (no block runs into, or links to, another function) can
+# be reused. The CFGs are only reused if every function is unchanged and in
+# the same order, as where the blocks are split around a call depends on
+# the rest of the file; otherwise the whole file is rebuilt.
+ANALYSIS_VERSION = 3
+
+cache_dir = os.path.expanduser("~/.ramoverlay")
+
+function_regex = re.compile(r"\s*\.type\s+([^,]+),\s*%function")
+
+def callSitesKey(call_sites):
+    return hashlib.sha1("\n".join(sorted(set(call_sites)))).hexdigest()
+
+# Split the file into functions, each running from its .type directive to
+# the next. Anything before the first function is given the name "". Each
+# function is returned as [name, fingerprint, first insn, last insn + 1].
+# Blanked lines (.loc, .cfi, .size) are left out of the fingerprint, so
+# that changing one function doesn't change the fingerprint of the rest.
+def functionRanges(lines, instructions):
+    starts = [(0, "")]
+    for lineno, l in enumerate(lines):
+        if "%function" in l:
+            m = function_regex.match(l)
+            if m is not None:
+                starts.append((lineno, m.group(1)))
+    starts.append((len(lines), None))
+
+    insn_lines = [insn.lineno for insn in instructions]
+
+    functions = []
+    for (first, name), (last, next_name) in zip(starts, starts[1:]):
+        text = "".join(lines[l] for l in xrange(first, last))
+        functions.append([name, hashlib.sha1(text).hexdigest(),
+                          bisect.bisect_left(insn_lines, first),
+                          bisect.bisect_left(insn_lines, last)])
+    return functions
+
+# Labels defined or referred to by the given instructions. Only these call
+# sites can change how the function's CFG is built
+def functionCallsKey(insns, call_set):
+    labels = set()
+    for insn in insns:
+        if insn.label is not False:
+            labels.add(insn.label)
+        elif insn.branchDestination() is not None:
+            labels.add(insn.branchDestination())
+    return callSitesKey(labels & call_set)
+
+# An assembly file, along with what was saved about it last time. loader
+# parses the file if it isn't in the cache, returning the instructions, the
+# source lines and the file's call sites.
+class CachedFile(object):
+    def __init__(self, fname, loader=arm.loadInstructions, use_cache=True):
+        self.fname = fname
+        self.use_cache = use_cache
+
+        text = open(fname).read()
+        self.entry = None
+        self.previous = None
+        self.reused = {}
+        if use_cache:
+            toolchain = asmsize.toolchainKey()
+            key = hashlib.sha1("{}\n{}\n{}".format(ANALYSIS_VERSION, toolchain, text)).hexdigest()
+            self.path = os.path.join(cache_dir, key + ".pickle")
+            # The last analysis of this file is only worth reusing costs from
+            # if it was sized by the same toolchain
+            latest = hashlib.sha1("{}\n{}\n{}".format(ANALYSIS_VERSION, toolchain, os.path.abspath(fname))).hexdigest()
+            self.latest = os.path.join(cache_dir, latest + ".latest")
+            self.entry = self.read(self.path)
+
+        if self.entry is None:
+            self.instructions, self.lines, self.calls = loader(fname)
+            self.functions = functionRanges(self.lines, self.instructions)
+            if use_cache:
+                self.reuseCosts()
+        else:
+            self.instructions = map(arm.ArmAsmInstruction.restoreState, self.entry["instructions"])
+            for insn in self.instructions:
+                insn.file = fname
+            self.lines = arm.SourceBuffer(text)
+            self.lines.blanked = set(self.entry["blanked"])
+            self.calls = self.entry["calls"]
+            self.functions = [[name, fp, start, end] for name, fp, calls_key, start, end, closed in self.entry["functions"]]
+            self.previous = self.entry
+            self.reused = {f[0]: f for f in self.entry["functions"] if f[5]}
+
+        # The instructions which still need sizing
+        if self.entry is not None:
+            self.uncosted = []
+        else:
+            self.uncosted = [insn for name, fp, start, end in self.functions
+                                      if name not in self.reused
+                                      for insn in self.instructions[start:end]]
+
+    # A CachedFile is sent back from the worker which loaded it with its
+    # instructions in their saved form, which is much quicker to pickle
+    def __getstate__(self):
+        ids = {id(insn): i for i, insn in enumerate(self.instructions)}
+        state = dict(self.__dict__)
+        state["instructions"] = [insn.saveState() for insn in self.instructions]
+        state["uncosted"] = [ids[id(insn)] for insn in self.uncosted]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.instructions = map(arm.ArmAsmInstruction.restoreState, state["instructions"])
+        self.uncosted = [self.instructions[i] for i in state["uncosted"]]
+
+    def read(self, path):
+        if not os.path.exists(path):
+            return None
+        try:
+            f = open(path, "rb")
+            entry = cPickle.load(f)
+            f.close()
+        except Exception:
+            # A corrupt entry is treated as a miss, and rewritten
+            return None
+        return entry
+
+    # Copy the costs of the instructions in each unchanged function from
+    # the last analysis of this file
+    def reuseCosts(self):
+        if not os.path.exists(self.latest):
+            return
+        self.previous = self.read(os.path.join(cache_dir, open(self.latest).read().strip() + ".pickle"))
+        if self.previous is None:
+            return
+
+        old_functions = {f[0]: f for f in self.previous["functions"]}
+        old_insns = self.previous["instructions"]
+
+        for name, fp, start, end in self.functions:
+            old = old_functions.get(name)
+            if old is None or old[1] != fp or not old[5]:
+                continue
+            self.reused[name] = old
+            for insn, state in zip(self.instructions[start:end], old_insns[old[3]:old[4]]):
+                insn.insnsize, insn.cycles, insn.flush = state[8:11]
+
+    # Return the CFGs for the file. These are restored if the file and the
+    # call sites are unchanged, pieced together from the unchanged
+    # functions and the rebuilt changed ones if possible, and otherwise are
+    # built by construct from scratch
+    def cfgs(self, call_sites, construct):
+        if self.restorable(call_sites):
+            return self.restoreCFGs(self.entry)
+
+        cfgs = None
+        if self.previous is not None:
+            cfgs = self.reuseFunctions(call_sites)
+        if cfgs is None:
+            # Clear anything a partial build marked, so the full build
+            # starts from the parsed instructions
+            for insn in self.instructions:
+                insn.markedNotCall = False
+                insn.markedAsCall = False
+            cfgs = construct(self.instructions, call_sites)
+
+        for c in cfgs:
+            c.findLoops()
+        self.save(call_sites, cfgs)
+        return cfgs
+
+    # Whether the CFGs for these call sites are in the cache
+    def restorable(self, call_sites):
+        return self.entry is not None and self.entry["call_sites"] == callSitesKey(call_sites)
+
+    # Flatten CFGs built by another process, along with the changes made
+    # to the instructions while building them, to be sent back and restored
+    # by restoreBuilt
+    def flatten(self, cfgs):
+        saved_cfgs, closed = self.saveCFGs(cfgs)
+        marks = [(insn.markedNotCall, insn.markedAsCall) for insn in self.instructions]
+        return marks, saved_cfgs, [(bb.codeSize(), bb.cycleCount()) for c in cfgs for bb in c.basicblocks]
+
+    def restoreBuilt(self, flat):
+        marks, saved_cfgs, features = flat
+        for i, (insn, (not_call, as_call)) in enumerate(zip(self.instructions, marks)):
+            insn.address = i
+            insn.markedNotCall, insn.markedAsCall = not_call, as_call
+        return self.restoreCFGs({"cfgs": saved_cfgs, "features": features})
+
+    def restoreCFGs(self, entry):
+        insns = self.instructions
+        blocks = []
+        cfgs = []
+
+        for startaddress, analysed, saved_blocks in entry["cfgs"]:
+            c = cfg.CFG()
+            c.startaddress = startaddress
+            c.basicblocks = []
+            for address, insn_ids, dests, header, header2 in saved_blocks:
+                bb = cfg.BasicBlock(address)
+                bb.instructions = [insns[i] for i in insn_ids]
+                bb.cfg = c
+                bb.iterations = 1
+                c.basicblocks.append(bb)
+                blocks.append(bb)
+            cfgs.append((c, analysed))
+
+        # Link the blocks up, now they all exist
+        saved = [b for startaddress, analysed, saved_blocks in entry["cfgs"] for b in saved_blocks]
+        for bb, (address, insn_ids, dests, header, header2) in zip(blocks, saved):
+            bb.destinations = [blocks[d] for d in dests]
+            bb.iloop_header = blocks[header] if header != -1 else None
+            bb.iloop_header2 = blocks[header2] if header2 != -1 else None
+
+        for bb, features in zip(blocks, entry["features"]):
+            bb.features = features
+
+        for c, analysed in cfgs:
+            if analysed:
+                c.buildLoopForest()
+
+        return [c for c, analysed in cfgs]
+
+    # Rebuild the blocks of the functions from the last analysis, shifted to
+    # where they are now. Returns None if any function has changed or moved
+    # relative to the others, as the file then has to be built as a whole
+    def reuseFunctions(self, call_sites):
+        call_set = set(call_sites)
+        insns = self.instructions
+
+        if [f[0] for f in self.functions] != [f[0] for f in self.previous["functions"]]:
+            return None
+        for name, fp, start, end in self.functions:
+            old = self.reused.get(name)
+            if old is None or old[2] != functionCallsKey(insns[start:end], call_set):
+                return None
+
+        # Group the saved blocks by the function they start in
+        old_insns = self.previous["instructions"]
+        old_starts = [f[3] for f in self.previous["functions"]]
+        old_blocks = []
+        function_blocks = collections.defaultdict(list)
+        for startaddress, analysed, saved_blocks in self.previous["cfgs"]:
+            for b in saved_blocks:
+                if b[1]:
+                    function_blocks[bisect.bisect_right(old_starts, b[1][0]) - 1].append(len(old_blocks))
+                old_blocks.append((b, analysed))
+
+        blocks = []
+        loop_tags = []
+        analysed_blocks = set()
+
+        for index, (name, fp, start, end) in enumerate(self.functions):
+            old = self.reused[name]
+            old_start, old_end = old[3], old[4]
+            delta = start - old_start
+            for insn, state in zip(insns[start:end], old_insns[old_start:old_end]):
+                insn.markedNotCall, insn.markedAsCall = state[2:4]
+
+            fn_blocks = {}
+            for i in function_blocks[index]:
+                address, insn_ids, dests, header, header2 = old_blocks[i][0]
+                bb = cfg.BasicBlock(address + delta)
+                bb.instructions = [insns[j + delta] for j in insn_ids]
+                bb.features = self.previous["features"][i]
+                fn_blocks[i] = bb
+            for i, bb in fn_blocks.items():
+                (address, insn_ids, dests, header, header2), analysed = old_blocks[i]
+                bb.destinations = [fn_blocks[d] for d in dests]
+                if analysed:
+                    loop_tags.append((bb, fn_blocks.get(header), fn_blocks.get(header2)))
+                    analysed_blocks.add(id(bb))
+            blocks.extend(fn_blocks.values())
+
+        for i, insn in enumerate(insns):
+            insn.address = i
+
+        blocks.sort(key=lambda bb: bb.address)
+        cfgs = cfg.cfgsFromBlocks(blocks)
+
+        # CFGs which had their loops found keep them
+        for bb, header, header2 in loop_tags:
+            bb.iloop_header = header
+            bb.iloop_header2 = header2
+        for c in cfgs:
+            if all(id(bb) in analysed_blocks for bb in c.basicblocks):
+                c.buildLoopForest()
+
+        return cfgs
+
+    # Save the instructions and the CFGs built from them. This should be
+    # done before the iterations are estimated, as they depend on the
+    # other files
+    def save(self, call_sites, cfgs):
+        if not self.use_cache:
+            return
+
+        saved_cfgs, closed = self.saveCFGs(cfgs)
+
+        call_set = set(call_sites)
+        functions = []
+        for i, (name, fp, start, end) in enumerate(self.functions):
+            functions.append((name, fp, functionCallsKey(self.instructions[start:end], call_set), start, end, closed[i]))
+
+        entry = {
+            "instructions": [insn.saveState() for insn in self.instructions],
+            "blanked": sorted(self.lines.blanked),
+            "calls": self.calls,
+            "call_sites": callSitesKey(call_sites),
+            "cfgs": saved_cfgs,
+            "features": [(bb.codeSize(), bb.cycleCount()) for c in cfgs for bb in c.basicblocks],
+            "functions": functions,
+        }
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        # Write to a temporary file first, so that a reader never sees half
+        # an entry
+        fd, tmp = tempfile.mkstemp(dir=cache_dir)
+        f = os.fdopen(fd, "wb")
+        cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmp, self.path)
+
+        f = open(self.latest, "w")
+        f.write(os.path.basename(self.path)[:-len(".pickle")])
+        f.close()
+
+        self.entry = entry
+
+    # Flatten the CFGs into lists of block tuples. Also returns whether
+    # each function is closed
+    def saveCFGs(self, cfgs):
+        insn_ids = {id(insn): i for i, insn in enumerate(self.instructions)}
+        block_ids = {}
+        for c in cfgs:
+            for bb in c.basicblocks:
+                block_ids[id(bb)] = len(block_ids)
+
+        def blockId(bb):
+            return block_ids[id(bb)] if bb is not None else -1
+
+        # A function is closed if every CFG with a block in it lies
+        # entirely within it
+        starts = [f[2] for f in self.functions]
+        closed = [True] * len(self.functions)
+
+        saved_cfgs = []
+        for c in cfgs:
+            saved_blocks = []
+            owners = set()
+            for bb in c.basicblocks:
+                ids = [insn_ids[id(i)] for i in bb.instructions]
+                owners.update(bisect.bisect_right(starts, i) - 1 for i in ids)
+                saved_blocks.append((bb.address, ids,
+                    [block_ids[id(d)] for d in bb.destinations],
+                    blockId(bb.iloop_header), blockId(bb.iloop_header2)))
+            if len(owners) > 1:
+                for o in owners:
+                    closed[o] = False
+            saved_cfgs.append((c.startaddress, c.loops is not None, saved_blocks))
+
+        return saved_cfgs, closed
+
+# A summary of the CFGs, for comparing two builds of the same file
+def describeCFGs(cfgs):
+    desc = []
+    for c in cfgs:
+        c.findLoops()
+        desc.append([(bb.address, [i.address for i in bb.instructions],
+                      [i.markedAsCall for i in bb.instructions],
+                      [d.address for d in bb.destinations],
+                      [h.address for h in bb.getLoopHeaders()],
+                      bb.codeSize(), bb.cycleCount()) for bb in c.basicblocks])
+    return desc
+
+# Check that analysing NEW after OLD, reusing what was saved about OLD,
+# builds the same CFGs as building NEW from scratch
+if __name__ == "__main__":
+    import sys, shutil
+    import rammanager
+
+    if len(sys.argv) != 3:
+        print "Usage: analysiscache.py OLD NEW"
+        sys.exit(2)
+    old, new = sys.argv[1:]
+
+    tmp = tempfile.mkdtemp()
+    cache_dir = os.path.join(tmp, "cache")
+    fname = os.path.join(tmp, os.path.basename(new))
+
+    def analyse(src, use_cache):
+        shutil.copy(src, fname)
+        c = CachedFile(fname, loader=rammanager.loadInstructions, use_cache=use_cache)
+        arm.precomputeSizes(c.uncosted)
+        return describeCFGs(c.cfgs(c.calls, rammanager.constructCFGs))
+
+    try:
+        analyse(old, True)
+        incremental = analyse(new, True)
+        full = analyse(new, False)
+    finally:
+        shutil.rmtree(tmp)
+
+    if incremental != full:
+        for i, (a, b) in enumerate(zip(incremental, full)):
+            if a != b:
+                print "CFG {} differs".format(i)
+                print "    incremental:", a
+                print "    full:       ", b
+                break
+        else:
+            print "{} CFGs built incrementally, {} from scratch".format(len(incremental), len(full))
+        sys.exit(1)
+    print "{} CFGs, the incremental build matches".format(len(full))
@@ -1,17 +1,173 @@
-import re, string
+import re, string, collections
+from array import array
 from asminstruction import AsmInstruction
 from logging import warning, info, debug
 import asmsize
+import thumbsize
 
 label_regex     = r'^([a-f0-9]{8})\s<([^>]+)>:'
 instr_regex     = r'^\s*(?P<address>[a-f0-9]+):\s+(?P<size>([a-f0-9]+[ ]?)+)\s+(?P<insn>.+)'
+operator_regex  = re.compile(r'([a-zA-Z0-9.]+)\s*([^;]*)')
 
 disassembler    = "arm-none-eabi-objdump"
 
+conditions = ["eq", "ne", "cs", "cc", "hs", "lo", "mi", "pl", "vs", "vc", "hi",
+              "ls", "ge", "lt", "gt", "le", "al"]
+
+# TODO if pc is dest, add pipeline flush
+pipeline_flush = 2
+
+# Cycle counts for the Cortex-M3, split by the size of the encoding. Where
+# a mnemonic appears in more than one list, the first list wins
+two_bytes_one_cycle =  ["adc", "add", "and", "asr", "bic", "cmn", "cmp", "cpy",
+                        "eor", "lsl", "lsr", "mov", "mul", "mvn", "neg", "orr",
+                        "ror", "sbc", "sub", "tst", "rev", "revh", "revsh",
+                        "sxtb", "sxth", "uxtb", "uxth", "mul", "nop",
+
+                        "adds", "movs", "subs", "lsls", "asrs", "orrs", "lsrs",
+                        "eors", "mvns", "muls", "ands", "negs",
+
+                        "it", "ite", "itt", "ittt", "itttt",
+                        ]
+two_bytes_one_flush =   [
+                        "b", "bl", "bx", "blx",
+
+                        "cbz", "cbnz"
+                        ]
+
+two_bytes_two_cycles =  ["ldr", "ldrb", "ldrh", "ldrsb", "ldrsh", "str", "strb",
+                        "strh",
+
+                        "adr"]
+
+four_bytes_one_cycle =  ["adcs", "adds", "cmn", "rsbs", "sbcs", "subs", "cmp",
+                        "ands", "tst", "bics", "eors", "teq", "orrs", "movs",
+                        "orns", "mvns", "adc", "add", "cmn", "rsb", "sbc",
+                        "sub", "and", "bic", "eor", "orr", "mov", "orn", "mvn", "nop",
+                        "negs",
+
+                        "movw", "movt", "addw", "subw", "movw", "mov",
+
+                        "bfi", "bfc", "ubfx", "sbfx",
+
+                        "asrs", "lsls", "lsrs", "rors", "rrxs",
+                        "asr", "lsl", "lsr", "ror", "rrx",
+
+                        "rev", "revh", "revsh", "rbit", "clz", "sxtb", "sxth", "uxtb", "uxth",
+
+                        "mul", "mla", "mls", "mul",
+                        ]
+
+four_bytes_one_flush  = [
+                        "bl", "b",
+                        ]
+
+four_bytes_two_cycles=   ["mla", "mls",
+
+                        "ldr", "ldrb", "ldrsb", "ldrh", "ldrsh", "str", "strb", "strh",
+
+                        "ldrd", "strd",
+
+                        "adr",
+                        ]
+
+four_bytes_three_cycles = ["umull", "smull", "umlal", "smlal"]
+
+# Each timing is (cycles, pipeline flush, extra cycles per register listed)
+def buildTiming(tables):
+    timing = {}
+    for ops, t in tables:
+        for op in ops:
+            timing.setdefault(op, t)
+    return timing
+
+timing2 = buildTiming([
+            (two_bytes_one_cycle, (1, False, 0)),
+            (two_bytes_one_flush, (1, True, 0)),
+            (two_bytes_two_cycles, (2, False, 0)),
+            (["ldmia", "stmia"], (1, False, 1)),
+            (["push", "pop"], (2, False, 1))])
+
+timing4 = buildTiming([
+            (four_bytes_one_cycle, (1, False, 0)),
+            (four_bytes_one_flush, (1, True, 0)),
+            (four_bytes_two_cycles, (2, False, 0)),
+            (four_bytes_three_cycles, (3, False, 0)),
+            (["ldm", "stm", "stmia", "ldmia"], (1, False, 1)),
+            (["push", "pop"], (2, False, 1)),
+            (["sdiv", "udiv"], (6, False, 0))])
+
+direct_branches = ["b", "bx", "cbnz", "cbz"]
+calls = ["bl", "blx"]
+loads = ["ldr", "pop", "ldm", "ldmia"]
+stores = ["str", "push", "stm", "stmia"]
+
+# Instructions which are only branches if they write to the pc. "list" means
+# pc is in the register list, "dest" that it is the destination register
+# and "table" that it is a table branch relative to the pc
+pc_branches = {"pop": "list", "ldmia": "list", "mov": "dest", "ldr": "dest", "tbh": "table"}
+
+Opcode = collections.namedtuple("Opcode", ["base", "cond", "width", "stripped",
+    "branch", "pcbranch", "call", "load", "store", "timing2", "timing4"])
+
+def makeOpcode(base, cond, width):
+    # Conditional branches keep their condition, the rest can only be
+    # conditional inside an IT block
+    if base == "b":
+        stripped = base + cond + width
+    else:
+        stripped = base + width
+
+    return Opcode(base, cond, width, stripped,
+                  base in direct_branches, pc_branches.get(base),
+                  base in calls, base in loads, base in stores,
+                  timing2.get(base), timing4.get(base))
+
+# Every mnemonic we know about, with each condition code and width suffix, is
+# decoded once here, so that classifying an instruction is a dict lookup
+base_mnemonics = set(timing2) | set(timing4) | set(direct_branches + calls + loads + stores) \
+               | set(pc_branches) | (thumbsize.always16 - set("b"+c for c in conditions)) | thumbsize.always32 \
+               | set(thumbsize.handlers) | set(["adr", "cpy", "itt", "ite", "itet", "itte", "itee",
+                                                "ittt", "itttt", "itete", "ittee", "iteee"])
+widths = ["", ".w", ".n"]
+
+opcodes = {}
+for base in base_mnemonics:
+    for width in widths:
+        opcodes[base + width] = makeOpcode(base, "", width)
+for base in base_mnemonics:
+    for cond in conditions:
+        for width in widths:
+            opcodes.setdefault(base + cond + width, makeOpcode(base, cond, width))
+
+def decodeOperator(op):
+    if op in opcodes:
+        return opcodes[op]
+
+    width = ""
+    if op[-2:] in widths:
+        op, width = op[:-2], op[-2:]
+    cond = ""
+    if op[-2:] in conditions and len(op) > 4:
+        op, cond = op[:-2], op[-2:]
+
+    o = makeOpcode(op, cond, width)
+    opcodes[op + cond + width] = o
+    return o
+
 class ArmAsmInstruction(AsmInstruction):
+    __slots__ = ["insnsize", "cycles", "flush", "opinfo"]
+
     def __init__(self, asm, lineno):
         super(ArmAsmInstruction, self).__init__(asm, lineno)
+    # Forget the costs worked out for this instruction, as it has changed
+    def invalidate(self):
+        self.insnsize = None
+        self.cycles = None
+        self.flush = None
     def processLine(self, l):
+        self.invalidate()
+        self.opinfo = None
         parts = l.split(':')
         parts[0] = parts[0].strip()
         # If len == 3, then we often have :lower16: type directives
@@ -19,73 +175,85 @@ class ArmAsmInstruction(AsmInstruction):
             if parts[1].strip() != "":
                 print parts[0]
                 print "Stuff after label? '{}'".format(parts[1])
-            self.label = parts[0].strip()
+            self.label = intern(parts[0].strip())
             self.operator=""
             self.operands=""
+            self.opinfo = decodeOperator("")
         else:
             if l.strip()[0] in ['.', '@']: # Dont care about directives
                 return
-            sregex = r'([a-zA-Z0-9.]+)\s*([^;]*)'
-
-            m = re.match(sregex, l.strip())
+            m = operator_regex.match(l.strip())
             if m is None:
                 print "Unmatched: "+l.strip()
                 return
 
-            self.operator = m.group(1).lower()
+            # Interned, as the same operators and operands repeat many times
+            self.operator = intern(m.group(1).lower())
             # self.operator = self.operator.split('.')[0]
-            self.operands = m.group(2).strip()
+            self.operands = intern(m.group(2).strip())
+            self.opinfo = decodeOperator(self.operator)
     def isLabel(self):
         return self.label is False
-    def isBranch(self):
-        if self.operator in ["b", "bx", "beq", "bne", "bcs", "bcc", "bhs", "blo", "bmi", "bpl", "bvs", "bvc", "bhi", "bls", "bge", "blt", "bgt", "ble", "cbnz", "cbz"]:
-            return True
-        if self.operator[:3] == "pop" or self.operator[:5] == "ldmia":
-            if "pc" in self.operands:
-                return True
-        if self.operator == "mov" or self.operator == "ldr":
-            if self.operands[:2] == "pc":
-                return True
-        if self.operator == "tbh" and self.operands[1:3] == "pc":
-            return True
+    # The fields of the instruction as a tuple, so that parsed instructions
+    # can be saved and restored without parsing them again
+    def saveState(self):
+        return (self.operator, self.operands, self.markedNotCall, self.markedAsCall,
+                self.lineno, self.label, self.address, self.file,
+                self.insnsize, self.cycles, self.flush)
+    @staticmethod
+    def restoreState(state):
+        insn = ArmAsmInstruction.__new__(ArmAsmInstruction)
+        (insn.operator, insn.operands, insn.markedNotCall, insn.markedAsCall,
+         insn.lineno, insn.label, insn.address, insn.file,
+         insn.insnsize, insn.cycles, insn.flush) = state
+        insn.opinfo = decodeOperator(insn.operator)
+        return insn
+    # The decoded form of the operator, from the opcode table
+    def opcode(self):
+        return self.opinfo
+    # Whether this is a load, move or table branch which writes to the pc
+    def isPCBranch(self):
+        kind = self.opinfo.pcbranch
+        if kind == "list":
+            return "pc" in self.operands
+        if kind == "dest":
+            return self.operands[:2] == "pc"
+        if kind == "table":
+            return self.operands[1:3] == "pc"
         return False
+    def isBranch(self):
+        o = self.opinfo
+        return o.branch or (o.pcbranch is not None and self.isPCBranch())
+    # Returns "load", "store" or None
+    def memoryClass(self):
+        if self.opinfo.load:
+            return "load"
+        if self.opinfo.store:
+            return "store"
+        return None
     def isLoad(self):
-        if self.operator in ["ldr", "pop", "ldm", "ldmia"]:
-            return True
-        return False
+        return self.opinfo.load
     def isStore(self):
-        if self.operator in ["str", "push", "stm", "stmia"]:
-            return True
-        return False
+        return self.opinfo.store
     def isUnconditional(self):
         if not self.isBranch():
             return False
-        if self.operator in ["b", "bx"]:
-            return True
-        if self.operator == "pop" or self.operator[:5] == "ldmia":
-            if "pc" in self.operands:
-                return True
-        if self.operator == "mov" or self.operator == "ldr":
-            if self.operands[:2] == "pc":
-                return True
-        if self.operator == "tbh" and self.operands[1:3] == "pc":
-            return True
-        return False
+        if self.opinfo.cond not in ["", "al"]:
+            return False
+        return self.opinfo.base in ["b", "bx"] or self.isPCBranch()
     def isCall(self):
-        if self.operator in ["bl", "blx"] and not self.markedNotCall:
-            return True
-        return False
+        return self.opinfo.call and not self.markedNotCall
     def isNop(self):
-        if self.operator in ["nop"]:
-            return True
-        return False
+        return self.opinfo.base == "nop"
     def isDotWord(self):
         return self.operator in [".word"]
     def branchDestination(self):
         if not self.isBranch() and not self.isCall():
             return False
 
-        if self.operator in ["cbnz", "cbz"]:
+        o = self.opinfo
+
+        if o.base in ["cbnz", "cbz"]:
             d = self.operands.split(',')
             return d[1].strip()
 
@@ -93,9 +261,7 @@ class ArmAsmInstruction(AsmInstruction):
         d = self.operands.strip()
         if d == "":
             return None
-        if self.operator[:3] == "pop" or self.operator[:5] == "ldmia":
-            return None
-        if self.operator == "mov" or self.operator == "ldr" or self.operator == "bx":
+        if o.pcbranch in ["list", "dest"] or o.base == "bx":
             return None
         # if self.operator == "tbh" and self.operands[1:3] == "pc":
             # return None
@@ -103,17 +269,17 @@ class ArmAsmInstruction(AsmInstruction):
         return d
     def markNotCall(self):
         self.markedNotCall = True
+        self.invalidate()
     def markAsCall(self):
         self.markedAsCall = True
+        self.invalidate()
     def doDelaySlot(self):
         return False
     def stripConditional(self):
-        op = self.operator
-        for suffix in ["gt", "le", "lt", "ne", "ge", "eq", "ls", "hi", "cc", "cs", "mi", "pl"]: # TODO MORE
-            if suffix == self.operator[-2:] and len(self.operator)>4:
-                op = self.operator[:-2]
-        return op
-    def insnSize(self):
+        return self.opinfo.stripped
+    # Return the instruction text and branch destination (if any) that
+    # asmsize needs to determine the size of this instruction
+    def sizeRequest(self):
         dest = None
         if self.isBranch():
             dest = self.branchDestination()
@@ -129,129 +295,121 @@ class ArmAsmInstruction(AsmInstruction):
             if "-" in dest:
                 dest = dest[:dest.index('-')]
 
-        self.insnsize = asmsize.findSize(insn, b_dest=dest)
+        return insn, dest
+    # A conditional instruction that isn't a branch must be in an IT block
+    def inITBlock(self):
+        return self.stripConditional() != self.operator
+    # Look the size up in the Thumb-2 encoding tables, returning None if
+    # the assembler is needed to work it out
+    def tableSize(self):
+        if self.label is not False:
+            return 0
+        return thumbsize.findSize(self.stripConditional(), self.operands, self.inITBlock())
+    def insnSize(self):
+        if self.insnsize is not None:
+            return self.insnsize
+
+        self.insnsize = self.tableSize()
+
+        if self.insnsize is None:
+            insn, dest = self.sizeRequest()
+            self.insnsize = asmsize.findSize(insn, b_dest=dest)
 
         return self.insnsize
 
+    # Fill in costs which have already been worked out elsewhere, e.g. by
+    # another process
+    def setCosts(self, size, cycles, flush):
+        self.insnsize = size
+        self.cycles = cycles
+        self.flush = flush
+
     def cycleCount(self):
-        two_bytes_one_cycle =  ["adc", "add", "and", "asr", "bic", "cmn", "cmp", "cpy",
-                                "eor", "lsl", "lsr", "mov", "mul", "mvn", "neg", "orr",
-                                "ror", "sbc", "sub", "tst", "rev", "revh", "revsh",
-                                "sxtb", "sxth", "uxtb", "uxth", "mul", "nop",
-
-                                "adds", "movs", "subs", "lsls", "asrs", "orrs", "lsrs",
-                                "eors", "mvns", "muls", "ands", "negs",
-
-                                "it", "ite", "itt", "ittt", "itttt",
-                                ]
-        two_bytes_one_flush =   [
-                                "b", "bl", "bx", "blx",
-
-                                "beq", "bne", "ble", "bgt", "bge", "blt", "bcc", "bcs", "bmi",
-                                "bpl", "bvs", "bhi", "bls",
-
-                                "cbz", "cbnz"
-                                ]
-
-        two_bytes_two_cycles =  ["ldr", "ldrb", "ldrh", "ldrsb", "ldrsh", "str", "strb",
-                                "strh",
-
-                                "adr"]
-
-        four_bytes_one_cycle =  ["adcs", "adds", "cmn", "rsbs", "sbcs", "subs", "cmp",
-                                "ands", "tst", "bics", "eors", "teq", "orrs", "movs",
-                                "orns", "mvns", "adc", "add", "cmn", "rsb", "sbc",
-                                "sub", "and", "bic", "eor", "orr", "mov", "orn", "mvn", "nop",
-                                "negs",
-
-                                "movw", "movt", "addw", "subw", "movw", "mov",
-
-                                "bfi", "bfc", "ubfx", "sbfx",
-
-                                "asrs", "lsls", "lsrs", "rors", "rrxs",
-                                "asr", "lsl", "lsr", "ror", "rrx",
-
-                                "rev", "revh", "revsh", "rbit", "clz", "sxtb", "sxth", "uxtb", "uxth",
-
-                                "mul", "mla", "mls", "mul",
-                                ]
-
-        four_bytes_one_flush  = [
-                                "bl", "b",
-
-                                "beq", "bne"
-                                ]
-
-        four_bytes_two_cycles=   ["mla", "mls",
-
-                                "ldr", "ldrb", "ldrsb", "ldrh", "ldrsh", "str", "strb", "strh",
-
-                                "ldrd", "strd",
-
-                                "adr",
-                                ]
-
-        four_bytes_three_cycles = ["umull", "smull", "umlal", "smlal"]
-
-
-        # TODO if pc is dest, add pipeline flush
-        pflush = 2
-        do_flush = False
-        cyc = 0
-
-        if self.insnSize() == 2:
-            if self.stripConditional() in two_bytes_one_cycle:
-                cyc = 1
-            elif self.stripConditional() in two_bytes_one_flush:
-                cyc = 1
-                do_flush = True
-            elif self.stripConditional() in two_bytes_two_cycles:
-                cyc =  2
-            elif self.stripConditional() in ["ldmia", "stmia"]:
-                cyc =  1 + self.operands.count(',')
-            elif self.stripConditional() in ["push", "pop"]:
-                cyc =  1 + self.operands.count(',')+1
-            else:
-                raise RuntimeError("Unknown cycle count for "+ str(self.operator))
-            # ldm stm push pop
-        elif self.insnSize() == 4:
-            if self.stripConditional() in four_bytes_one_cycle:
-                cyc = 1
-            elif self.stripConditional() in four_bytes_one_flush:
-                cyc = 1
-                do_flush = True
-            elif self.stripConditional() in four_bytes_two_cycles:
-                cyc = 2
-            elif self.stripConditional() in four_bytes_three_cycles:
-                cyc = 3
-            elif self.stripConditional() in ["ldm", "stm", "stmia", "ldmia"]:
-                cyc =  1 + self.operands.count(',')
-            elif self.stripConditional() in ["push", "pop"]:
-                cyc =  1 + self.operands.count(',')+1
-            elif self.stripConditional() in ["sdiv", "udiv"]:
-                cyc = 6
-            else:
-                print self
-                raise RuntimeError("Unknown cycle count for "+ str(self.operator))
+        if self.cycles is None:
+            self.cycles, self.flush = self.computeCycles()
+        return self.cycles
+
+    # Whether the instruction causes a pipeline flush
+    def pipelineFlush(self):
+        self.cycleCount()
+        return self.flush
+
+    # Return the number of cycles, and whether there is a pipeline flush
+    def computeCycles(self):
+        size = self.insnSize()
+
+        if size == 2:
+            t = self.opinfo.timing2
+        elif size == 4:
+            t = self.opinfo.timing4
         else:
-            return 0
+            return 0, False
 
-        if do_flush:
-            cyc += pflush
+        if t is None:
+            if size == 4:
+                print self
+            raise RuntimeError("Unknown cycle count for "+ str(self.operator))
 
-        return cyc
+        cyc, do_flush, per_reg = t
+        cyc += per_reg * self.operands.count(',')
 
+        if do_flush:
+            cyc += pipeline_flush
+
+        return cyc, do_flush
+
+
+# Size all the instructions the tables can't handle in one go, so that the
+# assembler is only invoked once for the whole list, rather than once for
+# each instruction
+def precomputeSizes(instructions):
+    asmsize.findSizes([insn.sizeRequest() for insn in instructions if insn.tableSize() is None])
+
+# The lines of an assembly file, kept as the one string read from the file
+# plus the offset each line starts at, rather than a list of strings. Lines
+# can be blanked out, which is the only change made to them before the
+# transformations are applied.
+class SourceBuffer(object):
+    def __init__(self, text):
+        self.text = text
+        self.offsets = array('l', [0])
+        self.blanked = set()
+
+        pos = text.find('\n')
+        while pos != -1:
+            self.offsets.append(pos + 1)
+            pos = text.find('\n', pos + 1)
+        if self.offsets[-1] != len(text):
+            self.offsets.append(len(text))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+    def __getitem__(self, lineno):
+        if lineno in self.blanked:
+            return ""
+        return self.text[self.offsets[lineno]:self.offsets[lineno+1]]
+    def __iter__(self):
+        for lineno in xrange(len(self)):
+            yield self[lineno]
+    def blank(self, lineno):
+        self.blanked.add(lineno)
 
 def loadInstructions(fname):
-    lines = open(fname).readlines()
+    lines = SourceBuffer(open(fname).read())
 
     instructions = []
     functions = []
 
     for lineno, l in enumerate(lines):
-        insn = ArmAsmInstruction(l, lineno)
+        # Only build instructions for lines which could be one, or a label.
+        # Everything else starting with . or @ is a directive or comment
+        s = l.lstrip()
+        if s == "" or (s[0] in ".@" and ':' not in s):
+            insn = None
+        else:
+            insn = ArmAsmInstruction(l, lineno)
 
-        if (insn.operator != "" and insn.operator is not None) or insn.label is not False:
+        if insn is not None and ((insn.operator != "" and insn.operator is not None) or insn.label is not False):
             instructions.append(insn)
             debug("Instruction:"+str(insn))
 
@@ -260,7 +418,6 @@ def loadInstructions(fname):
             functions.append(m.group(1))
 
         if ".cfi" in l or ".size" in l or ".loc" in l:
-            lines[lineno] = ""
+            lines.blank(lineno)
 
     return instructions, lines, functions
-
@@ -1,5 +1,10 @@
 
 class AsmInstruction(object):
+    # Instructions are created for every line of every assembly file, so
+    # all of their state is declared up front, rather than kept in a dict
+    __slots__ = ["operator", "operands", "markedNotCall", "markedAsCall",
+                 "lineno", "label", "address", "file"]
+
     def __init__(self, asm, lineno=None):
         self.operator = None
         self.operands = None
@@ -7,6 +12,8 @@ class AsmInstruction(object):
         self.markedAsCall = False
         self.lineno = lineno
         self.label = False
+        self.address = None     # Index in the instruction list, set by the CFG
+        self.file = None
         self.processLine(asm)
     def processLine(self, l):
         pass
@@ -2,22 +2,114 @@ import pexpect
 import tempfile, os, os.path
 import re
 import cPickle, atexit
-from lockfile import FileLock
+import sqlite3, hashlib
+
+# Sizes are kept in an sqlite database, so that several processes can share
+# (and add to) the cache at once, and entries are saved as soon as they are
+# found. The database is only opened on the first lookup, and entries are
+# keyed by the toolchain version and preamble, so that upgrading the compiler
+# doesn't reuse stale sizes. Sizes from the old pickled cache were found with
+# an unknown toolchain, so they are kept under their own key, and only used
+# when there is no toolchain to size instructions with.
+cache_file = os.path.expanduser("~/.asmsize.db")
+legacy_cache_file = os.path.expanduser("~/.asmsize.pickle")
 
 cache = {}
-if os.path.exists(os.path.expanduser("~/.asmsize.pickle")):
-    f = open(os.path.expanduser("~/.asmsize.pickle"))
-    cache = cPickle.load(f)
-    f.close()
+db = None
+db_pid = None
+cache_key = None
+toolchain_key = None
+toolchain_version = None
+legacy_key = "legacy"
+
+hits = 0
+misses = 0
+
+def toolchainVersion():
+    global toolchain_version
+    if toolchain_version is None:
+        try:
+            out = pexpect.run("arm-none-eabi-gcc --version")
+        except pexpect.ExceptionPexpect:
+            toolchain_version = "unknown"
+        else:
+            toolchain_version = out.split('\n')[0].strip()
+    return toolchain_version
+
+# Identifies the toolchain and preamble which the sizes are found with
+def toolchainKey():
+    global toolchain_key
+    if toolchain_key is None:
+        toolchain_key = hashlib.sha1(toolchainVersion() + preamble).hexdigest()
+    return toolchain_key
+
+def openCache():
+    global db, db_pid, cache_key
+
+    # A connection can't be shared with a forked child, so each process
+    # opens its own
+    if db is not None and db_pid == os.getpid():
+        return
+    db_pid = os.getpid()
+
+    if toolchainVersion() == "unknown":
+        cache_key = legacy_key
+    else:
+        cache_key = toolchainKey()
+
+    new_db = not os.path.exists(cache_file)
+
+    db = sqlite3.connect(cache_file, timeout=60)
+    db.text_factory = str
+    db.execute("CREATE TABLE IF NOT EXISTS sizes (key TEXT, insn TEXT, size INTEGER, PRIMARY KEY (key, insn))")
+    db.commit()
+
+    # Carry over the sizes from the old pickled cache
+    if new_db and os.path.exists(legacy_cache_file):
+        f = open(legacy_cache_file)
+        old = cPickle.load(f)
+        f.close()
+        db.executemany("INSERT OR REPLACE INTO sizes VALUES (?, ?, ?)", [(legacy_key, insn, size) for insn, size in old.items()])
+        db.commit()
+
+def lookup(insn):
+    global hits, misses
 
-def save():
-    global cache
-    f = open(os.path.expanduser("~/.asmsize.pickle"),"w")
-    cPickle.dump(cache,f)
-    f.close()
-    print "Saved instruction cache"
+    if insn in cache:
+        hits += 1
+        return cache[insn]
+
+    openCache()
+    row = db.execute("SELECT size FROM sizes WHERE key = ? AND insn = ?", (cache_key, insn)).fetchone()
+    if row is None:
+        misses += 1
+        return None
+
+    hits += 1
+    cache[insn] = row[0]
+    return row[0]
+
+def storeMany(entries):
+    entries = list(entries)
+    openCache()
+    for insn, size in entries:
+        cache[insn] = size
+    db.executemany("INSERT OR REPLACE INTO sizes VALUES (?, ?, ?)", [(cache_key, insn, size) for insn, size in entries])
+    db.commit()
+
+def store(insn, size):
+    storeMany([(insn, size)])
 
-atexit.register(save)
+# Return every size in the cache for the current toolchain
+def allEntries():
+    openCache()
+    return dict(db.execute("SELECT insn, size FROM sizes WHERE key = ?", (cache_key,)))
+
+def report():
+    if hits + misses > 0:
+        print "Instruction size cache: {} hits, {} misses".format(hits, misses)
+
+atexit.register(report)
 
 preamble = """
     .syntax unified
@@ -35,12 +127,26 @@ preamble = """
     .thumb
 """
 
-def findSize(insn, b_dest=None):
-    global cache
+# Run a toolchain command, turning a missing toolchain into a RuntimeError
+# naming the instructions which needed it
+def runToolchain(cmd, insns, **kwargs):
+    try:
+        return pexpect.run(cmd, **kwargs)
+    except pexpect.ExceptionPexpect as e:
+        names = ", ".join(repr(i.strip()) for i in insns[:5])
+        if len(insns) > 5:
+            names += " and {} more".format(len(insns) - 5)
+        raise RuntimeError("Can't size {} without the assembler, as they aren't in the "
+                           "Thumb-2 size table ({})".format(names, e))
 
-    if insn in cache:
-        return cache[insn]
+def findSize(insn, b_dest=None):
+    size = lookup(insn)
+    if size is not None:
+        return size
+    return assembleSize(insn, b_dest)
 
+# Size an instruction with the toolchain, without looking in the cache first
+def assembleSize(insn, b_dest=None):
     t = tempfile.NamedTemporaryFile(delete=False)
     t.write(preamble+"\n")
     t.write(insn+"\n")
@@ -52,12 +158,13 @@ def findSize(insn, b_dest=None):
     newd, name = t.name.rsplit("/", 1)
     os.chdir(newd)
 
-    res = pexpect.run("arm-none-eabi-gcc -c -mthumb -mcpu=cortex-m3 -x assembler {}".format(t.name), withexitstatus=True)
-    if res[1] != 0:
-        raise RuntimeError(res[0]+"\n"+insn)
-    out =  pexpect.run("arm-none-eabi-objdump -d {}.o".format(t.name))
-
-    os.chdir(d)
+    try:
+        res = runToolchain("arm-none-eabi-gcc -c -mthumb -mcpu=cortex-m3 -x assembler {}".format(t.name), [insn], withexitstatus=True)
+        if res[1] != 0:
+            raise RuntimeError(res[0]+"\n"+insn)
+        out = runToolchain("arm-none-eabi-objdump -d {}.o".format(t.name), [insn])
+    finally:
+        os.chdir(d)
 
     size = 0
 
@@ -72,7 +179,94 @@ def findSize(insn, b_dest=None):
 
     os.unlink(t.name)
 
-    cache[insn] = size
+    store(insn, size)
 
     return size
 
+batch_label = "__asmsize_"
+
+# Substitute a unique label for the branch destination in an instruction,
+# so that many instructions can share a single file without their
+# destination labels clashing. The size only depends on the distance to the
+# destination, not its name.
+def renameDestination(insn, b_dest, new_dest):
+    r = r'(?<![\w.$])' + re.escape(b_dest.strip()) + r'(?![\w.$])'
+    return re.sub(r, new_dest, insn)
+
+# Find the size of many instructions at once. Each request is an (insn, b_dest)
+# pair, as would be passed to findSize. All the uncached instructions are
+# assembled in a single file, each under its own label, and the objdump output
+# is split back up by label. This means the toolchain is run once per batch,
+# rather than once per instruction.
+def findSizes(requests):
+    pending = []
+    seen = set()
+    for insn, b_dest in requests:
+        if insn in seen or lookup(insn) is not None:
+            continue
+        seen.add(insn)
+        pending.append((insn, b_dest))
+
+    if not pending:
+        return
+
+    # Each instruction is aligned as if it were at the start of a file, and
+    # followed by its own destination stub and literal pool
+    src = [preamble]
+    for i, (insn, b_dest) in enumerate(pending):
+        src.append(".align 2")
+        src.append("{}{}:".format(batch_label, i))
+        if b_dest is not None:
+            dest = "{}{}_dest".format(batch_label, i)
+            src.append(renameDestination(insn, b_dest, dest))
+            src.append("nop\nnop\nnop\nnop\n"+dest+":")
+        else:
+            src.append(insn)
+        src.append(".ltorg")
+
+    t = tempfile.NamedTemporaryFile(suffix=".s", delete=False)
+    t.write("\n".join(src)+"\n")
+    t.close()
+
+    try:
+        res = runToolchain("arm-none-eabi-gcc -c -mthumb -mcpu=cortex-m3 -x assembler {0} -o {0}.o".format(t.name),
+                           [insn for insn, b_dest in pending], withexitstatus=True)
+    except RuntimeError:
+        os.unlink(t.name)
+        raise
+    if res[1] != 0:
+        os.unlink(t.name)
+        # Something in the batch doesn't assemble. Fall back to sizing one
+        # at a time, leaving the broken instruction to raise when it is
+        # actually needed. These have already been counted as misses
+        for insn, b_dest in pending:
+            try:
+                assembleSize(insn, b_dest=b_dest)
+            except RuntimeError:
+                pass
+        return
+
+    out = runToolchain("arm-none-eabi-objdump -d {}.o".format(t.name), [insn for insn, b_dest in pending])
+    os.unlink(t.name)
+    os.unlink(t.name+".o")
+
+    sizes = {}
+    current = None
+    for l in out.split('\n'):
+        m = re.match(r"[a-f0-9]+ <"+batch_label+r"(\d+)>:", l)
+        if m is not None:
+            current = int(m.group(1))
+            sizes[current] = 0
+            continue
+        if re.match(r"[a-f0-9]+ <", l) is not None:
+            current = None
+            continue
+        if current is None or sizes[current] != 0:
+            continue
+
+        m = re.match(r"\s*[a-f0-9]+:\s*([a-f0-9 ]+)", l)
+        if m is not None:
+            sizes[current] = (len(m.group(1)) - m.group(1).count(' ')) / 2
+
+    storeMany([(insn, sizes[i]) for i, (insn, b_dest) in enumerate(pending) if i in sizes])
+
@@ -0,0 +1,155 @@
+"""Benchmark the assembly front end.
+
+Usage:
+    benchmark.py parse [--repeat N] FILE...
+    benchmark.py cfg [--repeat N] [--branches LIST]
+    benchmark.py placement [--functions N] [--ram LIST] [--tolerance PCT]
+    benchmark.py -h
+
+Options:
+    -h --help           Show this message
+    -r --repeat N       Number of times to repeat each measurement, the
+                        fastest is reported. [default: 5]
+    -b --branches LIST  Comma separated numbers of branches to generate
+                        synthetic assembly with. [default: 10000,20000,50000,100000]
+    --functions N       Number of synthetic functions to place. [default: 6]
+    --ram LIST          Comma separated RAM sizes to place them for.
+                        [default: 100,200,500,1000,5000]
+    --tolerance PCT     How far, in percent, the heuristic placement may be
+                        above the exact one. [default: 1]
+
+Commands:
+    parse               Load the instructions from each assembly file and
+                        classify every one (branch, call, load/store, sizes)
+    cfg                 Build and partition the basic blocks of synthetic
+                        assembly with an increasing number of branches, to
+                        check the scaling
+    placement           Place the blocks of synthetic assembly with the
+                        heuristic and the exact solver, and fail if the
+                        heuristic is too far above the optimum
+"""
+
+from docopt import docopt
+
+import arm, cfg, placement, rammanager
+import time, resource, tempfile, os, sys
+
+def timeit(fn, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        t = time.time() - start
+        if best is None or t < best:
+            best = t
+    return best
+
+def classify(insns):
+    for insn in insns:
+        insn.isBranch()
+        insn.isUnconditional()
+        insn.isCall()
+        insn.isLoad()
+        insn.isStore()
+        insn.branchDestination()
+        insn.stripConditional()
+        insn.tableSize()
+
+def benchParse(fname, repeat):
+    lines = len(open(fname).readlines())
+    insns = arm.loadInstructions(fname)[0]
+
+    t_parse = timeit(lambda: arm.loadInstructions(fname), repeat)
+    # Classify freshly loaded instructions each time, so nothing is cached
+    t_classify = timeit(lambda: classify(arm.loadInstructions(fname)[0]), repeat) - t_parse
+
+    print fname
+    print "    {} lines, {} instructions".format(lines, len(insns))
+    print "    parse:    {:8.1f} ms  {:10.0f} lines/s".format(t_parse*1000, lines/t_parse)
+    print "    classify: {:8.1f} ms  {:10.0f} insns/s".format(t_classify*1000, len(insns)/max(t_classify, 1e-9))
+    print "    peak RSS: {:8.1f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+# Write out a synthetic function with a loop, forward branches and calls
+# to the next function, containing 10 branches
+def syntheticFunction(stream, n):
+    stream.write("\t.thumb_func\n\t.type\tf{0}, %function\nf{0}:\n".format(n))
+    stream.write("\tpush\t{r4, lr}\n\tmovs\tr4, #0\n")
+    stream.write(".Lf{0}_loop:\n\tadds\tr4, r4, #1\n".format(n))
+    for i in range(6):
+        stream.write("\tcmp\tr0, #{1}\n\tbeq\t.Lf{0}_{1}\n\tadds\tr0, r0, #{1}\n".format(n, i))
+        stream.write(".Lf{0}_{1}:\n".format(n, i))
+    stream.write("\tbl\tf{0}\n".format(n+1))
+    stream.write("\tcmp\tr4, #10\n\tbne\t.Lf{0}_loop\n".format(n))
+    stream.write("\tbl\tf{0}\n".format(n+1))
+    stream.write("\tpop\t{r4, pc}\n")
+    stream.write("\t.size\tf{0}, .-f{0}\n".format(n))
+
+def benchCFG(branches, repeat):
+    fd, fname = tempfile.mkstemp(suffix=".s")
+    f = os.fdopen(fd, "w")
+    for i in range(branches / 10):
+        syntheticFunction(f, i)
+    # The last function's calls are left to be resolved at link time
+    f.close()
+
+    insns, lines, functions = arm.loadInstructions(fname)
+    os.remove(fname)
+
+    c = cfg.CFG()
+    t_blocks = timeit(lambda: c.findBasicBlocks(insns, functions), repeat)
+    t_partition = timeit(c.partition, repeat)
+
+    print "{:8d} branches {:8d} insns {:8d} blocks".format(branches, len(insns), len(c.basicblocks))
+    print "    blocks:    {:8.1f} ms  {:6.2f} us/branch".format(t_blocks*1000, t_blocks*1e6/branches)
+    print "    partition: {:8.1f} ms  {:6.2f} us/block".format(t_partition*1000, t_partition*1e6/len(c.basicblocks))
+
+def benchPlacement(functions, budgets, tolerance):
+    fd, fname = tempfile.mkstemp(suffix=".s")
+    f = os.fdopen(fd, "w")
+    for i in range(functions):
+        syntheticFunction(f, i)
+    f.close()
+
+    insns, lines, calls = rammanager.loadInstructions(fname)
+    os.remove(fname)
+
+    cfgs = rammanager.constructCFGs(insns, calls)
+    rammanager.estimateIterations(rammanager.buildCallGraph(cfgs), 10)
+
+    worst = 0
+    for ram in budgets:
+        problem = rammanager.placementProblem(cfgs, spare_ram=ram, max_cycle_factor=1.5)
+        start = time.time()
+        exact = placement.BranchAndBound().solve(problem)
+        t_exact = time.time() - start
+        start = time.time()
+        heuristic = placement.Heuristic().solve(problem)
+        t_heuristic = time.time() - start
+
+        saving = 1 - exact.cost / float(problem.baseCost())
+        gap = (heuristic.cost - exact.cost) / float(exact.cost)
+        worst = max(worst, gap)
+        print "{:8d} bytes {:8d} blocks".format(ram, len(problem))
+        print "    exact:     {:8.1f} ms  {:6.2%} saved, {} blocks in RAM".format(t_exact*1000, saving, len(exact.ramBlocks()))
+        print "    heuristic: {:8.1f} ms  {:6.2%} above the optimum, {} blocks in RAM".format(t_heuristic*1000, gap, len(heuristic.ramBlocks()))
+
+    return worst * 100 <= tolerance
+
+if __name__=="__main__":
+    arguments = docopt(__doc__)
+
+    repeat = int(arguments['--repeat'])
+
+    if arguments['parse']:
+        for f in arguments['FILE']:
+            benchParse(f, repeat)
+
+    if arguments['cfg']:
+        for b in arguments['--branches'].split(","):
+            benchCFG(int(b), repeat)
+
+    if arguments['placement']:
+        budgets = map(int, arguments['--ram'].split(","))
+        if not benchPlacement(int(arguments['--functions']), budgets, float(arguments['--tolerance'])):
+            print "The heuristic is more than {}% above the optimum".format(arguments['--tolerance'])
+            sys.exit(1)
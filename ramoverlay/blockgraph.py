@@ -0,0 +1,85 @@
+from array import array
+
+# A compact view of a list of basic blocks. Each block gets a dense integer
+# id (its position in the list) and the links are stored as CSR arrays:
+# the successors of block i are succ[succ_start[i]:succ_start[i+1]], and
+# likewise for the predecessors. Links to blocks outside of the list are
+# left out.
+#
+# The per block features used by the later stages are kept in arrays
+# parallel to the blocks, filled in by loadFeatures.
+class BlockGraph(object):
+    def __init__(self, basicblocks):
+        self.blocks = list(basicblocks)
+        n = len(self.blocks)
+
+        # Addresses are only unique within a file, so blocks are keyed by
+        # identity
+        self.index = {id(bb): i for i, bb in enumerate(self.blocks)}
+
+        self.succ_start = array('i', [0]) * (n+1)
+        self.succ = array('i')
+        in_degree = array('i', [0]) * n
+
+        for i, bb in enumerate(self.blocks):
+            for d in bb.destinations:
+                j = self.index.get(id(d))
+                if j is not None:
+                    self.succ.append(j)
+                    in_degree[j] += 1
+            self.succ_start[i+1] = len(self.succ)
+
+        self.pred_start = array('i', [0]) * (n+1)
+        for i in range(n):
+            self.pred_start[i+1] = self.pred_start[i] + in_degree[i]
+
+        fill = array('i', self.pred_start[:n])
+        self.pred = array('i', [0]) * len(self.succ)
+        for i in range(n):
+            for k in range(self.succ_start[i], self.succ_start[i+1]):
+                j = self.succ[k]
+                self.pred[fill[j]] = i
+                fill[j] += 1
+
+        self.size = None
+        self.cycles = None
+        self.iterations = None
+        self.depth = None
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def id(self, bb):
+        return self.index[id(bb)]
+
+    def successors(self, i):
+        return self.succ[self.succ_start[i]:self.succ_start[i+1]]
+
+    def predecessors(self, i):
+        return self.pred[self.pred_start[i]:self.pred_start[i+1]]
+
+    def outDegree(self, i):
+        return self.succ_start[i+1] - self.succ_start[i]
+
+    def inDegree(self, i):
+        return self.pred_start[i+1] - self.pred_start[i]
+
+    # Blocks which are not jumped to from another block in the graph
+    def roots(self):
+        return [i for i in range(len(self.blocks)) if self.pred_start[i] == self.pred_start[i+1]]
+
+    # Blocks which leave the graph
+    def exits(self):
+        return [i for i in range(len(self.blocks)) if self.succ_start[i] == self.succ_start[i+1]]
+
+    # Copy the size, cycle count, iterations and loop depth of each block
+    # into the feature arrays. The iterations are estimated after the graph
+    # is built, so this is called when they are needed
+    def loadFeatures(self):
+        for c in set(bb.cfg for bb in self.blocks if bb.cfg is not None):
+            c.findLoops()
+
+        self.size = array('i', [bb.codeSize() for bb in self.blocks])
+        self.cycles = array('i', [bb.cycleCount() for bb in self.blocks])
+        self.iterations = array('d', [bb.iterations or 0 for bb in self.blocks])
+        self.depth = array('i', [len(bb.loop_nest) for bb in self.blocks])
@@ -0,0 +1,152 @@
+import collections
+
+# The calls between the CFGs of a program. The CFGs are numbered by their
+# position in the list, and for each CFG the CFGs it calls are kept along
+# with the number of call sites, as counted by BasicBlock.countCalls.
+#
+# The call destinations are resolved through an index of the labelled blocks,
+# which is built once, rather than searching every block for every call.
+class CallGraph(object):
+    def __init__(self, cfgs):
+        self.cfgs = list(cfgs)
+        self.index = {id(c): i for i, c in enumerate(self.cfgs)}
+
+        # Where a label starts more than one block (static functions of
+        # the same name in different files), the last one is used
+        self.entries = {}
+        for c in self.cfgs:
+            for bb in c.basicblocks:
+                label = bb.instructions[0].label
+                if label:
+                    self.entries[label] = bb
+
+        # A (calling block, called block) pair for each call site
+        self.edges = []
+        self.unknown_labels = set()
+
+        # Per block, the called blocks and the number of calls to each
+        self.block_calls = {}
+
+        # Per CFG, the called CFGs and the number of call sites for each
+        self.callees = [collections.Counter() for c in self.cfgs]
+        self.callers = [collections.Counter() for c in self.cfgs]
+
+        for i, c in enumerate(self.cfgs):
+            for bb in c.basicblocks:
+                counts = bb.countCalls()
+                if not counts:
+                    continue
+
+                calls = []
+                for dest_label, count in counts.items():
+                    dest_bb = self.entries.get(dest_label)
+                    if dest_bb is None:
+                        self.unknown_labels.add(dest_label)
+                        continue
+
+                    calls.append((dest_bb, count))
+                    self.edges.extend([(bb, dest_bb)] * count)
+
+                    j = self.index.get(id(dest_bb.cfg))
+                    if j is not None:
+                        self.callees[i][j] += count
+                        self.callers[j][i] += count
+
+                self.block_calls[id(bb)] = calls
+
+        self.sccs = None
+        self.component = None
+
+    def __len__(self):
+        return len(self.cfgs)
+
+    def id(self, c):
+        return self.index[id(c)]
+
+    # The blocks called from bb, with the number of calls to each
+    def callsFrom(self, bb):
+        return self.block_calls.get(id(bb), [])
+
+    # CFGs which are not called from anywhere, including themselves
+    def roots(self):
+        return [c for i, c in enumerate(self.cfgs) if not self.callers[i]]
+
+    # The strongly connected components of the call graph, found with an
+    # iterative version of Tarjan's algorithm. Each component is a list of
+    # CFG numbers, and the components are ordered so that callers come
+    # before the functions they call.
+    def components(self):
+        if self.sccs is not None:
+            return self.sccs
+
+        n = len(self.cfgs)
+        order = [-1] * n
+        low = [0] * n
+        on_stack = [False] * n
+        stack = []
+        sccs = []
+        count = 0
+
+        for s in range(n):
+            if order[s] != -1:
+                continue
+
+            order[s] = low[s] = count
+            count += 1
+            stack.append(s)
+            on_stack[s] = True
+            work = [(s, iter(self.callees[s]))]
+
+            while work:
+                v, it = work[-1]
+                for w in it:
+                    if order[w] == -1:
+                        order[w] = low[w] = count
+                        count += 1
+                        stack.append(w)
+                        on_stack[w] = True
+                        work.append((w, iter(self.callees[w])))
+                        break
+                    elif on_stack[w]:
+                        low[v] = min(low[v], order[w])
+                else:
+                    work.pop()
+                    if work:
+                        u = work[-1][0]
+                        low[u] = min(low[u], low[v])
+
+                    if low[v] == order[v]:
+                        comp = []
+                        while True:
+                            w = stack.pop()
+                            on_stack[w] = False
+                            comp.append(w)
+                            if w == v:
+                                break
+                        sccs.append(sorted(comp))
+
+        # Tarjan's algorithm finds the callees first
+        sccs.reverse()
+
+        self.sccs = sccs
+        self.component = [0] * n
+        for k, comp in enumerate(sccs):
+            for i in comp:
+                self.component[i] = k
+
+        return self.sccs
+
+    # Whether a component contains a cycle of calls
+    def isRecursive(self, comp):
+        return len(comp) > 1 or comp[0] in self.callees[comp[0]]
+
+    # Components which are not called from outside of themselves
+    def rootComponents(self):
+        self.components()
+        called = set()
+        for k, comp in enumerate(self.sccs):
+            for i in comp:
+                for j in self.callees[i]:
+                    if self.component[j] != k:
+                        called.add(self.component[j])
+        return [comp for k, comp in enumerate(self.sccs) if k not in called]
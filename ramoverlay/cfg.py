@@ -1,18 +1,46 @@
 import re
+import heapq
 import itertools
 import copy
 import collections
 import sys
 from logging import warning, info, debug
 import asmsize
+import dominance
+from blockgraph import BlockGraph
 
 divergent_colors = ["FF6666", "66FF66", "6666FF", "FFFF66", "FF66FF", "66FFFF"]
 
 class BasicBlock(object):
+    # All of the analysis state is declared here, so that blocks stay small
+    # and the later stages don't have to probe for attributes
+    __slots__ = ["instructions", "address", "destinations", "cfg", "iterations",
+                 "inram", "instrumented", "iloop_header", "iloop_header2",
+                 "dfsp_pos", "traversed", "enclosing_headers", "loop_nest", "features"]
+
     def __init__(self, address):
         self.instructions = []
         self.address = address
         self.destinations = []
+        self.cfg = None
+        self.iterations = None
+        self.inram = False
+        self.instrumented = False
+
+        # Loop analysis state
+        self.iloop_header = None
+        self.iloop_header2 = None
+        self.dfsp_pos = 0
+        self.traversed = False
+
+        # Loop headers enclosing this block, innermost first. loop_nest
+        # also includes the block itself if it is a header
+        self.enclosing_headers = []
+        self.loop_nest = []
+
+        # The (size, cycles) of the block, if they were restored from the
+        # analysis cache
+        self.features = None
     def addInstruction(self, insn):
         self.instructions.append(insn)
     def isEmpty(self):
@@ -44,6 +72,8 @@ class BasicBlock(object):
         return cnt
 
     def codeSize(self):
+        if self.features is not None:
+            return self.features[0]
         tot = 0
 
         for i in self.instructions:
@@ -52,6 +82,8 @@ class BasicBlock(object):
         return tot
 
     def cycleCount(self):
+        if self.features is not None:
+            return self.features[1]
         tot = 0
 
         for i in self.instructions:
@@ -89,18 +121,18 @@ class BasicBlock(object):
             headcolor = [None]
             head = "<tr><td align='left' port='f0'>{}</td></tr>".format(self.address)
 
-        if hasattr(self.instructions[0],"lineno"):
+        if self.instructions[0].lineno is not None:
             head += "<tr><td align='left' colspan='{}'>Line: {}</td></tr>".format(len(headcolor), self.instructions[0].lineno)
 
-        if hasattr(self,"iterations"):
+        if self.iterations is not None:
             head += "<tr><td align='left' colspan='{}'>Iterations: {}</td></tr>".format(len(headcolor), self.iterations)
 
-        if hasattr(self,"inram"):
+        if self.inram:
             head += "<tr><td align='left' bgcolor='blue' colspan='{}'>BB IN RAM</td></tr>".format(len(headcolor))
         else:
             head += "<tr><td align='left' colspan='{}'>BB NOT IN RAM</td></tr>".format(len(headcolor))
 
-        if hasattr(self,"instrumented"):
+        if self.instrumented:
             head += "<tr><td align='left' bgcolor='green' colspan='{}'>BB INSTRUMENTED</td></tr>".format(len(headcolor))
         else:
             head += "<tr><td align='left' colspan='{}'>BB NOT INSTRUMENTED</td></tr>".format(len(headcolor))
@@ -124,10 +156,7 @@ class BasicBlock(object):
         return self.instructions[-1]
 
     def getLoopHeaders(self):
-        lh = self.cfg.getLoopHeaders(self)
-        if self in self.cfg.loop_headers:
-            lh = [self] + lh
-        return lh
+        return self.loop_nest
 
     def __hash__(self):
         return self.address
@@ -136,11 +165,33 @@ class BasicBlock(object):
     def __repr__(self):
         return hex(self.address)
 
+# A loop in the loop nesting forest of a CFG. members includes the blocks
+# of any inner loops
+class Loop(object):
+    __slots__ = ["header", "parent", "depth", "members", "children"]
+
+    def __init__(self, header):
+        self.header = header
+        self.parent = None
+        self.depth = 1
+        self.members = set()
+        self.children = []
+
+    def __repr__(self):
+        return "Loop({!r}, depth={})".format(self.header, self.depth)
+
 class CFG(object):
     def __init__(self):
         self.startaddress = None
-        self.loops = []
+        # The loop forest is found once, by findLoops
+        self.loops = None
         self.loop_headers = []
+        self.header_loops = {}
+
+        # Analyses computed on demand and kept until the CFG changes
+        self.block_graph = None
+        self.domtree = None
+        self.postdomtree = None
 
     # def construct(self, instructions, extra_labels=[]):
     #     split_points = set()
@@ -250,6 +301,11 @@ class CFG(object):
     # from the instructions. The choice of entry point is important,
     # as the branches are found sequentially from this entry point
     def construct_new(self, instructions, fn_labels):
+        self.findBasicBlocks(instructions, fn_labels)
+
+    # Split the instructions into basic blocks and link them up. Returns
+    # the map of start address to basic block
+    def findBasicBlocks(self, instructions, fn_labels):
         label2insn = {}
         for i, insn in enumerate(instructions):
             if insn.label is not False:
@@ -271,30 +327,36 @@ class CFG(object):
         # Necessary because a basic block could start after the branch
         # but before the delay slot instruction.
 
-        # Find entry point
-        entry_points = set([])
+        # The entry points are kept in a heap, so that the lowest address
+        # is always processed next. queued mirrors the heap's contents, so
+        # an entry is never pushed twice
+        entry_points = []
+        queued = set()
+        processed_entries = set()
+
+        def addEntry(addr):
+            if addr not in processed_entries and addr not in queued:
+                heapq.heappush(entry_points, addr)
+                queued.add(addr)
 
-        computed_functions = []
+        fn_labels = set(fn_labels)
+        computed_functions = set(fn_labels)
         for i in instructions:
             if i.isCall() and i.branchDestination() is not None:
-                computed_functions.append(i.branchDestination())
+                computed_functions.add(i.branchDestination())
 
-        computed_functions += fn_labels
-
-        for e in fn_labels + computed_functions:
+        # Find entry point
+        for e in computed_functions:
             if e in label2insn:
-                entry_points.add(label2insn[e])
-
+                addEntry(label2insn[e])
 
-        processed_entries = set()
         bb_starts = set()
         split_points = set()
         processed_insns = set()
 
         while len(entry_points) > 0:
-            # current_address = entry_points.pop()
-            current_address = min(entry_points)
-            entry_points.remove(current_address)
+            current_address = heapq.heappop(entry_points)
+            queued.remove(current_address)
             processed_entries.add(current_address)
 
             current_insns = []
@@ -318,30 +380,30 @@ class CFG(object):
 
                 processed_insns.add(current_address)
 
+                dest = insn.branchDestination()
+
                 # Add call destination to entries, as a new basic block
                 # should start from there
-                if insn.isCall() and insn.branchDestination() not in label2insn:
-                    info("Destination {} is not locatable (resolved at linktime?)".format(insn.branchDestination()))
-                elif insn.isCall() and label2insn[insn.branchDestination()] not in processed_entries:
-                    debug("\tFound call@{} to {} ()".format(current_address, insn.branchDestination(), label2insn[insn.branchDestination()]))
-                    entry_points.add(label2insn[insn.branchDestination()])
-                    if current_address+1 not in processed_entries:
-                        entry_points.add(current_address + 1)
+                if insn.isCall() and dest not in label2insn:
+                    info("Destination {} is not locatable (resolved at linktime?)".format(dest))
+                elif insn.isCall() and label2insn[dest] not in processed_entries:
+                    debug("\tFound call@{} to {} ()".format(current_address, dest, label2insn[dest]))
+                    addEntry(label2insn[dest])
+                    addEntry(current_address + 1)
 
                 if insn.isBranch():
                     # Add the current branch and destination as points to split on
 
-                    if insn.branchDestination() is not None:
-                        if insn.branchDestination() not in label2insn or insn.branchDestination() in fn_labels:
+                    if dest is not None:
+                        if dest not in label2insn or dest in fn_labels:
                             debug("\tCould not find branch destination@{}".format(current_address))
                         else:
-                            e = (bb_start, label2insn[insn.branchDestination()])
-                            split_points.add((label2insn[insn.branchDestination()], 0))
+                            bd = label2insn[dest]
+                            split_points.add((bd, 0))
 
                             # Add branch destination as a new entry point for later processing
-                            if label2insn[insn.branchDestination()] not in processed_entries:
-                                entry_points.add(label2insn[insn.branchDestination()])
-                                bd = label2insn[insn.branchDestination()]
+                            if bd not in processed_entries:
+                                addEntry(bd)
                                 debug("\tFound branch@{} to {}".format(current_address, bd))
                     else:
                         debug("\tFound indirect branch@{}".format(current_address))
@@ -363,8 +425,7 @@ class CFG(object):
 
                     # If we fall through, the next instruction is the beginning
                     # of the next basic block
-                    if current_address+1 not in processed_entries:
-                        entry_points.add(current_address + 1)
+                    addEntry(current_address + 1)
 
                     debug("\tEnd BB@{}".format(current_address))
                     split_points.add((current_address, 1))
@@ -445,7 +506,6 @@ class CFG(object):
                     b.destinations.append(bbmap[label2insn[dest]])
                     debug("\tlink to "+hex(bbmap[label2insn[dest]].address))
                 else:
-                    print computed_functions
                     if dest in computed_functions:
                         warning("Standard branch \"{}\"@{} jumping to function:{}".format(str(b.getTailInsn()).strip(),b.address,dest))
                         b.getTailInsn().markAsCall()
@@ -453,23 +513,61 @@ class CFG(object):
                         warning("BB@{} has link to unknown BB@{}".format(b.address, dest))
 
         self.basicblocks = basicblocks
-
-        # Extra pass to cope with call instruction being abused as a local jump
-        # Check in each partitioned cfg, whether the calls at the end of a BB are
-        # in the same cfg or a different CFG. If the same CFG, assume it is being
-        # used as a jump, not a call
-        p_cfgs = self.partition()
-        for cfg in p_cfgs:
-            for bb in cfg.basicblocks:
-                if bb.getTailInsn().isCall():
-                    dest = bb.getTailInsn().branchDestination()
-                    for bb2 in cfg.basicblocks:
-                        if bb2.isContained(dest):
-                            warning("Found contained call")
-                            info("Contained call in BB: "+ hex(bb.address) + ", call to BB: "+ hex(bb2.address))
-                            bb.destinations.remove(bb.destinations[0])
-                            bb.destinations.append(bbmap[dest])
-                            bb.getTailInsn().markNotCall()
+        self.invalidate()
+        return bbmap
+
+    # The integer indexed view of the blocks, which the analyses work on
+    def graph(self):
+        if self.block_graph is None:
+            self.block_graph = BlockGraph(self.basicblocks)
+        return self.block_graph
+
+    # The blocks execution can start from
+    def entryBlocks(self):
+        starts = [bb for bb in self.basicblocks if bb.address in (self.startaddress or [])]
+        if not starts:
+            starts = findStartingBlocks(self.basicblocks)
+        if not starts:
+            starts = self.basicblocks[:1]
+        return starts
+
+    def dominators(self):
+        if self.domtree is None:
+            g = self.graph()
+            roots = [g.id(bb) for bb in self.entryBlocks()]
+            self.domtree = dominance.DominatorTree(g.succ_start, g.succ, roots)
+        return self.domtree
+
+    # Post dominators are found on the reversed CFG, from every block which
+    # leaves the function
+    def postDominators(self):
+        if self.postdomtree is None:
+            g = self.graph()
+            self.postdomtree = dominance.DominatorTree(g.pred_start, g.pred, g.exits())
+        return self.postdomtree
+
+    # True if every path from the entry to b goes through a
+    def dominates(self, a, b):
+        g = self.graph()
+        return self.dominators().dominates(g.id(a), g.id(b))
+
+    # True if every path from b to an exit goes through a
+    def postDominates(self, a, b):
+        g = self.graph()
+        return self.postDominators().dominates(g.id(a), g.id(b))
+
+    def immediateDominator(self, bb):
+        i = self.dominators().idom(self.graph().id(bb))
+        if i is None:
+            return None
+        return self.basicblocks[i]
+
+    # Drop the cached analyses, after the blocks or their links change
+    def invalidate(self):
+        self.block_graph = None
+        self.domtree = None
+        self.postdomtree = None
+        self.loops = None
 
     # Return a map of basic blocks to call destinations
     def findCalls(self):
@@ -483,43 +581,33 @@ class CFG(object):
     # Parition the CFG into non-connected CFGs
     def partition(self):
         cfgs = []
-        bblist = copy.copy(self.basicblocks)
-
         entry_points = self.findCalls()
 
-        while len(bblist) > 0:
-            c = CFG()
-
-            bbsublist = []
-
+        # A link in either direction puts two blocks in the same CFG
+        g = self.graph()
+        seen = [False] * len(self.basicblocks)
 
-            bbsublist = [bblist[0]]
-
-            # Go through the list
-            #   If a destination isn't in the list, but the main block is, add it
-            #   If the main block isnt in the list, but the destination is, add it
-            #   Repeat until unchanged
-            while True:
-                changed = False
-                for bb in bblist:
-                    for d in bb.destinations:
-                        if d in bbsublist:
-                            if bb not in bbsublist:
-                                bbsublist.append(bb)
-                                changed = True
-                        if bb in bbsublist:
-                            if d not in bbsublist:
-                                bbsublist.append(d)
-                                changed = True
-                if not changed:
-                    break
-
-            # Remove the selected blocks
-            for bb in bbsublist:
-                bblist.remove(bb)
+        for first in range(len(self.basicblocks)):
+            if seen[first]:
+                continue
+            c = CFG()
 
-            c.basicblocks = bbsublist
-            starts = findStartingBlocks(c.basicblocks)
+            # Breadth first search from the first block not yet in a CFG
+            seen[first] = True
+            members = [first]
+            queue = collections.deque([first])
+            while queue:
+                i = queue.popleft()
+                for j in itertools.chain(g.successors(i), g.predecessors(i)):
+                    if not seen[j]:
+                        seen[j] = True
+                        members.append(j)
+                        queue.append(j)
+
+            # Keep the blocks in their original order
+            members.sort()
+            c.basicblocks = [self.basicblocks[i] for i in members]
+            starts = [self.basicblocks[i] for i in members if g.inDegree(i) == 0]
 
             # Add extra start blocks from the found destinations of function calls
             for bb in c.basicblocks:
@@ -576,10 +664,7 @@ class CFG(object):
         for bb in self.basicblocks:
             drawn = False
 
-            lh = self.getLoopHeaders(bb)
-
-            if bb in self.loop_headers:
-                lh = [bb] + lh
+            lh = bb.loop_nest
 
             if lh == []:
                 bb.dumpDot(stream)
@@ -595,17 +680,21 @@ class CFG(object):
         stream.write("}\n")
 
     def findLoops(self):
+        if self.loops is not None:
+            return
+
         start_bbs = filter(lambda x: x.address in self.startaddress, self.basicblocks)
 
-        # Maybe this should be transformed into an iterative algorithm, so we dont have to
-        # play around with the recursion depth
-        rec_limit = max(1500,len(self.basicblocks)*2)
-        debug("Set recursion limit to " + str(rec_limit))
-        sys.setrecursionlimit(rec_limit)
+        # Each traversal starts from scratch, so only the last starting
+        # block decides the loops
+        if start_bbs:
+            self.traverseLoops(start_bbs[-1])
 
-        for sb in start_bbs:
-            self.traverseLoops(sb)
+        self.buildLoopForest()
 
+    # Gather up the loop headers tagged on each block by the traversal, and
+    # build the loop forest from them
+    def buildLoopForest(self):
         loop_headers = set()
 
         for bb in self.basicblocks:
@@ -614,26 +703,55 @@ class CFG(object):
 
         self.loop_headers = list(loop_headers)
 
+        # Cache the headers around each block, and build the loop forest
+        # from them
+        loops = {h: Loop(h) for h in self.loop_headers}
+
+        for bb in self.basicblocks:
+            bb.enclosing_headers = self.walkLoopHeaders(bb)
+            if bb in loops:
+                bb.loop_nest = [bb] + bb.enclosing_headers
+            else:
+                bb.loop_nest = bb.enclosing_headers
+
+            for h in bb.loop_nest:
+                if h in loops:
+                    loops[h].members.add(bb)
+
+        for h, loop in loops.items():
+            outer = [l for l in h.enclosing_headers if l in loops]
+            loop.depth = len(outer) + 1
+            if outer:
+                loop.parent = loops[outer[0]]
+                loop.parent.children.append(loop)
+
+        self.header_loops = loops
+        self.loops = sorted(loops.values(), key=lambda l: l.header.address)
+
         # print "Loop headers:"
         # for lh in self.loop_headers:
         #     print "\t", hex(lh.address)
 
+    # The loops with no enclosing loop
+    def rootLoops(self):
+        return [l for l in self.loops if l.parent is None]
 
     def getLoopHeaders(self, node):
+        return node.enclosing_headers
+
+    # Follow the loop headers out from node
+    def walkLoopHeaders(self, node):
         lh = []
-        try:
-            while node.iloop_header is not None:
-                if node == node.iloop_header:
-                    if hasattr(node, "iloop_header2"):
-                        lh.append(node.iloop_header2)
-                        node = node.iloop_header2
-                        continue
-                    else:
-                        break
-                lh.append(node.iloop_header)
-                node = node.iloop_header
-        except AttributeError:
-            pass
+        while node.iloop_header is not None:
+            if node == node.iloop_header:
+                if node.iloop_header2 is not None:
+                    lh.append(node.iloop_header2)
+                    node = node.iloop_header2
+                    continue
+                else:
+                    break
+            lh.append(node.iloop_header)
+            node = node.iloop_header
         return lh
 
     # Implementation of Tao Wei et al. 2012, starts here ##########################
@@ -641,6 +759,7 @@ class CFG(object):
         for bb in self.basicblocks:
             bb.traversed = False
             bb.iloop_header = None
+            bb.iloop_header2 = None
             bb.dfsp_pos = 0
         self.traverseLoopDFS(root,1)
         for bb in self.basicblocks:
@@ -670,39 +789,64 @@ class CFG(object):
                 cur1 = ih
         cur1.iloop_header = cur2
 
-    def traverseLoopDFS(self, b0, dfsp_pos):
-        b0.traversed = True
-        b0.dfsp_pos = dfsp_pos
-        for b in b0.destinations:
-            if not b.traversed:
-                nh = self.traverseLoopDFS(b, dfsp_pos + 1)
-                self.tag_lhead(b0, nh)
-            else:
-                if b.dfsp_pos > 0:
-                    self.tag_lhead(b0, b)
-                elif b.iloop_header is None:
-                    pass
+    # The depth first search uses an explicit stack of blocks and their
+    # remaining destinations, so large functions don't exhaust the
+    # recursion limit. A block's position on the path is its stack depth
+    def traverseLoopDFS(self, root, dfsp_pos):
+        root.traversed = True
+        root.dfsp_pos = dfsp_pos
+        stack = [(root, iter(root.destinations))]
+
+        while stack:
+            b0, dests = stack[-1]
+            for b in dests:
+                if not b.traversed:
+                    b.traversed = True
+                    b.dfsp_pos = dfsp_pos + len(stack)
+                    stack.append((b, iter(b.destinations)))
+                    break
                 else:
-                    h = b.iloop_header
-                    if h.dfsp_pos > 0:
-                        self.tag_lhead(b0, h)
-                    else:
-                        warning("Irreducible CFG")
+                    if b.dfsp_pos > 0:
+                        self.tag_lhead(b0, b)
+                    elif b.iloop_header is None:
                         pass
-                        # print b, "is reentry"
-                        # print "Irreducible CFG"
-                        # print "TODO"
-        b0.dfsp_pos = 0
-        return b0.iloop_header
+                    else:
+                        h = b.iloop_header
+                        if h.dfsp_pos > 0:
+                            self.tag_lhead(b0, h)
+                        else:
+                            warning("Irreducible CFG")
+                            pass
+                            # print b, "is reentry"
+                            # print "Irreducible CFG"
+                            # print "TODO"
+            else:
+                # Every destination has been visited, so return to the
+                # parent and tag it with this block's header
+                stack.pop()
+                b0.dfsp_pos = 0
+                if stack:
+                    self.tag_lhead(stack[-1][0], b0.iloop_header)
+
+        return root.iloop_header
 
     # Implementation of Tao Wei et al. 2012, ends here ##########################
 
-# Finds a block which is not jumped to by another block
-def findStartingBlocks(basicblocks):
-    bbmap = {b: True for b in basicblocks}
+# Split a list of linked basic blocks into separate CFGs
+def cfgsFromBlocks(basicblocks):
+    overall_cfg = CFG()
+    overall_cfg.basicblocks = basicblocks
+
+    cfgs = overall_cfg.partition()
 
-    for bb in basicblocks:
-        for d in bb.destinations:
-            bbmap[d] = False
+    for c in cfgs:
+        for bb in c.basicblocks:
+            bb.cfg = c
+            bb.iterations = 1
 
-    return list(itertools.compress(*zip(*bbmap.items())))
+    return cfgs
+
+# Finds a block which is not jumped to by another block
+def findStartingBlocks(basicblocks):
+    g = BlockGraph(basicblocks)
+    return [g.blocks[i] for i in g.roots()]
@@ -0,0 +1,109 @@
+from array import array
+
+# Dominator trees, found with the iterative algorithm of Cooper, Harvey and
+# Kennedy, "A Simple, Fast Dominance Algorithm", 2001.
+#
+# Nodes are numbered 0..n-1 and the graph is given in CSR form, as in
+# blockgraph: the successors of node v are targets[starts[v]:starts[v+1]].
+# An extra virtual node n is added as the root, with an edge to each
+# of the given roots, so graphs with several entries (or several exits, for
+# post dominators) have a single tree. The tree is numbered in depth first
+# order, so a dominance query is just a comparison of two intervals.
+class DominatorTree(object):
+    def __init__(self, starts, targets, roots):
+        n = len(starts) - 1
+        self.root = n
+
+        succ = [targets[starts[v]:starts[v+1]] for v in range(n)] + [list(roots)]
+
+        # Postorder of the nodes reachable from the virtual root
+        order = []
+        visited = array('b', [0]) * (n+1)
+        visited[n] = 1
+        stack = [(n, iter(succ[n]))]
+        while stack:
+            v, it = stack[-1]
+            for w in it:
+                if not visited[w]:
+                    visited[w] = 1
+                    stack.append((w, iter(succ[w])))
+                    break
+            else:
+                stack.pop()
+                order.append(v)
+
+        po_num = array('i', [-1]) * (n+1)
+        for i, v in enumerate(order):
+            po_num[v] = i
+
+        preds = [[] for i in range(n+1)]
+        for v in order:
+            for w in succ[v]:
+                preds[w].append(v)
+
+        idom = array('i', [-1]) * (n+1)
+        idom[n] = n
+
+        def intersect(a, b):
+            while a != b:
+                while po_num[a] < po_num[b]:
+                    a = idom[a]
+                while po_num[b] < po_num[a]:
+                    b = idom[b]
+            return a
+
+        rpo = order[::-1][1:]
+        changed = True
+        while changed:
+            changed = False
+            for v in rpo:
+                new_idom = -1
+                for p in preds[v]:
+                    if idom[p] != -1:
+                        if new_idom == -1:
+                            new_idom = p
+                        else:
+                            new_idom = intersect(p, new_idom)
+                if idom[v] != new_idom:
+                    idom[v] = new_idom
+                    changed = True
+
+        self.idoms = idom
+
+        # Number the tree, so that a dominates b if b's number falls
+        # between a's number and the last number in a's subtree
+        children = [[] for i in range(n+1)]
+        for v in rpo:
+            children[idom[v]].append(v)
+
+        self.pre = array('i', [-1]) * (n+1)
+        self.last = array('i', [-1]) * (n+1)
+        count = 0
+        self.pre[n] = count
+        stack = [(n, iter(children[n]))]
+        while stack:
+            v, it = stack[-1]
+            for w in it:
+                count += 1
+                self.pre[w] = count
+                stack.append((w, iter(children[w])))
+                break
+            else:
+                stack.pop()
+                self.last[v] = count
+
+    # Immediate dominator of node v, or None if it is only dominated by the
+    # virtual root or is unreachable
+    def idom(self, v):
+        d = self.idoms[v]
+        if d == -1 or d == self.root:
+            return None
+        return d
+
+    def reachable(self, v):
+        return self.pre[v] != -1
+
+    def dominates(self, a, b):
+        if self.pre[a] == -1 or self.pre[b] == -1:
+            return False
+        return self.pre[a] <= self.pre[b] <= self.last[a]
@@ -0,0 +1,148 @@
+from array import array
+import collections
+import tripcount
+
+# Static estimates of how often each block of a CFG runs per call of the
+# function, following Wu and Larus, "Static Branch Frequency and Program
+# Profile Analysis", 1994.
+#
+# Each branch is given a probability from the loop structure: a branch which
+# leaves a loop is taken with a probability of one over the loop's trip
+# count, shared between the exits of the loop, so that each loop runs about
+# that many times. The trip count is the estimate unless tripcount can work
+# it out. Other branches are equally likely. The block frequencies then
+# follow from the probabilities, by propagating through each loop from the
+# innermost out.
+
+# Count the conditional branches which leave each loop
+def loopExits(c):
+    g = c.graph()
+    c.findLoops()
+
+    exits = collections.defaultdict(int)
+    for i, bb in enumerate(g.blocks):
+        if g.outDegree(i) < 2:
+            continue
+        for j in g.successors(i):
+            for h in leftLoops(c, bb, g.blocks[j]):
+                exits[h] += 1
+    return exits
+
+# The headers of the loops which an edge from bb to dest leaves, innermost
+# first
+def leftLoops(c, bb, dest):
+    return [h for h in bb.loop_nest if h in c.header_loops and dest not in c.header_loops[h].members]
+
+# Probability of each edge, in the same order as the CSR successor array of
+# the CFG's block graph
+def branchProbabilities(c, estimate):
+    g = c.graph()
+    exits = loopExits(c)
+    trips = tripcount.tripCounts(c)
+
+    prob = array('d', [0.0]) * len(g.succ)
+    for i, bb in enumerate(g.blocks):
+        start, end = g.succ_start[i], g.succ_start[i+1]
+        if end - start == 1:
+            prob[start] = 1.0
+            continue
+
+        leaving = []
+        for k in range(start, end):
+            left = leftLoops(c, bb, g.blocks[g.succ[k]])
+            if left:
+                exit_prob = 1.0 / max(trips.get(left[0], estimate), 1)
+                leaving.append((k, exit_prob / exits[left[0]]))
+
+        # Stay in the loop unless every edge leaves it
+        if leaving and len(leaving) < end - start:
+            taken = 0.0
+            for k, p in leaving:
+                prob[k] = p
+                taken += p
+            staying = [k for k in range(start, end) if prob[k] == 0.0]
+            for k in staying:
+                prob[k] = (1.0 - taken) / len(staying)
+        else:
+            for k in range(start, end):
+                prob[k] = 1.0 / (end - start)
+    return prob
+
+# Frequency of each block relative to one call of the function, in the order
+# of c.basicblocks
+def blockFrequencies(c, estimate):
+    g = c.graph()
+    c.findLoops()
+    prob = branchProbabilities(c, estimate)
+
+    # An edge to the header of a loop containing the source closes the loop
+    back = array('b', [0]) * len(g.succ)
+    for i, bb in enumerate(g.blocks):
+        for k in range(g.succ_start[i], g.succ_start[i+1]):
+            loop = c.header_loops.get(g.blocks[g.succ[k]])
+            if loop is not None and bb in loop.members:
+                back[k] = 1
+
+    freq = array('d', [0.0]) * len(g)
+
+    # Chance of coming back round each loop. A loop with no way out is taken
+    # to run estimate times
+    no_exit = 1.0 - 1.0 / max(estimate, 1)
+    cyclic = {}
+
+    for loop in sorted(c.loops, key=lambda l: -l.depth):
+        h = g.id(loop.header)
+        region = set(g.id(bb) for bb in loop.members)
+        returning = propagate(g, prob, back, [h], region, cyclic, freq)
+        if returning > 1.0 - 1e-9:
+            returning = no_exit
+        cyclic[h] = returning
+
+    heads = [g.id(bb) for bb in c.entryBlocks()]
+    propagate(g, prob, back, heads, set(range(len(g))), cyclic, freq)
+
+    return list(freq)
+
+# Work out the frequencies of the blocks in region relative to the heads,
+# visiting them in topological order of the forward edges. Inner loops have
+# already been solved, so their headers are scaled up by the number of
+# times round the loop. Returns the probability of coming back to the heads.
+# The header of the loop being solved isn't in cyclic yet, so is left as 1
+def propagate(g, prob, back, heads, region, cyclic, freq):
+    order = []
+    visited = set(heads)
+    for s in heads:
+        stack = [(s, iter(range(g.succ_start[s], g.succ_start[s+1])))]
+        while stack:
+            v, it = stack[-1]
+            for k in it:
+                w = g.succ[k]
+                if not back[k] and w in region and w not in visited:
+                    visited.add(w)
+                    stack.append((w, iter(range(g.succ_start[w], g.succ_start[w+1]))))
+                    break
+            else:
+                stack.pop()
+                order.append(v)
+    order.reverse()
+
+    inflow = collections.defaultdict(float)
+    for s in heads:
+        inflow[s] = 1.0
+
+    returning = 0.0
+    for v in order:
+        f = inflow[v]
+        if v in cyclic:
+            f /= 1.0 - cyclic[v]
+        freq[v] = f
+
+        for k in range(g.succ_start[v], g.succ_start[v+1]):
+            w = g.succ[k]
+            if back[k]:
+                if w in heads:
+                    returning += f * prob[k]
+            elif w in region:
+                inflow[w] += f * prob[k]
+
+    return returning
@@ -9,8 +9,13 @@ param icost_cyc{bb in BBs}, integer; # Cost in cycles of instrumenting a block
 param icost_cyc_ram{bb in BBs}, integer; # Cost in cycles for a block to be in RAM
 param force_ram{bb in BBs}, integer;
 param force_flash{bb in BBs}, integer;
-param iterations{bb in BBs}, integer;
-param successors{bb in BBs, bb2 in BBs}, binary;
+param iterations{bb in BBs} >= 0;
+
+# The edges of the CFGs, from a block to each of its successors, and the
+# number of blocks which jump to each block
+set EDGES within BBs cross BBs;
+param npreds{bb in BBs}, integer, >= 0;
+
 param E_flash;
 param E_ram;
 param spare_ram;
@@ -19,10 +24,6 @@ param max_cycle_factor;
 var BBs_in_ram{BBs} >=0 binary;
 
 var is_bb_instrumented{BBs} >=0 binary;
-var succ_in_ram{bb in BBs, bb2 in BBs}  binary;
-var succ_not_in_ram{bb in BBs, bb2 in BBs}  binary;
-var max_inst{bb in BBs, bb2 in BBs}  binary;
-var max_inst2{bb in BBs, bb2 in BBs}  binary;
 
 var BBs_in_ram_instrumented{BBs} >=0 binary;
 var BBs_not_in_ram_instrumented{BBs} >=0 binary;
@@ -47,39 +48,29 @@ subject to instrument_cost_cons1{bb in BBs}:
 subject to instrument_cost_cons2{bb in BBs}:
     BBs_not_in_ram_instrumented[bb] >=  (1 - BBs_in_ram[bb]) + is_bb_instrumented[bb] - 1;
 
-# the block is instrumented if it is in RAM, and its successors is not
-subject to instrument_cons1{bb in BBs, bb2 in BBs}:
-    is_bb_instrumented[bb] >= max_inst[bb,bb2];
-
-subject to instrument_cons1c{bb in BBs, bb2 in BBs}:
-    max_inst[bb,bb2] >= BBs_in_ram[bb] + succ_not_in_ram[bb,bb2] - 1;
+# The constraints on instrumentation are only over the edges, so the model
+# grows with the number of edges rather than the square of the number of
+# blocks
 
+# the block is instrumented if it is in RAM, and its successors is not
+subject to instrument_cons1{(bb, bb2) in EDGES}:
+    is_bb_instrumented[bb] >= BBs_in_ram[bb] - BBs_in_ram[bb2];
 
 # the block is instrumented if it is not in RAM, and its successors is
-subject to instrument_cons2{bb in BBs, bb2 in BBs}:
-    is_bb_instrumented[bb] >= max_inst2[bb,bb2];
-
-subject to instrument_cons2a{bb in BBs, bb2 in BBs}:
-    max_inst2[bb,bb2] >= (1 - BBs_in_ram[bb]) + succ_in_ram[bb,bb2] - 1;
+subject to instrument_cons2{(bb, bb2) in EDGES}:
+    is_bb_instrumented[bb] >= BBs_in_ram[bb2] - BBs_in_ram[bb];
 
 
-# This constraint checks whether any block jumps to bb (by summing the column of successors)
+# This constraint checks whether any block jumps to bb (by counting its predecessors)
 # If there is not, and we are in RAM, then we need to instrument this block too, because
 # it may be possible that we end up executing from this block, without being in RAM.
 # E.g. an untranslated function call.
 subject to instrument_cons3{bb in BBs}:
-    is_bb_instrumented[bb] >= BBs_in_ram[bb] * (1 - sum{bb2 in BBs}(successors[bb2,bb]));
+    is_bb_instrumented[bb] >= BBs_in_ram[bb] * (1 - npreds[bb]);
 
 # For now, we make sure that if nothing jumps to the bb, it cant be in ram
 subject to no_starts{bb in BBs}:
-    BBs_in_ram[bb] <= sum{bb2 in BBs}(successors[bb2,bb]);
-
-# Create variables for successors in ram and not in ram
-subject to instrument_cons5a{bb in BBs, bb2 in BBs}:
-    succ_in_ram[bb,bb2] = (successors[bb,bb2] * BBs_in_ram[bb2]);
-
-subject to instrument_cons5b{bb in BBs, bb2 in BBs}:
-    succ_not_in_ram[bb,bb2] = (successors[bb,bb2] * (1-BBs_in_ram[bb2]));
+    BBs_in_ram[bb] <= npreds[bb];
 
 
 # This constraint makes sure we can fit into the RAM allocation given
@@ -127,35 +118,6 @@ printf: "# Final RAM size: %.0f\n", sum{bb in BBs}(BBs_in_ram[bb] * usize[bb] +
 printf: "# name, size, ram, instrumented\n";
 printf{bb in BBs}: "%s, %.0f, %.0f, %.0f\n", bb, usize[bb] + icost_ram[bb]*is_bb_instrumented[bb], BBs_in_ram[bb],is_bb_instrumented[bb];
 
-# printf: "\nsucc_in_ram\n";
-# for {bb in BBs}
-# {
-#     printf{bb2 in BBs}: "%d ", succ_in_ram[bb,bb2];
-#     printf: "\n";
-# }
-
-# printf: "\nsucc_not_in_ram\n";
-# for {bb in BBs}
-# {
-#     printf{bb2 in BBs}: "%d ", succ_not_in_ram[bb,bb2];
-#     printf: "\n";
-# }
-
-# printf: "\nmax_inst\n";
-# for {bb in BBs}
-# {
-#     printf{bb2 in BBs}: "%d ", max_inst[bb,bb2];
-#     printf: "\n";
-# }
-
-
-# printf: "\nmax_inst2\n";
-# for {bb in BBs}
-# {
-#     printf{bb2 in BBs}: "%d ", max_inst2[bb,bb2];
-#     printf: "\n";
-# }
-
 data;
 
 set BBs := bb1 bb2 bb3 bb4 bb5;
@@ -209,17 +171,16 @@ param force_flash :=
     bb4 0
     bb5 0;
 
-# Sucessors is
-# [row, col]
-# row is from, col is to, i.e. col is a successor of row
-
-param successors : bb1 bb2 bb3 bb4 bb5:=
-    bb1   0  1  0  0  0
-    bb2   0  0  1  0  0
-    bb3   0  0  0  1  0
-    bb4   0  0  0  0  1
-    bb5   0  0  0  0  0
-    ;
+# Each edge is (from, to), i.e. to is a successor of from
+
+set EDGES := (bb1, bb2) (bb2, bb3) (bb3, bb4) (bb4, bb5);
+
+param npreds :=
+    bb1 0
+    bb2 1
+    bb3 1
+    bb4 1
+    bb5 1;
 
 param E_flash := 200;
 param E_ram := 150;
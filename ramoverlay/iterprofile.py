@@ -0,0 +1,105 @@
+"""Convert iteration profiles between the text and binary formats.
+
+Usage:
+    iterprofile.py [--text] INPUT OUTPUT
+    iterprofile.py -h
+
+Options:
+    -h --help           Show this message
+    --text              Write the profile as text, rather than binary
+
+The text format has one "filename.s:linenumber hits" entry per line, as
+written by sim.py (filename.s_linenumber is also accepted). The input format
+is detected from the file.
+"""
+
+from docopt import docopt
+
+import struct
+
+# The binary format is the magic string, a table of file names, each as a
+# 16 bit length followed by the name, then a fixed size record per entry of
+# the file's index in the table, the line number and the hit count
+magic = "RAMITER1"
+record = struct.Struct("<HIQ")
+
+def isBinary(fname):
+    f = open(fname, "rb")
+    start = f.read(len(magic))
+    f.close()
+    return start == magic
+
+# Yield a (file, line, hits) tuple for each entry in a text or binary
+# profile
+def readProfile(fname):
+    if isBinary(fname):
+        return readBinary(fname)
+    return readText(fname)
+
+def readText(fname):
+    for line in open(fname):
+        parts = line.split()
+        if not parts:
+            continue
+
+        if ':' not in parts[0]:
+            delim = "_"
+        else:
+            delim = ":"
+
+        f_iter, f_line = parts[0].rsplit(delim, 1)
+        yield f_iter, int(f_line), int(parts[1])
+
+def readBinary(fname):
+    f = open(fname, "rb")
+    f.read(len(magic))
+
+    n_files, = struct.unpack("<I", f.read(4))
+    files = []
+    for i in range(n_files):
+        length, = struct.unpack("<H", f.read(2))
+        files.append(f.read(length))
+
+    # Read many records at a time
+    chunk = record.size * 4096
+    while True:
+        data = f.read(chunk)
+        if not data:
+            break
+        if len(data) % record.size:
+            raise RuntimeError("Truncated iteration profile: " + fname)
+        for offset in range(0, len(data), record.size):
+            index, line, hits = record.unpack_from(data, offset)
+            yield files[index], line, hits
+    f.close()
+
+def writeText(fname, entries):
+    f = open(fname, "w")
+    for f_iter, line, hits in entries:
+        f.write("{}:{} {}\n".format(f_iter, line, hits))
+    f.close()
+
+def writeBinary(fname, entries):
+    entries = list(entries)
+
+    files = sorted(set(e[0] for e in entries))
+    index = {name: i for i, name in enumerate(files)}
+
+    f = open(fname, "wb")
+    f.write(magic)
+    f.write(struct.pack("<I", len(files)))
+    for name in files:
+        f.write(struct.pack("<H", len(name)))
+        f.write(name)
+    for f_iter, line, hits in entries:
+        f.write(record.pack(index[f_iter], line, hits))
+    f.close()
+
+if __name__=="__main__":
+    arguments = docopt(__doc__)
+
+    entries = readProfile(arguments['INPUT'])
+    if arguments['--text']:
+        writeText(arguments['OUTPUT'], entries)
+    else:
+        writeBinary(arguments['OUTPUT'], entries)
@@ -0,0 +1,864 @@
+import pexpect
+import heapq
+import os
+
+# The placement problem: choose the basic blocks to put in RAM, so that the
+# energy is minimised, without going over the spare RAM or slowing the
+# program down by more than max_cycle_factor. A block is instrumented if it
+# jumps between RAM and flash, and that costs cycles and, in RAM, space.
+#
+# The problem is built from the feature arrays of a BlockGraph, and can be
+# solved in process, or by writing it out for glpsol with ilp.mod.
+
+# The name of a block in the ILP data and the solver output
+def blockName(bb):
+    insn0 = bb.instructions[0]
+    if insn0.label is False:
+        return "{}_{}".format(insn0.file, insn0.lineno)
+    return "{}_{}".format(insn0.file, insn0.label)
+
+# Cost in bytes of instrumenting a block
+def icostRAM(bb):
+    # Count number of calls in bb
+    calls = sum(bb.countCalls().values())
+
+    if bb.getTailInsn().operator in ["cbz", "cbnz"]:
+        icost = 8
+    elif not bb.getTailInsn().isBranch():
+        icost = 6 # Fallthrough
+    elif bb.getTailInsn().isUnconditional():
+        icost = 2 # Unconditional branch
+    else:
+        icost = 6 # Conditional
+
+    return icost + calls*2
+
+# Cost in cycles of instrumenting a block
+def icostCycles(bb):
+    # Count number of calls in bb
+    calls = sum(bb.countCalls().values())
+
+    if bb.getTailInsn().operator in ["cbz", "cbnz"]:
+        icost = 8 - 3
+    elif not bb.getTailInsn().isBranch():
+        icost = 4 # Fallthrough
+    elif bb.getTailInsn().isUnconditional():
+        icost = 4 - 3 # Unconditional branch
+    else:
+        icost = 7 - 3 # Conditional
+
+    return icost + calls*2
+
+# Cost in cycles for a block to be in RAM
+def icostCyclesRAM(bb):
+    icost = 0
+
+    for insn in bb.instructions:
+        if insn.isLoad() or insn.isStore():
+            icost += 2
+
+    return icost
+
+class PlacementProblem(object):
+    def __init__(self, g, force_bbs=[], specified_only=False, E_flash=100, E_ram=66, spare_ram=2000, max_cycle_factor=2):
+        if g.size is None:
+            g.loadFeatures()
+
+        self.blocks = g.blocks
+        self.names = [blockName(bb) for bb in g.blocks]
+        n = len(self.blocks)
+
+        self.size = list(g.size)
+        self.cycles = list(g.cycles)
+        self.iterations = list(g.iterations)
+
+        self.icost_ram = [icostRAM(bb) for bb in g.blocks]
+        self.icost_cyc = [icostCycles(bb) for bb in g.blocks]
+        self.icost_cyc_ram = [icostCyclesRAM(bb) for bb in g.blocks]
+
+        forced = set(g.id(bb) for bb in force_bbs)
+        self.force_ram = [i in forced for i in range(n)]
+        self.force_flash = [specified_only and i not in forced for i in range(n)]
+
+        # A block may jump to the same successor more than once
+        self.edges = []
+        self.succs = [[] for i in range(n)]
+        self.preds = [[] for i in range(n)]
+        for i in range(n):
+            for j in sorted(set(g.successors(i))):
+                self.edges.append((i, j))
+                self.succs[i].append(j)
+                self.preds[j].append(i)
+        self.npreds = [len(p) for p in self.preds]
+
+        self.E_flash = E_flash
+        self.E_ram = E_ram
+        self.spare_ram = int(spare_ram)
+        self.max_cycle_factor = max_cycle_factor
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def baseCost(self):
+        return sum(c * self.E_flash * it for c, it in zip(self.cycles, self.iterations))
+
+    def baseCycles(self):
+        return sum(c * it for c, it in zip(self.cycles, self.iterations))
+
+    def maxCycles(self):
+        return self.baseCycles() * self.max_cycle_factor
+
+    # The blocks of each loop in the CFGs the blocks come from, as lists of
+    # block indices. A loop includes the blocks of its inner loops
+    def loopGroups(self):
+        index = {id(bb): i for i, bb in enumerate(self.blocks)}
+        seen = set()
+        groups = []
+        for bb in self.blocks:
+            c = bb.cfg
+            if c is None or c.loops is None or id(c) in seen:
+                continue
+            seen.add(id(c))
+            for loop in c.loops:
+                members = sorted(index[id(m)] for m in loop.members if id(m) in index)
+                if len(members) > 1:
+                    groups.append(members)
+        return groups
+
+    # Whether block k has to be instrumented, if the blocks marked in in_ram
+    # are placed in RAM
+    def isInstrumented(self, k, in_ram):
+        if in_ram[k] and self.npreds[k] == 0:
+            return True
+        return any(in_ram[j] != in_ram[k] for j in self.succs[k])
+
+    # The cost, cycles and RAM of block k, as the model in ilp.mod works
+    # them out
+    def blockCost(self, k, in_ram, inst):
+        it = self.iterations[k]
+        cycles = self.cycles[k] * it
+        if inst:
+            cycles += self.icost_cyc[k] * it
+
+        if in_ram[k]:
+            cost = (self.cycles[k] + self.icost_cyc_ram[k]) * self.E_ram * it
+            cycles += self.icost_cyc_ram[k] * it
+            ram = self.size[k]
+            if inst:
+                cost += self.icost_cyc[k] * self.E_ram * it
+                ram += self.icost_ram[k]
+        else:
+            cost = self.cycles[k] * self.E_flash * it
+            ram = 0
+            if inst:
+                cost += self.icost_cyc[k] * self.E_flash * it
+        return cost, cycles, ram
+
+    # Work out the cost, cycles and RAM of placing the blocks marked in
+    # in_ram in RAM
+    def evaluate(self, in_ram, **kwargs):
+        in_ram = [bool(r) for r in in_ram]
+        inst = [self.isInstrumented(k, in_ram) for k in range(len(self))]
+
+        cost = cycles = ram = 0
+        for k in range(len(self)):
+            c, cyc, r = self.blockCost(k, in_ram, inst[k])
+            cost += c
+            cycles += cyc
+            ram += r
+
+        return PlacementResult(self, in_ram, inst, cost, cycles, ram, **kwargs)
+
+    # Whether a placement keeps to the RAM, cycle and forced placement
+    # constraints
+    def feasible(self, result):
+        if result.ram > self.spare_ram:
+            return False
+        if result.cycles > self.maxCycles():
+            return False
+        for i in range(len(self)):
+            if result.in_ram[i] and self.npreds[i] == 0:
+                return False
+            if self.force_ram[i] and not result.in_ram[i]:
+                return False
+            if self.force_flash[i] and result.in_ram[i]:
+                return False
+        return True
+
+class PlacementResult(object):
+    def __init__(self, problem, in_ram, instrumented, cost, cycles, ram, optimal=True, bound=None, nodes=0, node_limit=None):
+        self.problem = problem
+        self.in_ram = in_ram
+        self.instrumented = instrumented
+        self.cost = cost
+        self.cycles = cycles
+        self.ram = ram
+        self.optimal = optimal
+        # A lower bound on the optimal cost, if one is known
+        if optimal and bound is None:
+            bound = cost
+        self.bound = bound
+        self.nodes = nodes
+        # The node limit the search stopped at, if it did
+        self.node_limit = node_limit
+
+    def ramBlocks(self):
+        return [i for i, r in enumerate(self.in_ram) if r]
+
+    # How far the cost may be above the optimum, as a fraction of the cost
+    def gap(self):
+        if self.bound is None:
+            return None
+        if self.cost == 0:
+            return 0.0
+        return max(self.cost - self.bound, 0) / float(self.cost)
+
+# A smaller problem with the same optimum as the problem it is made from:
+#
+# - Blocks too big for the RAM, and blocks which never run and are only
+#   jumped to from blocks in flash, are fixed in flash. Moving such a block
+#   to flash can't cost anything, so this doesn't lose any solutions.
+# - If contract is set, chains of free blocks, where each jumps only to the
+#   next and is only jumped to from the one before, with the same
+#   iterations, become one block, with the sizes and cycles added up. Only
+#   the last block of a chain can need instrumenting. The chain then has to
+#   be placed as a whole, which can lose the optimum (e.g. when only part of
+#   it fits), so the result is no longer known to be optimal.
+# - Edges which can't change the instrumentation cost are dropped: those
+#   inside a chain, between two blocks fixed in the same place, and from
+#   blocks in flash which never run. The fixed blocks which are left without
+#   edges are taken out, and their cost, cycles and RAM added on as
+#   constants.
+#
+# The solution to this problem is mapped back with expand.
+class ReducedProblem(PlacementProblem):
+    def __init__(self, problem, contract=False):
+        p = problem
+        n = len(p)
+        self.original = p
+
+        # Fix the blocks, following the blocks which never run from the
+        # blocks in flash which jump to them
+        fixed = [None] * n
+        work = []
+        for i in range(n):
+            if p.force_ram[i]:
+                fixed[i] = 1
+            elif p.force_flash[i] or p.npreds[i] == 0 or p.size[i] > p.spare_ram:
+                fixed[i] = 0
+                work.append(i)
+        while work:
+            i = work.pop()
+            for j in p.succs[i]:
+                if fixed[j] is None and p.iterations[j] == 0 and \
+                   all(fixed[k] == 0 or k == j for k in p.preds[j]):
+                    fixed[j] = 0
+                    work.append(j)
+        self.fixed = fixed
+
+        # Link each free block to the next block of its chain
+        link = [None] * n
+        linked = [False] * n
+        for i in range(n):
+            if not contract or fixed[i] is not None or len(p.succs[i]) != 1:
+                continue
+            j = p.succs[i][0]
+            if j != i and fixed[j] is None and p.preds[j] == [i] and p.iterations[j] == p.iterations[i]:
+                link[i] = j
+                linked[j] = True
+
+        # Group the blocks, starting each chain from its first block. A loop
+        # made only of chain links has no first block, so its blocks are
+        # left on their own
+        group = [None] * n
+        self.members = []
+        for i in range(n):
+            if fixed[i] is None and not linked[i]:
+                chain = [i]
+                while link[chain[-1]] is not None:
+                    chain.append(link[chain[-1]])
+                for k in chain:
+                    group[k] = len(self.members)
+                self.members.append(chain)
+        for i in range(n):
+            if group[i] is None and fixed[i] is None:
+                group[i] = len(self.members)
+                self.members.append([i])
+        self.free = len(self.members)
+
+        # The edges which can change the instrumentation cost, and the fixed
+        # blocks which are needed for them
+        kept = set()
+        for i, j in p.edges:
+            if fixed[i] is not None and fixed[j] is not None and fixed[i] == fixed[j]:
+                continue
+            if fixed[i] == 0 and p.iterations[i] == 0:
+                continue
+            for k in [i, j]:
+                if group[k] is None:
+                    group[k] = len(self.members)
+                    self.members.append([k])
+            if group[i] != group[j]:
+                kept.add((group[i], group[j]))
+        self.group = group
+
+        # Everything else is constant
+        placed = [fixed[i] == 1 for i in range(n)]
+        self.cost = self.cycles_offset = self.ram_offset = 0
+        for i in range(n):
+            if group[i] is None:
+                c, cyc, r = p.blockCost(i, placed, False)
+                self.cost += c
+                self.cycles_offset += cyc
+                self.ram_offset += r
+
+        self.blocks = [p.blocks[m[0]] for m in self.members]
+        self.names = [p.names[m[0]] for m in self.members]
+        self.size = [sum(p.size[k] for k in m) for m in self.members]
+        self.cycles = [sum(p.cycles[k] for k in m) for m in self.members]
+        self.iterations = [p.iterations[m[0]] for m in self.members]
+        self.icost_ram = [p.icost_ram[m[-1]] for m in self.members]
+        self.icost_cyc = [p.icost_cyc[m[-1]] for m in self.members]
+        self.icost_cyc_ram = [sum(p.icost_cyc_ram[k] for k in m) for m in self.members]
+        self.force_ram = [fixed[m[0]] == 1 for m in self.members]
+        self.force_flash = [fixed[m[0]] == 0 for m in self.members]
+
+        # A block which is jumped to needs the count of all of its
+        # predecessors, not just those which are left
+        self.npreds = [p.npreds[m[0]] for m in self.members]
+        self.edges = sorted(kept)
+        self.succs = [[] for m in self.members]
+        self.preds = [[] for m in self.members]
+        for i, j in self.edges:
+            self.succs[i].append(j)
+            self.preds[j].append(i)
+
+        self.E_flash = p.E_flash
+        self.E_ram = p.E_ram
+        self.spare_ram = p.spare_ram - self.ram_offset
+
+        # The cycles which are left for the blocks which are kept, as a
+        # factor of their own cycles
+        base = self.baseCycles()
+        self.max_cycles = p.maxCycles() - self.cycles_offset
+        self.max_cycle_factor = self.max_cycles / float(base) if base else 1
+
+    def maxCycles(self):
+        return self.max_cycles
+
+    # The share of the blocks which are left to be placed, and of the edges
+    def ratio(self):
+        blocks = self.free / float(len(self.original)) if len(self.original) else 0.0
+        edges = len(self.edges) / float(len(self.original.edges)) if self.original.edges else 0.0
+        return blocks, edges
+
+    # A placement of the original blocks, as one of the reduced blocks. The
+    # first block of each chain decides where the chain goes
+    def reduce(self, in_ram):
+        return [bool(in_ram[m[0]]) for m in self.members]
+
+    # Whether the optimum of this problem is the optimum of the original
+    def exact(self):
+        return all(len(m) == 1 for m in self.members)
+
+    # The result for the original problem, from a result for this one. Once
+    # chains have been joined, the result is only the best placement which
+    # keeps them together, and its bound isn't a bound for the original
+    def expand(self, result):
+        p = self.original
+        in_ram = [self.fixed[i] == 1 for i in range(len(p))]
+        for k, m in enumerate(self.members):
+            for i in m:
+                in_ram[i] = result.in_ram[k]
+
+        if not self.exact():
+            return p.evaluate(in_ram, optimal=False, bound=None, nodes=result.nodes, node_limit=result.node_limit)
+        bound = None if result.bound is None else result.bound + self.cost
+        return p.evaluate(in_ram, optimal=result.optimal, bound=bound, nodes=result.nodes, node_limit=result.node_limit)
+
+# Write the problem out as data for ilp.mod
+def writeData(problem, fname):
+    f = open(fname, "w")
+    names = problem.names
+
+    f.write("set BBs := {};\n\n".format(" ".join(names)))
+
+    maxname = max([0] + map(len, names))
+
+    def param(name, values, fmt="{}"):
+        f.write("param {} :=\n".format(name))
+        for bb_name, v in zip(names, values):
+            f.write("\t{1: <{0}} ".format(maxname, bb_name) + fmt.format(v) + "\n")
+        f.write(";\n\n")
+
+    param("usize", problem.size)
+    param("cyc_cost", problem.cycles)
+    param("iterations", problem.iterations, "{:.15g}")
+    param("force_ram", [1 if r else 0 for r in problem.force_ram])
+    param("force_flash", [1 if r else 0 for r in problem.force_flash])
+    param("icost_ram", problem.icost_ram)
+    param("icost_cyc", problem.icost_cyc)
+    param("icost_cyc_ram", problem.icost_cyc_ram)
+
+    # Only the edges which exist are written
+    f.write("set EDGES :=\n")
+    for i, j in problem.edges:
+        f.write("\t({}, {})\n".format(names[i], names[j]))
+    f.write(";\n\n")
+
+    param("npreds", problem.npreds)
+
+    f.write("param E_flash := {};\n".format(problem.E_flash))
+    f.write("param E_ram := {};\n".format(problem.E_ram))
+    f.write("param spare_ram := {};\n".format(problem.spare_ram))
+    f.write("param max_cycle_factor := {};\n".format(problem.max_cycle_factor))
+
+    f.write("end;\n")
+    f.close()
+
+# Solve with glpsol and the MathProg model
+class GlpsolSolver(object):
+    def __init__(self, model, data="ilp.data"):
+        self.model = model
+        self.data = data
+
+    # glpsol always starts from scratch
+    def solve(self, problem, start=None):
+        writeData(problem, self.data)
+
+        # TODO proper temp file
+        out = "/tmp/glp.{}".format(os.getpid())
+        glpsol = pexpect.spawn("glpsol -d {} -m {} -y {}".format(self.data, self.model, out), timeout=3600)
+        glpsol.expect(".*INTEGER OPTIMAL SOLUTION FOUND.*")
+        glpsol.expect(pexpect.EOF)
+
+        index = {name: i for i, name in enumerate(problem.names)}
+        in_ram = [False] * len(problem)
+
+        for l in open(out):
+            if l[0] == '#':
+                print l.strip()
+                continue
+
+            parts = l.split(',')
+            if parts[0] not in index:
+                print "ERROR", parts[0]
+            elif parts[2].strip() == "1":
+                in_ram[index[parts[0]]] = True
+
+        return problem.evaluate(in_ram)
+
+# Sums over the blocks which save energy in RAM, in order of the saving per
+# byte, which blocks can be taken out of and put back into as they are
+# decided. Used for the fractional knapsack bound of the undecided blocks.
+class KnapsackTree(object):
+    def __init__(self, sizes, savings):
+        self.n = len(sizes)
+        self.sizes = [0] + list(sizes)
+        self.savings = [0] + list(savings)
+        self.tree_size = [0] * (self.n + 1)
+        self.tree_saving = [0] * (self.n + 1)
+        for k in range(1, self.n + 1):
+            self.update(k, 1)
+        self.top = 1
+        while self.top * 2 <= self.n:
+            self.top *= 2
+
+    def update(self, k, sign):
+        size = self.sizes[k] * sign
+        saving = self.savings[k] * sign
+        while k <= self.n:
+            self.tree_size[k] += size
+            self.tree_saving[k] += saving
+            k += k & -k
+
+    # Position k in the order, starting from 0
+    def remove(self, k):
+        self.update(k + 1, -1)
+
+    def add(self, k):
+        self.update(k + 1, 1)
+
+    # The most that can be saved by the blocks which are left, if they can
+    # be split, in the given bytes
+    def bound(self, space):
+        k = 0
+        size = saving = 0
+        step = self.top
+        while step:
+            if k + step <= self.n and size + self.tree_size[k + step] <= space:
+                k += step
+                size += self.tree_size[k]
+                saving += self.tree_saving[k]
+            step //= 2
+
+        # The block after the last which fits has to be left, and only fits
+        # in part
+        if k < self.n:
+            saving += self.savings[k + 1] * (space - size) / float(self.sizes[k + 1])
+        return saving
+
+# An exact branch and bound over the blocks, in process. The bound for the
+# undecided blocks is the fractional knapsack of their savings into the RAM
+# which is left, ignoring instrumentation, which is only counted once both
+# ends of an edge are decided. So that this is seen early on, the blocks are
+# decided a neighbourhood at a time, starting from the blocks which save the
+# most per byte, and each block first tries whichever of RAM and flash costs
+# less given its decided neighbours. If the node limit is hit, the best
+# placement found so far is returned, with the root bound.
+class BranchAndBound(object):
+    def __init__(self, node_limit=1000000):
+        self.node_limit = node_limit
+
+    # The search starts from the heuristic's placement, built on start if
+    # that is given, so that stopping at the node limit is never worse than
+    # the heuristic
+    def solve(self, problem, start=None):
+        p = problem
+        n = len(p)
+
+        saving = [it * (c * p.E_flash - (c + cr) * p.E_ram)
+                  for c, cr, it in zip(p.cycles, p.icost_cyc_ram, p.iterations)]
+        inst_cost = [(it * ic * p.E_flash, it * ic * p.E_ram) for ic, it in zip(p.icost_cyc, p.iterations)]
+        inst_cycles = [it * ic for ic, it in zip(p.icost_cyc, p.iterations)]
+        ram_cycles = [it * ic for ic, it in zip(p.icost_cyc_ram, p.iterations)]
+
+        max_cycles = p.maxCycles()
+        base_cycles = p.baseCycles()
+
+        # Blocks with nothing jumping to them, or too big for the RAM, stay
+        # in flash
+        fixed = []
+        free = []
+        for i in range(n):
+            if p.force_ram[i]:
+                if p.npreds[i] == 0 or p.force_flash[i]:
+                    raise RuntimeError("Block {} can't be forced into RAM".format(p.names[i]))
+                fixed.append((i, 1))
+            elif p.force_flash[i] or p.npreds[i] == 0 or p.size[i] > p.spare_ram:
+                fixed.append((i, 0))
+            else:
+                free.append(i)
+
+        def density(i):
+            if p.size[i] == 0:
+                return float("inf")
+            return saving[i] / float(p.size[i])
+        positive = sorted([i for i in free if saving[i] > 0], key=density, reverse=True)
+        rank = {i: k for k, i in enumerate(positive)}
+        knapsack = KnapsackTree([p.size[i] for i in positive], [saving[i] for i in positive])
+
+        # Breadth first from each block in turn, in order of density
+        is_free = [False] * n
+        for i in free:
+            is_free[i] = True
+        order = []
+        queued = [False] * n
+        for s in positive + [i for i in free if saving[i] <= 0]:
+            if queued[s]:
+                continue
+            queued[s] = True
+            order.append(s)
+            k = len(order) - 1
+            while k < len(order):
+                v = order[k]
+                k += 1
+                for w in p.succs[v] + p.preds[v]:
+                    if is_free[w] and not queued[w]:
+                        queued[w] = True
+                        order.append(w)
+
+        x = [-1] * n
+        inst = [False] * n
+        state = {"cost": p.baseCost(), "ram": 0, "cycles": 0}
+
+        def instrument(k, changed):
+            if not inst[k]:
+                inst[k] = True
+                state["cost"] += inst_cost[k][x[k]]
+                state["cycles"] += inst_cycles[k]
+                state["ram"] += p.icost_ram[k] * x[k]
+                changed.append(k)
+
+        def assign(i, v):
+            x[i] = v
+            state["cost"] -= saving[i] * v
+            state["ram"] += p.size[i] * v
+            state["cycles"] += ram_cycles[i] * v
+            if i in rank:
+                knapsack.remove(rank[i])
+            changed = []
+            for j in p.succs[i]:
+                if x[j] != -1 and x[j] != v:
+                    instrument(i, changed)
+            for j in p.preds[i]:
+                if x[j] != -1 and x[j] != v:
+                    instrument(j, changed)
+            return changed
+
+        def unassign(i, changed):
+            for k in changed:
+                inst[k] = False
+                state["cost"] -= inst_cost[k][x[k]]
+                state["cycles"] -= inst_cycles[k]
+                state["ram"] -= p.icost_ram[k] * x[k]
+            v = x[i]
+            state["cost"] += saving[i] * v
+            state["ram"] -= p.size[i] * v
+            state["cycles"] -= ram_cycles[i] * v
+            if i in rank:
+                knapsack.add(rank[i])
+            x[i] = -1
+
+        def bound():
+            left = p.spare_ram - state["ram"]
+            if left < 0 or base_cycles + state["cycles"] > max_cycles:
+                return None
+            return state["cost"] - knapsack.bound(left)
+
+        # The cost of putting block i in RAM, less the cost of leaving it in
+        # flash, counting the edges to the blocks already decided
+        def preference(i):
+            delta = -saving[i]
+            succs = [x[j] for j in p.succs[i]]
+            if 0 in succs:
+                delta += inst_cost[i][1]
+            if 1 in succs:
+                delta -= inst_cost[i][0]
+            for j in p.preds[i]:
+                if x[j] != -1 and not inst[j]:
+                    delta += inst_cost[j][0] if x[j] == 0 else -inst_cost[j][1]
+            return delta
+
+        for i, v in fixed:
+            assign(i, v)
+
+        root_bound = bound()
+        best_cost = None
+        best = None
+        nodes = 0
+
+        # The first incumbent is the cheapest of start, the heuristic's
+        # placement and everything which isn't forced into RAM in flash
+        starts = [[1 if p.force_ram[i] else 0 for i in range(n)]]
+        if start is not None:
+            starts.append([1 if r else 0 for r in start])
+        try:
+            starts.append([1 if r else 0 for r in Heuristic().solve(p, start=start).in_ram])
+        except RuntimeError:
+            pass
+        for placed in starts:
+            first = p.evaluate(placed)
+            if p.feasible(first) and (best_cost is None or first.cost < best_cost):
+                best_cost = first.cost
+                best = placed
+
+        stack = []
+        complete = True
+        while True:
+            b = bound()
+            if b is not None and (best_cost is None or b < best_cost - 1e-9):
+                d = len(stack)
+                if d == len(order):
+                    best_cost = state["cost"]
+                    best = list(x)
+                else:
+                    i = order[d]
+                    fits = p.size[i] <= p.spare_ram - state["ram"]
+                    v = 1 if fits and preference(i) < 0 else 0
+                    stack.append((i, v, assign(i, v), fits))
+                    nodes += 1
+                    if nodes < self.node_limit:
+                        continue
+                    complete = False
+                    break
+
+            # Backtrack to the last block with a choice left
+            while stack:
+                i, v, changed, other = stack.pop()
+                unassign(i, changed)
+                if other:
+                    v = 1 - v
+                    stack.append((i, v, assign(i, v), False))
+                    nodes += 1
+                    break
+            else:
+                break
+            if nodes >= self.node_limit:
+                complete = False
+                break
+
+        if best is None:
+            if not complete:
+                raise RuntimeError("No placement found within {} nodes".format(self.node_limit))
+            raise RuntimeError("The placement problem has no solution")
+
+        return p.evaluate([v == 1 for v in best], optimal=complete, bound=best_cost if complete else root_bound,
+                          nodes=nodes, node_limit=None if complete else self.node_limit)
+
+# A fast placement, for quick runs and for programs too big to solve
+# exactly. Single blocks, whole loops and straight line chains are put in
+# RAM greedily, in order of the energy they save per byte, counting the
+# instrumentation which moving them needs given the blocks already in RAM.
+# Where a whole loop or chain doesn't fit, the run of its blocks which saves
+# the most and does is placed instead. Then the same groups, and the two ends of an edge together, are moved in
+# or out of RAM while that lowers the energy and keeps to the RAM and cycle
+# limits.
+class Heuristic(object):
+    def __init__(self, passes=10):
+        self.passes = passes
+
+    # If start is given and fits, blocks are added to it, rather than to an
+    # empty RAM
+    def solve(self, problem, start=None):
+        p = problem
+        n = len(p)
+
+        x = [1 if p.force_ram[i] else 0 for i in range(n)]
+        first = p.evaluate(x)
+        if start is not None:
+            given = p.evaluate(start)
+            if p.feasible(given):
+                x = [1 if r else 0 for r in start]
+                first = given
+        totals = [first.cost, first.cycles, first.ram]
+        max_cycles = p.maxCycles()
+
+        movable = [i for i in range(n) if not (p.force_ram[i] or p.force_flash[i] or p.npreds[i] == 0)]
+        is_movable = [False] * n
+        for i in movable:
+            is_movable[i] = True
+
+        # Moving a block on its own means instrumenting the blocks around
+        # it, so whole loops and straight line chains are tried as well.
+        # groups[g] is the movable blocks of each candidate move
+        groups = [[i] for i in movable]
+        for g in p.loopGroups() + [m for m in ReducedProblem(p, contract=True).members if len(m) > 1]:
+            g = [i for i in g if is_movable[i]]
+            if len(g) > 1 and g not in groups:
+                groups.append(g)
+        block_groups = [[] for i in range(n)]
+        for g, blocks in enumerate(groups):
+            for i in blocks:
+                block_groups[i].append(g)
+
+        # The change in cost, cycles and RAM from moving the blocks. Only
+        # they and the blocks which jump to them can change
+        def delta(blocks):
+            affected = set(blocks)
+            for i in blocks:
+                affected.update(p.preds[i])
+
+            change = [0, 0, 0]
+            for sign in [-1, 1]:
+                for k in affected:
+                    for m, v in enumerate(p.blockCost(k, x, p.isInstrumented(k, x))):
+                        change[m] += sign * v
+                for i in blocks:
+                    x[i] = 1 - x[i]
+            return change
+
+        # The blocks forced into RAM might only fit once their neighbours
+        # are in RAM too, so moves which don't make things worse are allowed
+        def fits(change, base=totals):
+            return (base[2] + change[2] <= p.spare_ram or change[2] <= 0) and \
+                   (base[1] + change[1] <= max_cycles or change[1] <= 0)
+
+        def move(blocks, change):
+            for i in blocks:
+                x[i] = 1 - x[i]
+            for m in range(3):
+                totals[m] += change[m]
+
+        def density(change):
+            if change[2] <= 0:
+                return float("-inf")
+            return change[0] / float(change[2])
+
+        # The blocks of a group which are still in flash
+        def outside(g):
+            return [i for i in groups[g] if not x[i]]
+
+        # The run of the blocks, in the order they are laid out, which saves
+        # the most and fits, so a loop can lose its header, its latch or
+        # both. A window slides along the blocks a block at a time, and is
+        # shortened from the start whenever it doesn't fit
+        def fitting(blocks):
+            before = list(totals)
+            best, best_cost = [], 0
+            start = 0
+            for end in range(len(blocks)):
+                move([blocks[end]], delta([blocks[end]]))
+                while start <= end and not fits([t - b for t, b in zip(totals, before)], before):
+                    move([blocks[start]], delta([blocks[start]]))
+                    start += 1
+                if start <= end and totals[0] - before[0] < best_cost:
+                    best, best_cost = blocks[start:end + 1], totals[0] - before[0]
+            for i in blocks[start:]:
+                x[i] = 1 - x[i]
+            totals[:] = before
+            return best
+
+        # Greedy knapsack over the groups, with the groups which have become
+        # cheaper pushed again as their blocks and neighbours go into RAM
+        def push(g):
+            blocks = outside(g)
+            if blocks:
+                change = delta(blocks)
+                if change[0] < 0:
+                    heapq.heappush(heap, (density(change), g, change))
+
+        heap = []
+        for g in range(len(groups)):
+            push(g)
+
+        while heap:
+            d, g, change = heapq.heappop(heap)
+            blocks = outside(g)
+            if not blocks:
+                continue
+            current = delta(blocks)
+            if current != change:
+                if current[0] < 0:
+                    heapq.heappush(heap, (density(current), g, current))
+                continue
+            if not fits(change):
+                # Place as much of a loop or chain as there is room for
+                if len(blocks) == 1:
+                    continue
+                blocks = fitting(blocks)
+                if not blocks:
+                    continue
+                change = delta(blocks)
+                if change[0] >= 0:
+                    continue
+
+            move(blocks, change)
+            changed = set()
+            for i in blocks:
+                for j in [i] + p.preds[i] + p.succs[i]:
+                    changed.update(block_groups[j])
+            for h in changed:
+                push(h)
+
+        # Local search, moving each group, or each pair of blocks joined by
+        # an edge, wholly into or out of RAM
+        pairs = [[i, j] for i, j in p.edges if i != j and is_movable[i] and is_movable[j]]
+        for k in range(self.passes):
+            improved = False
+            for blocks in groups + pairs:
+                for to_ram in [1, 0]:
+                    flip = [i for i in blocks if x[i] != to_ram]
+                    if not flip:
+                        continue
+                    change = delta(flip)
+                    if change[0] < 0 and fits(change):
+                        move(flip, change)
+                        improved = True
+            if not improved:
+                break
+
+        result = p.evaluate(x, optimal=False)
+        if not p.feasible(result):
+            raise RuntimeError("No placement found which fits")
+        return result
@@ -1,18 +1,43 @@
 """Instrument basic blocks and copy them to RAM.
 
 Usage:
-    rammanager.py [options] [--bb BB]... DIRECTORY
+    rammanager.py [options] [--bb BB]... [--emit RAM]... DIRECTORY
     rammanager.py -h
 
 Options:
     -h --help           Show this message
-    -s --solve          Invoke glpsol to get a list of basic blocks for memory
+    -s --solve          Solve the ILP to get a list of basic blocks for memory
+    --solver SOLVER     Either glpsol, to write ilp.data and use ilp.mod, or
+                        bnb, to solve the ILP in process. bnb stops after
+                        --nodes nodes, with the best placement found so far,
+                        which may not be optimal [default: glpsol]
+    --nodes NODES       The most nodes the bnb solver searches
+                        [default: 1000000]
+    --nopresolve        Solve the ILP for every block, rather than fixing the
+                        blocks which can't gain from RAM in flash first
+    --contract          Also join straight line chains of blocks together
+                        before solving. This is faster, but the placement
+                        found may not be optimal
+    --placement MODE    Either ilp, to place the blocks from the ILP solution
+                        if --solve is given, or heuristic, for a fast greedy
+                        placement. With --solve as well, the ILP is still
+                        solved, to show how far the heuristic is from it
+                        [default: ilp]
     -m --maxram RAM     Specify the maximum amount of RAM to allow for basic
                         blocks. If RAM is compute and -c is specified, the
                         -fstack-usage option is used to find the stack usage.
 
                         This hits problems when the stack usage is dynamic.
 
+                        A list (100,200,500) or a range (0:4096:64) of RAM
+                        sizes places the blocks for each in turn, writing the
+                        energy, cycles and RAM of each to the --pareto file.
+
+    --pareto FILE       Where to write the results of a sweep of RAM sizes
+                        [default: pareto.out]
+    --emit RAM          Write the assembly for this RAM size of a sweep, as
+                        .s.out.RAM files
+
     -t --maxtime TIME   This sets a maximum % increase in the time allowed.
                         For example, if this is set to 2, the total number of
                         cycle is allowed to double. [default: 1.5]
@@ -21,20 +46,38 @@ Options:
 
     --bb BB             Place this BB in RAM. Of the form file:lineno
     -i --iterations IF  Use this file to denote the number of times each
-                        basic block is executed
+                        basic block is executed. Either text, as written by
+                        sim.py, or binary, as written by iterprofile.py
 
     -e --estimate EST   Use E iterations per loop as the estimate. [default: 10]
 
+    --solveiters        Estimate the iterations from static branch
+                        probabilities, rather than from the loop depth alone
+
+    -j --jobs JOBS      Number of processes used to load, size and build the
+                        CFGs of the files. Defaults to the number of cores.
+
+    --nocache           Parse and analyse every file from scratch, rather
+                        than reusing the results saved from a previous run
+
 """
 
 from docopt import docopt
 
 import arm
 import cfg
+import analysiscache
+from blockgraph import BlockGraph
+from callgraph import CallGraph
+import frequency
+import tripcount
+import iterprofile
+import placement
 import logging, logging.config
-import os,os.path,sys,glob
+import os,os.path,sys,glob,time
 import itertools, re
 import pexpect, string, collections
+import multiprocessing
 from copy import copy
 
 # logging.config.fileConfig("/home/james/.pylogging.conf")
@@ -55,20 +98,78 @@ def loadInstructions(fname):
 
     return insns, lines, call_dests+calls
 
+# Run fn over each of args, in a pool of worker processes if there is more
+# than one to run. The initializer is run in each worker as it starts; the
+# workers are forked, so its arguments aren't pickled
+def mapFiles(fn, args, jobs=None, initializer=None, initargs=()):
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(args))
+
+    if jobs <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return map(fn, args)
+
+    pool = multiprocessing.Pool(jobs, initializer, initargs)
+    results = pool.map(fn, args)
+    pool.close()
+    pool.join()
+    return results
+
+# Load a file through the analysis cache, and work out the size and cycle
+# cost of its instructions, so that they are sent back with it when this
+# is run in a worker process
+def loadFile(args):
+    fname, use_cache = args
+    cached = analysiscache.CachedFile(fname, loader=loadInstructions, use_cache=use_cache)
+    arm.precomputeSizes(cached.uncosted)
+    for insn in cached.uncosted:
+        try:
+            insn.insnSize()
+            insn.cycleCount()
+        except RuntimeError:
+            # Leave it to fail if the instruction is actually used
+            pass
+    return cached
+
+# The files and call sites the CFG workers build from
+worker_files = None
+worker_call_sites = None
+
+def initCFGWorker(files, call_sites):
+    global worker_files, worker_call_sites
+    worker_files = files
+    worker_call_sites = call_sites
+
+def fileCFGs(fname):
+    cached = worker_files[fname]
+    return cached.flatten(cached.cfgs(worker_call_sites, constructCFGs))
+
+# Build the CFGs of each file, in parallel if there is more than one to
+# build. The CFGs in the cache are restored here, as that is quicker than
+# sending them back from a worker
+def buildCFGs(files, file_cache, call_sites, jobs=None):
+    flat = {}
+    built = [f for f in files if not file_cache[f].restorable(call_sites)]
+    if len(built) > 1 and jobs != 1:
+        flat = dict(zip(built, mapFiles(fileCFGs, built, jobs, initCFGWorker, (file_cache, call_sites))))
+
+    file_cfgs = {}
+    for f in files:
+        if f in flat:
+            file_cfgs[f] = file_cache[f].restoreBuilt(flat[f])
+        else:
+            file_cfgs[f] = file_cache[f].cfgs(call_sites, constructCFGs)
+    return file_cfgs
+
 # Create a CFG from the list of instructions. Use call_sites as a
 # starting point to construct the functions
 def constructCFGs(insns, call_sites=[]):
     overall_cfg = cfg.CFG()
     overall_cfg.construct_new(insns, call_sites)
 
-    cfgs = overall_cfg.partition()
-
-    for c in cfgs:
-        for bb in c.basicblocks:
-            bb.cfg = c
-            bb.iterations = 1
-
-    return cfgs
+    return cfg.cfgsFromBlocks(overall_cfg.basicblocks)
 
 def drawCFGs(cfgs, prefix=""):
     if not os.path.exists("cfgs"):
@@ -80,15 +181,11 @@ def drawCFGs(cfgs, prefix=""):
         os.system("dot -Tpng cfgs/cfg{0}_{1}.dot > cfgs/cfg{0}_{1}.png".format(prefix, i))
 
 def buildCallGraph(cfgs):
-    edges = []
-
     print "Building the callgraph"
 
-    cur_fn = ""
+    graph = CallGraph(cfgs)
 
-    unknown_labels = set([])
-    # Perhaps this could be written better
-    # Precompute list of destinations, and lookup label
+    cur_fn = ""
     for c in cfgs:
         for bb in c.basicblocks:
 
@@ -96,38 +193,16 @@ def buildCallGraph(cfgs):
             if bb.instructions[0].label and bb.instructions[0].label[0] != '.':
                 cur_fn = bb.instructions[0].label
 
-            for insn in bb.instructions:
-                if not insn.isCall() and not insn.markedAsCall:
-                    continue
-                src = bb
-                dest_label = insn.branchDestination()
-                dest_bb = None
-
-                for c2 in cfgs:
-                    for bb2 in c2.basicblocks:
-                        if bb2.instructions[0].label == dest_label:
-                            dest_bb = bb2
-
-                if dest_bb is None:
-                    unknown_labels.add(dest_label)
-                    continue
-
-                sb = cfg.findStartingBlocks(c.basicblocks)[0]
-                print "\tAdding edge ", sb.instructions[0].file,cur_fn, "->",dest_bb.instructions[0].file, dest_label
-
-                edges.append((src,dest_bb))
-    if unknown_labels:
-        print "\tUnfound labels in callgraph:",list(unknown_labels)
+            for dest_bb, count in graph.callsFrom(bb):
+                print "\tAdding edge ", bb.instructions[0].file, cur_fn, "->", dest_bb.instructions[0].file, dest_bb.instructions[0].label
 
-    return edges
+    if graph.unknown_labels:
+        print "\tUnfound labels in callgraph:",list(graph.unknown_labels)
 
-def findRootCFG(cfgs, edges):
-    cfglist = copy(cfgs)
+    return graph
 
-    for e_from, e_to in edges:
-        for c in cfgs:
-            if e_to in c.basicblocks and c in cfglist:
-                del cfglist[cfglist.index(c)]
+def findRootCFG(graph):
+    cfglist = graph.roots()
 
     if len(cfglist) > 1:
         print "There are more than 1 root CFGs..."
@@ -137,76 +212,110 @@ def findRootCFG(cfgs, edges):
 
     return cfglist
 
-def estimateIterations(root, cfgs, edges, estimate, processed_bbs=[], base_iterations=1, depth=0):
-
-    if depth > 5:
-        print "Recursion limit"
-        return
+# The number of times each block of c runs per call of the function, from
+# the loop nesting and the iterations of each loop. Loops whose trip count
+# can't be worked out are taken to run estimate times
+def localIterations(c, estimate):
+    c.findLoops()
+    trips = tripcount.tripCounts(c)
 
-    sb = cfg.findStartingBlocks(root.basicblocks)[0]
-    print "  "*depth+"In fn", sb.instructions[0].label, sb.instructions[0].file
-
-    root.findLoops()
-
-    for bb in root.basicblocks:
+    local = []
+    for bb in c.basicblocks:
 
         # Get the loop depth of the current basic block
-        cols = []
-        lh = root.getLoopHeaders(bb)
-        if bb in root.loop_headers:
-            lh = [bb] + lh
-
-        for header in lh:
-            if header in root.loop_headers:
-                i = root.loop_headers.index(header)
-                cols.append(i)
-
-        if bb in lh:
-            iter_count = estimate ** (len(cols)+1) * (estimate+1) * base_iterations
+        lh = bb.getLoopHeaders()
+        cols = [header for header in lh if header in c.header_loops]
+
+        iter_count = 1
+        for header in cols:
+            iter_count *= trips.get(header, estimate)
+
+        # A header runs once more than its loop body, for the test which
+        # leaves the loop. iter_count already includes its own trip count
+        if bb in lh and bb in c.header_loops:
+            n = trips.get(bb, estimate)
+            local.append(iter_count / n * (n+1) if n else iter_count)
         else:
-            iter_count = estimate ** len(cols) * base_iterations
-        bb.iterations = max(bb.iterations, iter_count)
-
-        for e in edges:
-            # print e[0].instructions[0].label
-            if e[0] == bb:
-                # if e[0] in processed_bbs:
-                #     print "Recursive CFG found?!"
-                #     continue
-
-                found = False
-                for c in cfgs:
-                    if e[1] in c.basicblocks:
-                        estimateIterations(c, cfgs, edges, estimate, processed_bbs+[e[1]], bb.iterations, depth+1)
-                        found = True
-
-                if not found:
-                    print "Could not find destination CFG?!"
+            local.append(iter_count)
+    return local
+
+# Estimate how many times every block runs. The local iterations of each
+# function are found once, then the number of calls of each function is
+# pushed through the call graph, callers first. The functions in a cycle of
+# calls are called from each other for estimate levels of recursion.
+def estimateIterations(graph, estimate, local_iterations=localIterations):
+    local = [local_iterations(c, estimate) for c in graph.cfgs]
+
+    # The number of times each function is called
+    calls = [0] * len(graph)
+    roots = set(graph.component[comp[0]] for comp in graph.rootComponents())
+
+    for comp in graph.components():
+        k = graph.component[comp[0]]
+
+        # Functions which are not called from anywhere else run once
+        if k in roots:
+            for i in comp:
+                calls[i] += 1
+
+        if graph.isRecursive(comp):
+            level = {i: calls[i] for i in comp}
+            for depth in range(estimate):
+                next_level = collections.defaultdict(int)
+                for i in comp:
+                    if not level.get(i):
+                        continue
+                    for bb, n in zip(graph.cfgs[i].basicblocks, local[i]):
+                        for dest_bb, count in graph.callsFrom(bb):
+                            j = graph.index.get(id(dest_bb.cfg))
+                            if j is not None and graph.component[j] == k:
+                                next_level[j] += level[i] * n * count
+                if not next_level:
+                    break
+                for j, v in next_level.items():
+                    calls[j] += v
+                level = next_level
+
+        for i in comp:
+            for bb, n in zip(graph.cfgs[i].basicblocks, local[i]):
+                bb.iterations = max(1, n * calls[i])
+
+                for dest_bb, count in graph.callsFrom(bb):
+                    j = graph.index.get(id(dest_bb.cfg))
+                    if j is not None and graph.component[j] != k:
+                        calls[j] += bb.iterations * count
+
+    print "Estimated iterations for {} functions, {} recursive".format(len(graph), sum(1 for comp in graph.components() if graph.isRecursive(comp)))
 
 def loadIterations(file_cfgs, fname):
     print "Loading iterations from file"
-    for line in open(fname).readlines():
-        parts = line.split()
-
-        if ':' not in parts[0]:
-            delim = "_"
-        else:
-            delim = ":"
 
-        f_iter = parts[0].rsplit(delim,1)[0]
-        f_line = parts[0].rsplit(delim,1)[1]
+    # Index the blocks by where they start, so that each entry is a lookup
+    blocks = collections.defaultdict(list)
+    for f, cfgs in file_cfgs.items():
+        for c in cfgs:
+            for bb in c.basicblocks:
+                blocks[(f, bb.instructions[0].lineno)].append(bb)
 
+    unknown_files = set()
+    unmatched = []
+    for f_iter, f_line, hits in iterprofile.readProfile(fname):
         if f_iter not in file_cfgs:
-            print "Error, iteration file specifies file:",f_iter
+            unknown_files.add(f_iter)
+            continue
 
-        found = False
-        for c in file_cfgs[f_iter]:
-            for bb in c.basicblocks:
-                if bb.instructions[0].lineno == int(f_line):
-                    found = True
-                    bb.iterations = int(parts[1])
+        found = blocks.get((f_iter, f_line))
         if not found:
-            print "Error could not find basic block:",parts[0]
+            unmatched.append("{}:{}".format(f_iter, f_line))
+            continue
+
+        for bb in found:
+            bb.iterations = hits
+
+    if unknown_files:
+        print "Error, iteration file specifies files:", " ".join(sorted(unknown_files))
+    if unmatched:
+        print "Error could not find {} basic blocks:".format(len(unmatched)), " ".join(unmatched[:20]), "..." if len(unmatched) > 20 else ""
 
 
 
@@ -413,294 +522,136 @@ def applyChanges(lines, changes):
 
     return lines_out
 
-def solveForIterationCount(file_cfgs, cfgs, model):
-    fname = "iterations.data"
-    f = open(fname, "w")
-
-    all_bbs = list(itertools.chain(*map(lambda x: x.basicblocks, cfgs)))
-
-    bb_names = []
-    for bb in all_bbs:
-        insn0 = bb.instructions[0]
-        bb_names.append("{}_{:04d}".format(insn0.file,insn0.lineno))
-
-    bb_map = dict(zip(bb_names, all_bbs))
-    maxname = max(map(len, bb_names))
-
-    bb_names.sort()
-
-
-    # Output list of beasic blocks first
-    f.write("set BBs := {};\n\n".format(" ".join(bb_names)))
-
-    # output initial
-    f.write("param iterations_initial :=\n")
-    for bb_name, bb in zip(bb_names, all_bbs):
-        f.write("\t{1: <{0}} {2}\n".format(maxname, bb_name, 0))
-    f.write(";\n\n")
-
-    loop_exits = collections.defaultdict(int)
-
-    for bb_name in bb_names:
-        cur_bb = bb_map[bb_name]
-        dests = cur_bb.destinations
-
-        lh = cur_bb.getLoopHeaders()
-        bb_depth = len(lh)
-
-        if len(dests) == 2:
-            d0_depth = len(dests[0].getLoopHeaders())
-            d1_depth = len(dests[1].getLoopHeaders())
-
-            if d0_depth < bb_depth:
-                for i in range(bb_depth - d0_depth):
-                    loop_exits[lh[i]] += 1
-                    print "Loop exit @{} for loop@{}".format(cur_bb.instructions[0].lineno, lh[i].instructions[0].lineno)
-            if d1_depth < bb_depth:
-                for i in range(bb_depth - d1_depth):
-                    loop_exits[lh[i]] += 1
-                    print "Loop exit @{} for loop@{}".format(cur_bb.instructions[0].lineno, lh[i].instructions[0].lineno)
-
-
-
-    print loop_exits
+# Estimate the iterations from static branch probabilities, solving for the
+# block frequencies of each function in process, rather than with the
+# loop depth alone
+def solveForIterationCount(graph, estimate):
+    print "Solving for block frequencies from branch probabilities"
+    estimateIterations(graph, estimate, local_iterations=frequency.blockFrequencies)
 
-    # Output bb to bb probability
-    f.write("param branch_prob : {} :=\n".format(" ".join(bb_names)))
-    for bb_name in bb_names:
-        f.write("\t{1: <{0}}\t\t".format(maxname, bb_name))
-        dests = bb_map[bb_name].destinations
-        cur_bb = bb_map[bb_name]
-
-        # Find the inner most loop for this basic block
-        lh = cur_bb.getLoopHeaders()
-        bb_depth = len(lh)
-
-        # Work out if both destinations are in the same loop
-        same = True
-        if len(dests) == 2:
-            d0_depth = len(dests[0].getLoopHeaders())
-            d1_depth = len(dests[1].getLoopHeaders())
-
-            if d0_depth < bb_depth or  d1_depth < bb_depth:
-                same = False
-
-        for bb_name2 in bb_names:
-            dest_bb = bb_map[bb_name2]
-
-            # Find the inner most loop for this basic block
-            dest_depth = len(dest_bb.getLoopHeaders())
-
-            if dest_bb not in dests:
-                f.write("0.0 ")
-            elif len(dests) == 1:
-                f.write("1.0 ")
-            else:
-                # Equal probability if both in the same loop
-                if same:
-                    f.write("0.5 ")
-                # Skew probabilities to say in the loop, if not
-                else:
-                    # if dest_depth >= bb_depth:
-                    if dest_bb.getLoopHeaders() == lh or dest_depth > bb_depth:
-                        # f.write("{} ".format(1 - (0.10 / loop_exits[bb_loop])))
-                        f.write("{} ".format(1 - (0.10)))
-                    else:
-                        # f.write("{} ".format((0.10 / 1)))
-                        prob = 0.1
-                        for i in range(bb_depth - dest_depth):
-                            prob /= loop_exits[lh[i]]
-                            print loop_exits[lh[i]]
-                        print dest_depth,bb_depth, prob
-                        f.write("{} ".format(prob))
-        f.write("\n")
-    f.write(";\n\n")
-
-    f.close()
-
-    # TODO proper temp file
-    glpsol = pexpect.spawn("glpsol -d iterations.data -m {} -y /tmp/glp_iter".format(model), timeout=3600)
-    glpsol.expect(".*OPTIMAL LP SOLUTION FOUND.*")
-    glpsol.expect(pexpect.EOF)
-    print "*** Found iteration count solution ***"
-    loadIterations(file_cfgs, "/tmp/glp_iter")
-
-    # edges = buildCallGraph(cfgs)
-    # roots = findRootCFG(cfgs, edges)
-    # # print "Found root:", cfg.findStartingBlocks(roots[0].basicblocks)[0].instructions[0].label
-
-    # for r in roots:
-    #     estimateIterations(r, cfgs, edges, estimate=0)
+def placementProblem(cfgs, E_flash=100, E_ram=66, spare_ram=2000, max_cycle_factor=2, force_bbs=[], specified_only=False):
+    g = BlockGraph(itertools.chain(*map(lambda x: x.basicblocks, cfgs)))
 
+    print "Calculating sizes and cycle costs"
+    g.loadFeatures()
 
+    return placement.PlacementProblem(g, force_bbs=force_bbs, specified_only=specified_only,
+        E_flash=E_flash, E_ram=E_ram, spare_ram=spare_ram, max_cycle_factor=max_cycle_factor)
 
 def createILPData(cfgs, fname, E_flash=100, E_ram=66, spare_ram=2000, max_cycle_factor=2, force_bbs=[], specified_only=False):
-    f = open(fname, "w")
-
-    all_bbs = list(itertools.chain(*map(lambda x: x.basicblocks, cfgs)))
-
-    bb_names = []
-    for bb in all_bbs:
-        insn0 = bb.instructions[0]
-        if insn0.label is False:
-            bb_names.append("{}_{}".format(insn0.file,insn0.lineno))
-        else:
-            bb_names.append("{}_{}".format(insn0.file,insn0.label))
-
-    bb_map = dict(zip(bb_names, all_bbs))
-
-    f.write("set BBs := {};\n\n".format(" ".join(bb_names)))
-
-    f.write("param usize :=\n")
-    maxname = max(map(len, bb_names))
-
-    sys.stdout.write("Calculating sizes")
-    for bb_name, bb in zip(bb_names, all_bbs):
-        f.write("\t{1: <{0}} {2}\n".format(maxname, bb_name, bb.codeSize()))
-        sys.stdout.write(".")
-        sys.stdout.flush()
-    print ""
-    f.write(";\n\n")
-
-    f.write("param cyc_cost :=\n")
-    sys.stdout.write("Calculating cycle costs")
-    for bb_name, bb in zip(bb_names, all_bbs):
-        f.write("\t{1: <{0}} {2}\n".format(maxname, bb_name, bb.cycleCount()))
-        sys.stdout.write(".")
-        sys.stdout.flush()
-    print ""
-    f.write(";\n\n")
-
-    f.write("param iterations :=\n")
-    for bb_name, bb in zip(bb_names, all_bbs):
-        f.write("\t{1: <{0}} {2}\n".format(maxname, bb_name, bb.iterations))
-    f.write(";\n\n")
-
-    f.write("param force_ram :=\n")
-    for bb_name, bb in zip(bb_names, all_bbs):
-        f.write("\t{1: <{0}} {2}\n".format(maxname, bb_name, 1 if bb in force_bbs else 0))
-    f.write(";\n\n")
-
-    f.write("param force_flash :=\n")
-    for bb_name, bb in zip(bb_names, all_bbs):
-        f.write("\t{1: <{0}} {2}\n".format(maxname, bb_name, 1 if specified_only and bb not in force_bbs else 0))
-    f.write(";\n\n")
-
-    f.write("param icost_ram :=\n")
-    for bb_name, bb in zip(bb_names, all_bbs):
-        # Count number of calls in bb
-        calls = sum(bb.countCalls().values())
-
-        if bb.getTailInsn().operator in ["cbz", "cbnz"]:
-            icost = 8
-        elif not bb.getTailInsn().isBranch():
-            icost = 6 # Fallthrough
-        elif bb.getTailInsn().isUnconditional():
-            icost = 2 # Unconditional branch
-        else:
-            icost = 6 # Conditional
-
-        icost += calls*2
-        f.write("\t{1: <{0}} {2}\n".format(maxname, bb_name, icost))
-    f.write(";\n\n")
-
-    f.write("param icost_cyc :=\n")
-    for bb_name, bb in zip(bb_names, all_bbs):
-        # Count number of calls in bb
-        calls = sum(bb.countCalls().values())
-
-        if bb.getTailInsn().operator in ["cbz", "cbnz"]:
-            icost = 8 - 3
-        elif not bb.getTailInsn().isBranch():
-            icost = 4 # Fallthrough
-        elif bb.getTailInsn().isUnconditional():
-            icost = 4 - 3 # Unconditional branch
-        else:
-            icost = 7 - 3 # Conditional
-
-        icost += calls*2
-        f.write("\t{1: <{0}} {2}\n".format(maxname, bb_name, icost))
-    f.write(";\n\n")
-
-    f.write("param icost_cyc_ram :=\n")
-    for bb_name, bb in zip(bb_names, all_bbs):
-        # Count number of calls in bb
-        icost = 0
-
-        for insn in bb.instructions:
-            if insn.isLoad() or insn.isStore():
-                icost += 2
-#                icost += insn.cycleCount()
-#            icost += 1
+    problem = placementProblem(cfgs, E_flash=E_flash, E_ram=E_ram, spare_ram=spare_ram,
+        max_cycle_factor=max_cycle_factor, force_bbs=force_bbs, specified_only=specified_only)
+    placement.writeData(problem, fname)
 
+    return dict(zip(problem.names, problem.blocks))
 
-        f.write("\t{1: <{0}} {2}\n".format(maxname, bb_name, icost))
-    f.write(";\n\n")
+def solveILP(problem, solver, start=None, presolve=True, contract=False):
+    if presolve:
+        reduced = placement.ReducedProblem(problem, contract=contract)
+        blocks, edges = reduced.ratio()
+        print "Presolve left {} of {} blocks ({:.1%}) and {} of {} edges ({:.1%})".format(
+            reduced.free, len(problem), blocks, len(reduced.edges), len(problem.edges), edges)
 
+        print "Starting the ILP solver..."
+        result = reduced.expand(solver.solve(reduced, start=None if start is None else reduced.reduce(start)))
+    else:
+        print "Starting the ILP solver..."
+        result = solver.solve(problem, start=start)
+    if result.optimal:
+        print "*** Found solution ***"
+    elif result.node_limit is not None:
+        gap = "unknown" if result.gap() is None else "{:.2%}".format(result.gap())
+        print "*** Node limit of {} hit: the solution may not be optimal (gap to the bound: {}) ***".format(result.node_limit, gap)
+    elif result.gap() is None:
+        print "*** Found solution, not known to be optimal ({} nodes) ***".format(result.nodes)
+    else:
+        print "*** Found solution, within {:.2%} of optimal ({} nodes) ***".format(result.gap(), result.nodes)
 
-    f.write("param successors : {} :=\n".format(" ".join(bb_names)))
-    for bb_name in bb_names:
-        f.write("\t{1: <{0}}\t\t".format(maxname, bb_name))
-        dests = bb_map[bb_name].destinations
+    return result
 
-        for bb_name2 in bb_names:
-            f.write("{:d} ".format(bb_map[bb_name2] in dests))
-        f.write("\n")
-    f.write(";\n\n")
+def placeHeuristically(problem, exact=None, start=None):
+    print "Placing blocks heuristically..."
+    started = time.time()
+    result = placement.Heuristic().solve(problem, start=start)
+    print "*** Found placement in {:.0f} ms ***".format((time.time() - started) * 1000)
 
-    f.write("param E_flash := {};\n".format(E_flash))
-    f.write("param E_ram := {};\n".format(E_ram))
-    f.write("param spare_ram := {};\n".format(spare_ram))
-    f.write("param max_cycle_factor := {};\n".format(max_cycle_factor))
+    if exact is not None:
+        gap = (result.cost - exact.cost) / float(exact.cost) if exact.cost else 0.0
+        if exact.optimal:
+            print "*** Heuristic cost is {:.2%} above the ILP optimum ***".format(gap)
+        else:
+            print "*** Heuristic cost is {:.2%} above the best ILP solution found ***".format(gap)
 
-    f.write("end;\n")
-    f.close()
+    return result
 
-    return dict(zip(bb_names, all_bbs))
+def applyPlacement(problem, result):
+    cost = int(round(result.cost))
+    cycles = int(round(result.cycles))
+    print "*** Cost:", cost
 
-def solveILP(bb_names, model):
     target_bbs = []
-
-    print "Starting the ILP solver..."
-    # TODO proper temp file
-    glpsol = pexpect.spawn("glpsol -d ilp.data -m {} -y /tmp/glp.{}".format(model,os.getpid()), timeout=3600)
-    glpsol.expect(".*INTEGER OPTIMAL SOLUTION FOUND.*")
-    glpsol.expect(pexpect.EOF)
-    print "*** Found solution ***"
-
-    f = open("/tmp/glp.{}".format(os.getpid()))
-    lines = f.readlines()
-    cost = int(lines[1].split(":")[1])
-    cycles = int(lines[3].split(":")[1])
-    ramsize = int(lines[6].split(":")[1])
     totalsize = 0
-
-    print "*** Cost:", cost
-    # print cost.strip(),
-
-    for l in lines:
-        if l[0] == '#':
-            print l.strip()
-            continue
-
-        parts = l.split(',')
-
-        if parts[0] not in bb_names:
-            print "ERROR", parts[0]
-        else:
-            if parts[2].strip() == "1":
-                target_bbs.append(bb_names[parts[0]])
-                totalsize += int(parts[1].strip())
-            if parts[3].strip() == "1":
-                bb_names[parts[0]].instrumented=1
-
+    for i in result.ramBlocks():
+        target_bbs.append(problem.blocks[i])
+        totalsize += problem.size[i]
+    for i, inst in enumerate(result.instrumented):
+        if inst:
+            problem.blocks[i].instrumented = 1
 
     print "*** There are {} basicblocks in RAM".format(len(target_bbs))
     print "*** {} bytes of RAM used for code".format(totalsize)
 
-    # print len(target_bbs), totalsize,
-
-    return target_bbs, cost,cycles,ramsize
+    return target_bbs, cost, cycles, result.ram
+
+# The RAM budgets to place the blocks for, from a single number, a list such
+# as 100,200,500 or a range such as 0:4096:64, which includes its end
+def ramBudgets(spec):
+    spec = str(spec)
+    if ':' in spec:
+        parts = map(int, spec.split(':'))
+        if len(parts) != 3 or parts[2] <= 0:
+            raise RuntimeError("RAM range should be start:end:step, not " + spec)
+        return range(parts[0], parts[1] + 1, parts[2])
+    return map(int, spec.split(','))
+
+# Solve the placement for each RAM budget in turn, starting each solve from
+# the placement found for the budget before
+def sweepRAM(problem, budgets, ilp_solver=None, heuristic=False, presolve=True, contract=False):
+    points = []
+    start = None
+
+    for ram in budgets:
+        print "\n*** RAM budget: {} bytes".format(ram)
+        problem.spare_ram = ram
+
+        result = None
+        if ilp_solver is not None:
+            result = solveILP(problem, ilp_solver, start=start, presolve=presolve, contract=contract)
+        if heuristic:
+            result = placeHeuristically(problem, exact=result, start=start)
+
+        print "*** Cost: {}, cycles: {}, RAM: {}".format(int(round(result.cost)), int(round(result.cycles)), result.ram)
+        points.append((ram, result))
+        start = result.in_ram
+
+    return points
+
+# Whether a is at least as good as b in energy, cycles and RAM, and better
+# in one of them
+def dominates(a, b):
+    a = (a.cost, a.cycles, a.ram)
+    b = (b.cost, b.cycles, b.ram)
+    return all(x <= y for x, y in zip(a, b)) and a != b
+
+def writePareto(points, fname):
+    f = open(fname, "w")
+    f.write("maxram, cost, cycles, ram, ram_bbs, gap, pareto\n")
+    for ram, result in points:
+        gap = result.gap()
+        pareto = not any(dominates(other, result) for r, other in points)
+        f.write("{}, {}, {}, {}, {}, {}, {}\n".format(ram, int(round(result.cost)), int(round(result.cycles)),
+            result.ram, len(result.ramBlocks()), "-" if gap is None else "{:.6f}".format(gap), 1 if pareto else 0))
+    f.close()
 
 def preCompile(extra_flags="", doclean=True):
     global safe_register
@@ -770,85 +721,11 @@ def doCompile(asmfiles, extra_flags=""):
     print "Done"
 
 
-def main(compile=False, solve=False, maxram=1000, files=[], model="", cflags="", extrabbs=[], max_cycle_factor=1.5, specified_only=False, iteration_file=None, solveiters=False, itermodel="", iteration_estimate=10):
-    file_cfgs = {}
-    file_insns = {}
-    file_lines = {}
-    file_changes = {}
+# Instrument the blocks and move the blocks marked inram to RAM, writing
+# each file out with suffix on the end of its name
+def writeOutput(files, file_cfgs, file_lines, suffix=".out"):
+    file_changes = {f:[] for f in files}
     file_fallthrough = {f:[] for f in files}
-    call_sites = []
-
-    if compile:
-        preCompile(extra_flags=cflags)
-
-    print "\n\n*** LOADING + CFG + CALL GRAPH *****************************"
-    print "Loading instructions from assembly files"
-    for f in files:
-        insns, lines, cs = loadInstructions(f)
-        call_sites += cs
-
-        file_insns[f] = insns
-        file_lines[f] = lines
-        file_changes[f] = []
-        print "\t", f
-
-    print "Found {} call sites".format(len(call_sites))
-
-    for f in files:
-        cfgs = constructCFGs(file_insns[f], call_sites)
-        file_cfgs[f] = cfgs
-
-    cfg_list = reduce(list.__add__, file_cfgs.values(), [])
-
-    edges = buildCallGraph(cfg_list)
-
-    print "\n\n*** ITERATION ESTIMATION ***********************************"
-    roots = findRootCFG(cfg_list, edges)
-    print "Using root to estimate iterations:", cfg.findStartingBlocks(roots[0].basicblocks)[0].instructions[0].label
-
-    for r in roots:
-        estimateIterations(r, cfg_list, edges, estimate=iteration_estimate)
-
-    if iteration_file is not None:
-        loadIterations(file_cfgs, iteration_file)
-
-    print "\n\n*** APPLYING BASIC BLOCK MODEL *****************************"
-    if extrabbs:
-        print "Forcing specified basic blocks into RAM"
-    target_bbs = []
-    # Add the basicblocks specified on the command line
-    for n in extrabbs:
-        f, l = n.split(':')
-        for c in file_cfgs[f]:
-            for bb in c.basicblocks:
-                if bb.instructions[0].lineno == int(l):
-                    if bb not in target_bbs:
-                        target_bbs.append(bb)
-
-    if solve:
-        bb_names = createILPData(cfg_list, "ilp.data", spare_ram=maxram, max_cycle_factor=max_cycle_factor, force_bbs=target_bbs, specified_only=specified_only)
-        target_bbs, cost, cycles, ramsize = solveILP(bb_names, model=model)
-    else:
-        print "Skipping the ILP solver"
-        cost, cycles, ramsize = 0,0,0
-
-    print "Basic blocks in RAM:", len(target_bbs)
-    # for f in files:
-    #     for c in file_cfgs[f]:
-    #         for bb in c.basicblocks:
-    #             if bb in target_bbs:
-    #                 print "   ",f+":"+str(bb.instructions[0].lineno)
-
-    print "\n\n*** DRAWING CFGS *******************************************"
-
-    for f in files:
-        print "CFGs in ",f
-        for c in file_cfgs[f]:
-            for bb in c.basicblocks:
-                if bb in target_bbs:
-                    bb.inram = True
-                # print bb.instructions[0].lineno, map(lambda x: x.instructions[0].lineno, target_bbs)
-        drawCFGs(file_cfgs[f], prefix=f)
 
     print "\n\n*** APPLYING TRANSFORMATIONS TO BASIC BLOCKS ***************"
 
@@ -860,16 +737,16 @@ def main(compile=False, solve=False, maxram=1000, files=[], model="", cflags="",
                 cc = transformReferences(bb)
                 file_changes[fname].extend(cc)
 
-                ram_dests = filter(lambda x: x in target_bbs, bb.destinations)
+                ram_dests = filter(lambda x: x.inram, bb.destinations)
 
                 # If bb is not in ram, and some destinations are
-                if bb not in target_bbs and len(ram_dests) > 0:
+                if not bb.inram and len(ram_dests) > 0:
                     cc, fallthrough = instrumentBB(bb)
                     file_changes[fname].extend(cc)
                     file_fallthrough[fname].extend(fallthrough)
 
                 # If bb is in ram and one of its destinations is not
-                elif bb in target_bbs and len(ram_dests) != len(bb.destinations):
+                elif bb.inram and len(ram_dests) != len(bb.destinations):
                     cc, fallthrough = instrumentBB(bb)
                     file_changes[fname].extend(cc)
                     file_fallthrough[fname].extend(fallthrough)
@@ -878,7 +755,7 @@ def main(compile=False, solve=False, maxram=1000, files=[], model="", cflags="",
         for c in cfgs:
             for bb in c.basicblocks:
 
-                if bb in target_bbs:
+                if bb.inram:
                     cc = markRAMBB(bb)
                     file_changes[fname].extend(cc)
 
@@ -905,10 +782,142 @@ def main(compile=False, solve=False, maxram=1000, files=[], model="", cflags="",
         out_lines = applyChanges(file_lines[fname], file_changes[fname] + file_fallthrough[fname])
 
         print "Applying changes to", fname
-        f = open(fname+".out","w")
+        f = open(fname+suffix,"w")
         f.write("".join(out_lines))
         f.close()
 
+# Place the blocks for every RAM budget, writing the energy, cycles and RAM
+# of each to pareto_file, and the assembly for the budgets in emit, as
+# .out.RAM files
+def sweep(problem, budgets, ilp_solver, heuristic, presolve, contract, files, file_cfgs, file_lines, pareto_file, emit):
+    print "\n\n*** SWEEPING RAM BUDGETS ***********************************"
+    points = sweepRAM(problem, budgets, ilp_solver=ilp_solver, heuristic=heuristic, presolve=presolve, contract=contract)
+
+    writePareto(points, pareto_file)
+    print "Wrote the results for {} budgets to {}".format(len(points), pareto_file)
+
+    results = dict(points)
+    for ram in map(int, emit):
+        if ram not in results:
+            print "No RAM budget of {} in the sweep, not writing it out".format(ram)
+            continue
+
+        for bb in problem.blocks:
+            bb.inram = False
+            bb.instrumented = False
+        print "\nPlacement for {} bytes of RAM".format(ram)
+        target_bbs = applyPlacement(problem, results[ram])[0]
+        for bb in target_bbs:
+            bb.inram = True
+        writeOutput(files, file_cfgs, file_lines, suffix=".out.{}".format(ram))
+
+    return [(ram, int(round(r.cost)), int(round(r.cycles)), r.ram) for ram, r in points]
+
+def main(compile=False, solve=False, maxram=1000, files=[], model="", cflags="", extrabbs=[], max_cycle_factor=1.5, specified_only=False, iteration_file=None, solveiters=False, iteration_estimate=10, jobs=None, use_cache=True, solver="glpsol", node_limit=1000000, placement_mode="ilp", pareto_file="pareto.out", emit=[], presolve=True, contract=False):
+    file_cfgs = {}
+    file_insns = {}
+    file_lines = {}
+    file_cache = {}
+    call_sites = []
+
+    if compile:
+        preCompile(extra_flags=cflags)
+
+    print "\n\n*** LOADING + CFG + CALL GRAPH *****************************"
+    print "Loading and sizing instructions from assembly files"
+    for f, cached in zip(files, mapFiles(loadFile, [(f, use_cache) for f in files], jobs)):
+        call_sites += cached.calls
+
+        file_cache[f] = cached
+        file_insns[f] = cached.instructions
+        file_lines[f] = cached.lines
+        print "\t", f, "({} of {} instructions sized)".format(len(cached.uncosted), len(cached.instructions))
+
+    print "Found {} call sites".format(len(call_sites))
+
+    file_cfgs = buildCFGs(files, file_cache, call_sites, jobs)
+
+    cfg_list = reduce(list.__add__, file_cfgs.values(), [])
+
+    graph = buildCallGraph(cfg_list)
+
+    print "\n\n*** ITERATION ESTIMATION ***********************************"
+    roots = findRootCFG(graph)
+    print "Using root to estimate iterations:", cfg.findStartingBlocks(roots[0].basicblocks)[0].instructions[0].label
+
+    if solveiters:
+        solveForIterationCount(graph, estimate=iteration_estimate)
+    else:
+        estimateIterations(graph, estimate=iteration_estimate)
+
+    if iteration_file is not None:
+        loadIterations(file_cfgs, iteration_file)
+
+    print "\n\n*** APPLYING BASIC BLOCK MODEL *****************************"
+    if extrabbs:
+        print "Forcing specified basic blocks into RAM"
+    target_bbs = []
+    # Add the basicblocks specified on the command line
+    for n in extrabbs:
+        f, l = n.split(':')
+        for c in file_cfgs[f]:
+            for bb in c.basicblocks:
+                if bb.instructions[0].lineno == int(l):
+                    if bb not in target_bbs:
+                        target_bbs.append(bb)
+
+    if placement_mode not in ["ilp", "heuristic"]:
+        raise RuntimeError("Unknown placement mode: " + placement_mode)
+
+    budgets = ramBudgets(maxram)
+    if len(budgets) > 1 and not (solve or placement_mode == "heuristic"):
+        raise RuntimeError("A sweep of RAM budgets needs --solve or --placement heuristic")
+
+    if solve or placement_mode == "heuristic":
+        problem = placementProblem(cfg_list, spare_ram=budgets[0], max_cycle_factor=max_cycle_factor, force_bbs=target_bbs, specified_only=specified_only)
+
+        ilp_solver = None
+        if solve:
+            if solver == "glpsol":
+                ilp_solver = placement.GlpsolSolver(model)
+            elif solver == "bnb":
+                ilp_solver = placement.BranchAndBound(node_limit=node_limit)
+            else:
+                raise RuntimeError("Unknown solver: " + solver)
+
+        if len(budgets) > 1:
+            return sweep(problem, budgets, ilp_solver, placement_mode == "heuristic", presolve, contract,
+                         files, file_cfgs, file_lines, pareto_file, emit)
+
+        result = None
+        if solve:
+            result = solveILP(problem, ilp_solver, presolve=presolve, contract=contract)
+
+        if placement_mode == "heuristic":
+            result = placeHeuristically(problem, exact=result)
+
+        target_bbs, cost, cycles, ramsize = applyPlacement(problem, result)
+    else:
+        print "Skipping the ILP solver"
+        cost, cycles, ramsize = 0,0,0
+
+    print "Basic blocks in RAM:", len(target_bbs)
+    for bb in target_bbs:
+        bb.inram = True
+    # for f in files:
+    #     for c in file_cfgs[f]:
+    #         for bb in c.basicblocks:
+    #             if bb in target_bbs:
+    #                 print "   ",f+":"+str(bb.instructions[0].lineno)
+
+    print "\n\n*** DRAWING CFGS *******************************************"
+
+    for f in files:
+        print "CFGs in ",f
+        drawCFGs(file_cfgs[f], prefix=f)
+
+    writeOutput(files, file_cfgs, file_lines)
+
     if compile:
         doCompile(files,extra_flags=cflags)
 
@@ -918,10 +927,8 @@ if __name__=="__main__":
     arguments = docopt(__doc__)
 
     model = "ilp.mod"
-    itermodel = "iterations.mod"
 
     model = os.getcwd() + "/" + model
-    itermodel = os.getcwd() + "/" + itermodel
     os.chdir(arguments['DIRECTORY'])
 
     print "Doing a make to work out what files are produced"
@@ -945,5 +952,14 @@ if __name__=="__main__":
         model=model, cflags=arguments['--flags'], extrabbs=arguments['--bb'],
         max_cycle_factor=float(arguments['--maxtime']),
         iteration_file=arguments['--iterations'],
-        itermodel=itermodel,
-        iteration_estimate=int(arguments['--estimate']))
+        solveiters=arguments['--solveiters'],
+        iteration_estimate=int(arguments['--estimate']),
+        jobs=int(arguments['--jobs']) if arguments['--jobs'] else None,
+        use_cache=not arguments['--nocache'],
+        solver=arguments['--solver'],
+        node_limit=int(arguments['--nodes']),
+        placement_mode=arguments['--placement'],
+        pareto_file=arguments['--pareto'],
+        emit=arguments['--emit'],
+        presolve=not arguments['--nopresolve'],
+        contract=arguments['--contract'])
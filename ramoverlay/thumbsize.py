@@ -0,0 +1,513 @@
+"""Calculate Thumb-2 instruction sizes without the assembler.
+
+Usage:
+    thumbsize.py [-v]
+    thumbsize.py -h
+
+Options:
+    -h --help           Show this message
+    -v --verbose        Print every instruction that disagrees with the cache
+
+When run directly, this checks the table against the sizes the assembler has
+previously found for the current toolchain (the asmsize cache), and exits with
+an error if any disagree.
+"""
+
+import re
+
+# This decides between the 16-bit and 32-bit encodings of a Cortex-M3
+# instruction, following the same choices gas makes in unified syntax (the
+# narrow encoding is used wherever one exists). The operator passed in should
+# already have its condition code stripped; whether it was inside an IT block
+# is passed separately, as it changes which encodings set the flags.
+#
+# Loads from, and addresses of, a label are sized as the assembler sizes them
+# in asmsize's context, where the instruction starts word aligned and the
+# label is 8 bytes after it. ldr rt, =value is always wide for a high
+# register, but for a low one the choice between a mov, mvn or movw and a
+# narrow literal load changes between gas versions, so it is left to the
+# assembler.
+#
+# When the size can't be decided from the text alone (e.g. the operator isn't
+# in the table, or an operand is the value of a symbol), None is returned and
+# the caller should fall back to the assembler.
+
+reg_numbers = {"sb": 9, "sl": 10, "fp": 11, "ip": 12, "sp": 13, "lr": 14, "pc": 15}
+for i in range(16):
+    reg_numbers["r{}".format(i)] = i
+
+conditions = ["eq", "ne", "cs", "cc", "hs", "lo", "mi", "pl", "vs", "vc", "hi",
+              "ls", "ge", "lt", "gt", "le", "al"]
+
+always16 = set(["b", "bx", "cbz", "cbnz", "nop", "svc", "bkpt", "cpsie", "cpsid",
+                "wfi", "wfe", "sev", "yield"] + ["b"+c for c in conditions])
+
+always32 = set(["bl", "movw", "movt", "addw", "subw", "udiv", "sdiv", "mla", "mls",
+                "umull", "smull", "umlal", "smlal", "bfi", "bfc", "ubfx", "sbfx",
+                "clz", "rbit", "teq", "orn", "orns", "rrx", "rrxs", "ldrd", "strd",
+                "ldrex", "strex", "ldrexb", "ldrexh", "strexb", "strexh", "tbb",
+                "tbh", "dmb", "dsb", "isb", "mrs", "msr", "ssat", "usat", "ldmdb",
+                "stmdb", "pld", "pli", "clrex", "ldrt", "ldrbt", "ldrht",
+                "ldrsbt", "ldrsht", "strt", "strbt", "strht", "sxtab", "sxtah",
+                "uxtab", "uxtah", "umaal", "usada8", "usad8", "sel",
+                "qadd", "qsub", "ssat16", "usat16"])
+
+it_regex = re.compile(r'it[te]{0,3}$')
+
+def regNum(s):
+    return reg_numbers.get(s.strip().lower())
+
+def isLow(s):
+    n = regNum(s)
+    return n is not None and n < 8
+
+# Return the value of an immediate operand, or None if it isn't a plain
+# number (e.g. #:lower16:sym)
+def immediate(s):
+    s = s.strip()
+    if s[:1] == '#':
+        s = s[1:]
+    try:
+        return int(s, 0)
+    except ValueError:
+        return None
+
+def isImmediate(s):
+    return s.strip()[:1] == '#'
+
+# Split operands on the top level commas, leaving those inside [] and {}
+def splitOperands(operands):
+    if '@' in operands:
+        operands = operands[:operands.index('@')]
+
+    parts = []
+    depth = 0
+    cur = ""
+    for c in operands:
+        if c in "[{":
+            depth += 1
+        elif c in "]}":
+            depth -= 1
+        if c == ',' and depth == 0:
+            parts.append(cur.strip())
+            cur = ""
+        else:
+            cur += c
+    if cur.strip() != "":
+        parts.append(cur.strip())
+    return parts
+
+# Expand a register list such as {r4-r7, lr} into register numbers
+def regList(s):
+    s = s.strip()
+    if s[:1] != '{' or s[-1:] != '}':
+        return None
+    regs = []
+    for r in s[1:-1].split(','):
+        if '-' in r:
+            lo, hi = map(regNum, r.split('-'))
+            if lo is None or hi is None:
+                return None
+            regs.extend(range(lo, hi+1))
+        else:
+            n = regNum(r)
+            if n is None:
+                return None
+            regs.append(n)
+    return regs
+
+# The narrow data processing encodings set the flags outside of an IT block,
+# and don't inside one
+def flagsOk(setflags, in_it):
+    return setflags != in_it
+
+def splitFlags(op, base_ops):
+    if op in base_ops:
+        return op, False
+    if op[-1:] == 's' and op[:-1] in base_ops:
+        return op[:-1], True
+    return None, False
+
+# mov, mvn
+def sizeMove(op, ops, in_it):
+    base, s = splitFlags(op, ["mov", "mvn"])
+    if len(ops) != 2:
+        return None
+
+    rd, x = ops
+    if isImmediate(x):
+        imm = immediate(x)
+        if imm is None:
+            return 4
+        if base == "mov" and flagsOk(s, in_it) and isLow(rd) and 0 <= imm <= 255:
+            return 2
+        return 4
+
+    if regNum(x) is None:
+        return None
+    if base == "mov":
+        if not s:
+            return 2
+        if isLow(rd) and isLow(x) and not in_it:
+            return 2
+        return 4
+    if flagsOk(s, in_it) and isLow(rd) and isLow(x):
+        return 2
+    return 4
+
+# cmp, cmn, tst
+def sizeCompare(op, ops, in_it):
+    if len(ops) != 2:
+        return None
+
+    rn, x = ops
+    if isImmediate(x):
+        imm = immediate(x)
+        if imm is None or imm < 0:
+            return None
+        if op == "cmp" and isLow(rn) and imm <= 255:
+            return 2
+        return 4
+
+    if regNum(rn) is None or regNum(x) is None:
+        return 4
+    if op == "cmp":
+        return 2
+    if isLow(rn) and isLow(x):
+        return 2
+    return 4
+
+# add, sub
+def sizeAddSub(op, ops, in_it):
+    base, s = splitFlags(op, ["add", "sub"])
+    if len(ops) == 2:
+        ops = [ops[0]] + ops
+    if len(ops) != 3:
+        return 4 if len(ops) == 4 else None
+
+    rd, rn, x = ops
+    if regNum(rd) is None or regNum(rn) is None:
+        return None
+
+    if isImmediate(x):
+        imm = immediate(x)
+        if imm is None:
+            return None
+        if imm < 0:
+            base = "sub" if base == "add" else "add"
+            imm = -imm
+
+        if regNum(rn) == 15:
+            return None
+        if regNum(rn) == 13:
+            if s:
+                return 4
+            if regNum(rd) == 13 and imm <= 508 and imm % 4 == 0:
+                return 2
+            if base == "add" and isLow(rd) and imm <= 1020 and imm % 4 == 0:
+                return 2
+            return 4
+
+        if isLow(rd) and isLow(rn) and flagsOk(s, in_it):
+            if imm <= 7:
+                return 2
+            if regNum(rd) == regNum(rn) and imm <= 255:
+                return 2
+        return 4
+
+    if regNum(x) is None:
+        return None
+    if isLow(rd) and isLow(rn) and isLow(x) and flagsOk(s, in_it):
+        return 2
+    # The high register form of add doesn't set the flags, but needs the
+    # destination to be one of the sources
+    if base == "add" and not s and regNum(rd) != 15:
+        if regNum(rd) == regNum(rn) or regNum(rd) == regNum(x):
+            return 2
+    return 4
+
+# adc, sbc, and, eor, orr, bic, mul
+def sizeLogical(op, ops, in_it):
+    commutative = ["adc", "and", "eor", "orr", "mul"]
+    base, s = splitFlags(op, ["adc", "sbc", "and", "eor", "orr", "bic", "mul"])
+    if len(ops) == 2:
+        ops = [ops[0]] + ops
+    if len(ops) != 3:
+        return 4 if len(ops) == 4 else None
+
+    rd, rn, x = ops
+    if isImmediate(x):
+        return 4
+    if regNum(rd) is None or regNum(rn) is None or regNum(x) is None:
+        return None
+
+    if not (isLow(rd) and isLow(rn) and isLow(x) and flagsOk(s, in_it)):
+        return 4
+    if regNum(rd) == regNum(rn) and base != "mul":
+        return 2
+    if regNum(rd) == regNum(x) and base in commutative:
+        return 2
+    if base == "mul" and regNum(rd) == regNum(rn):
+        return 2
+    return 4
+
+# lsl, lsr, asr, ror
+def sizeShift(op, ops, in_it):
+    base, s = splitFlags(op, ["lsl", "lsr", "asr", "ror"])
+    if len(ops) == 2:
+        ops = [ops[0]] + ops
+    if len(ops) != 3:
+        return None
+
+    rd, rm, x = ops
+    if regNum(rd) is None or regNum(rm) is None:
+        return None
+    if not (isLow(rd) and isLow(rm) and flagsOk(s, in_it)):
+        return 4
+
+    if isImmediate(x):
+        if immediate(x) is None:
+            return None
+        if base == "ror":
+            return 4
+        return 2
+
+    if isLow(x) and regNum(rd) == regNum(rm):
+        return 2
+    return 4
+
+# rsb, neg
+def sizeNegate(op, ops, in_it):
+    base, s = splitFlags(op, ["rsb", "neg"])
+    if base == "neg":
+        ops = ops + ["#0"]
+    if len(ops) != 3:
+        return 4
+
+    rd, rn, x = ops
+    if isImmediate(x) and immediate(x) == 0 and isLow(rd) and isLow(rn) and flagsOk(s, in_it):
+        return 2
+    return 4
+
+# sxtb, sxth, uxtb, uxth, rev, rev16, revsh
+def sizeExtend(op, ops, in_it):
+    if len(ops) == 2 and isLow(ops[0]) and isLow(ops[1]):
+        return 2
+    return 4
+
+# The word aligned values which can be encoded as a 32-bit Thumb-2 modified
+# immediate: a byte repeated in one of four patterns, or a rotated byte with
+# its top bit set
+# Split a label operand such as .L5+4 into the label and its offset
+def labelOffset(s):
+    m = re.match(r'([\w.$]+)\s*(?:([+-])\s*(\w+))?$', s.strip())
+    if m is None:
+        return None
+    if m.group(2) is None:
+        return 0
+    try:
+        off = int(m.group(3), 0)
+    except ValueError:
+        return None
+    return off if m.group(2) == '+' else -off
+
+# ldr rt, label and adr rd, label. gas only uses the narrow encoding if the
+# target is word aligned and no more than 1020 bytes after the word aligned
+# pc. Starting at a word aligned address, the narrow instruction is followed
+# by the 8 bytes before the label, so the label itself is never aligned
+def sizeLabel(op, rt, label):
+    off = labelOffset(label)
+    if off is None or regNum(rt) is None:
+        return None
+    if op not in ["ldr", "adr"] or not isLow(rt):
+        return 4
+    target = 2 + 8 + off
+    if target % 4 == 0 and 0 <= target - 4 <= 1020:
+        return 2
+    return 4
+
+def sizeAdr(op, ops, in_it):
+    if len(ops) != 2:
+        return None
+    return sizeLabel(op, ops[0], ops[1])
+
+# Single register loads and stores
+def sizeLoadStore(op, ops, in_it):
+    if len(ops) == 3:
+        return 4 # Post indexed
+    if len(ops) != 2:
+        return None
+
+    rt, addr = ops
+    if regNum(rt) is None:
+        return None
+
+    if addr[:1] != '[':
+        if op[:3] != "ldr" or regNum(rt) == 15:
+            return None
+        if addr[:1] != '=':
+            return sizeLabel(op, rt, addr)
+        if op != "ldr" or isLow(rt):
+            return None
+        return 4
+
+    if addr[-1:] == '!' or not isLow(rt):
+        return 4
+
+    parts = splitOperands(addr[1:-1])
+    rn = regNum(parts[0])
+    if rn is None:
+        return None
+
+    if len(parts) == 1:
+        if op in ["ldrsb", "ldrsh"]:
+            return 4
+        parts.append("#0")
+
+    if len(parts) == 3:
+        return 4 # Shifted register offset
+
+    if not isImmediate(parts[1]):
+        if rn < 8 and isLow(parts[1]):
+            return 2
+        return 4
+
+    imm = immediate(parts[1])
+    if imm is None:
+        return None
+    if imm < 0:
+        return 4
+
+    if rn in [13, 15]:
+        if (op == "ldr" or (op == "str" and rn == 13)) and imm <= 1020 and imm % 4 == 0:
+            return 2
+        return 4
+    if rn >= 8:
+        return 4
+
+    if op in ["ldr", "str"] and imm <= 124 and imm % 4 == 0:
+        return 2
+    if op in ["ldrb", "strb"] and imm <= 31:
+        return 2
+    if op in ["ldrh", "strh"] and imm <= 62 and imm % 2 == 0:
+        return 2
+    return 4
+
+# ldm, stm
+def sizeMultiple(op, ops, in_it):
+    if len(ops) != 2:
+        return None
+    rn_s, regs = ops
+    writeback = rn_s[-1:] == '!'
+    rn = regNum(rn_s.rstrip('!'))
+    regs = regList(regs)
+    if rn is None or regs is None or rn == 13:
+        return None
+
+    if rn >= 8 or max(regs) >= 8:
+        return 4
+    if op[:3] == "ldm" and writeback == (rn not in regs):
+        return 2
+    if op[:3] == "stm" and writeback:
+        return 2
+    return 4
+
+def sizePushPop(op, ops, in_it):
+    if len(ops) != 1:
+        return None
+    regs = regList(ops[0])
+    if regs is None:
+        return None
+
+    extra = 14 if op == "push" else 15
+    if all(r < 8 or r == extra for r in regs):
+        return 2
+    return 4
+
+def sizeBranchExchange(op, ops, in_it):
+    if len(ops) != 1:
+        return None
+    if regNum(ops[0]) is not None:
+        return 2
+    return 4
+
+handlers = {}
+for ops, fn in [(["mov", "mvn"], sizeMove),
+                (["add", "sub"], sizeAddSub),
+                (["adc", "sbc", "and", "eor", "orr", "bic", "mul"], sizeLogical),
+                (["lsl", "lsr", "asr", "ror"], sizeShift),
+                (["rsb", "neg"], sizeNegate)]:
+    for o in ops:
+        handlers[o] = fn
+        handlers[o+"s"] = fn
+for o in ["cmp", "cmn", "tst"]:
+    handlers[o] = sizeCompare
+for o in ["sxtb", "sxth", "uxtb", "uxth", "rev", "rev16", "revsh"]:
+    handlers[o] = sizeExtend
+for o in ["ldr", "str", "ldrb", "strb", "ldrh", "strh", "ldrsb", "ldrsh"]:
+    handlers[o] = sizeLoadStore
+for o in ["ldm", "ldmia", "ldmfd", "stm", "stmia", "stmea"]:
+    handlers[o] = sizeMultiple
+handlers["push"] = sizePushPop
+handlers["pop"] = sizePushPop
+handlers["blx"] = sizeBranchExchange
+handlers["adr"] = sizeAdr
+
+# Return the size of the instruction in bytes, or None if it can't be
+# determined without assembling it
+def findSize(op, operands, in_it=False):
+    op = op.lower()
+
+    if op[-2:] == ".w":
+        return 4
+    if op[-2:] == ".n":
+        return 2
+    if op in always16 or it_regex.match(op):
+        return 2
+    if op in always32:
+        return 4
+
+    if op not in handlers:
+        return None
+    return handlers[op](op, splitOperands(operands), in_it)
+
+def splitInsn(insn):
+    parts = insn.strip().split(None, 1)
+    if len(parts) == 1:
+        parts.append("")
+    return parts
+
+if __name__ == "__main__":
+    from docopt import docopt
+    import sys
+
+    arguments = docopt(__doc__)
+
+    import asmsize
+
+    agree = 0
+    disagree = 0
+    unknown = 0
+
+    entries = asmsize.allEntries()
+    if not entries:
+        print "The asmsize cache has no sizes for this toolchain to check against"
+        sys.exit(1)
+
+    for insn, size in sorted(entries.items()):
+        if not insn.strip():
+            continue
+
+        s = findSize(*splitInsn(insn))
+        if s is None:
+            unknown += 1
+        elif s == size:
+            agree += 1
+        else:
+            disagree += 1
+            if arguments['--verbose']:
+                print "{: <40} assembler: {} table: {}".format(insn.strip(), size, s)
+
+    print "Agree: {}, disagree: {}, left to the assembler: {}".format(agree, disagree, unknown)
+    if disagree:
+        sys.exit(1)
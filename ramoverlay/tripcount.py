@@ -0,0 +1,346 @@
+import re
+
+# Static trip counts for counted loops. A loop is counted if it has a single
+# exit, taken from a compare of an induction register, where the register is
+# changed by a constant once per iteration, starts from a constant and is
+# compared against a constant or a register loaded with one. The patterns
+# recognised are those gcc produces for Thumb-2:
+#
+#       movs    r3, #0                  movw    r2, #1000
+#   .L6:                                movs    r3, #100
+#       ...                         .L4:
+#       adds    r3, r3, #1              ...
+#       cmp     r3, #100                subs    r3, r3, #1
+#       bne     .L6                     bne     .L4
+#
+# along with compares against a register and cbz/cbnz down counters. Loops
+# which don't match are left out, so that the caller falls back to the
+# iteration estimate.
+
+aliases = {"ip": "r12", "fp": "r11", "sl": "r10", "sb": "r9", "lr": "r14", "sp": "r13"}
+
+# Registers which a call can change
+call_clobbered = set(["r0", "r1", "r2", "r3", "r12", "r14"])
+
+# Instructions which don't write to their first operand
+no_dest = set(["cmp", "cmn", "tst", "teq", "b", "bx", "bl", "blx", "cbz", "cbnz", "nop", "push",
+               "str", "strb", "strh", "strd", "stm", "stmia", "stmdb", "bkpt", "svc", "dmb",
+               "dsb", "isb", "cpsid", "cpsie", "wfi", "wfe", "tbb", "tbh"])
+two_dests = set(["ldrd", "umull", "smull", "umlal", "smlal"])
+flag_setters = set(["cmp", "cmn", "tst", "teq", "adds", "subs", "movs", "mvns", "lsls", "lsrs",
+                    "asrs", "rors", "ands", "orrs", "eors", "bics", "orns", "muls", "negs",
+                    "rsbs", "adcs", "sbcs", "msr"])
+
+# The condition with its operands swapped, and the condition which is true
+# when it is false
+swapped = {"eq": "eq", "ne": "ne", "lt": "gt", "gt": "lt", "le": "ge", "ge": "le",
+           "lo": "hi", "hi": "lo", "ls": "hs", "hs": "ls"}
+negated = {"eq": "ne", "ne": "eq", "lt": "ge", "ge": "lt", "gt": "le", "le": "gt",
+           "lo": "hs", "hs": "lo", "hi": "ls", "ls": "hi"}
+synonyms = {"cc": "lo", "cs": "hs", "mi": "lt", "pl": "ge"}
+
+def register(op):
+    op = op.strip().lower()
+    return aliases.get(op, op)
+
+# gcc leaves the # off the operand of movt
+def immediate(op):
+    op = op.strip()
+    if op.startswith("#"):
+        op = op[1:]
+    try:
+        return int(op, 0)
+    except ValueError:
+        return None
+
+def operandList(insn):
+    return [o.strip() for o in re.split(r",(?![^\[{]*[\]}])", insn.operands)]
+
+# The registers in a list such as {r4-r7, lr}
+def registerList(ops):
+    m = re.search(r"\{(.*)\}", ops)
+    if m is None:
+        return set()
+
+    regs = set()
+    for part in m.group(1).split(','):
+        if '-' in part:
+            first, last = [register(r) for r in part.split('-')]
+            regs.update("r{}".format(n) for n in range(int(first[1:]), int(last[1:])+1))
+        else:
+            regs.add(register(part))
+    return regs
+
+# Whether insn might change reg
+def writesRegister(insn, reg):
+    base = insn.opinfo.base
+    if base == "":
+        return False
+    if insn.isCall():
+        return reg in call_clobbered
+
+    ops = insn.operands.lower()
+    if base in ["pop", "ldm", "ldmia", "ldmdb"] and reg in registerList(ops):
+        return True
+
+    names = set(register(r) for r in re.findall(r"\b(?:r\d+|ip|fp|sl|sb|lr|sp)\b", ops))
+    if reg not in names:
+        return False
+
+    # Base register writeback
+    if "!" in ops or re.search(r"\],", ops):
+        return True
+
+    if base in no_dest or base in ["pop", "ldm", "ldmia", "ldmdb"]:
+        return False
+
+    dests = operandList(insn)[:2 if base in two_dests else 1]
+    return reg in [register(d) for d in dests]
+
+# If insn is "add rX, rX, #k" or "sub rX, #k", return (rX, k)
+def stepOf(insn):
+    if insn.opinfo.base not in ["add", "adds", "sub", "subs"] or insn.opinfo.cond != "":
+        return None
+    ops = operandList(insn)
+    if len(ops) == 3 and register(ops[0]) == register(ops[1]):
+        k = immediate(ops[2])
+    elif len(ops) == 2:
+        k = immediate(ops[1])
+    else:
+        return None
+    if k is None:
+        return None
+    if insn.opinfo.base in ["sub", "subs"]:
+        k = -k
+    return register(ops[0]), k
+
+# The constant value of reg at the end of block i of g, following the blocks
+# back while they have a single predecessor
+def constantAtEnd(g, i, reg, limit=8):
+    high = None
+    for step in range(limit):
+        for insn in reversed(g.blocks[i].instructions):
+            if not writesRegister(insn, reg):
+                continue
+            base = insn.opinfo.base
+            ops = operandList(insn)
+            if insn.opinfo.cond != "" or len(ops) != 2:
+                return None
+            value = immediate(ops[1])
+            if value is None:
+                return None
+            if base == "movt" and high is None:
+                high = value
+                continue
+            if base == "movw":
+                return value | ((high or 0) << 16)
+            if base in ["mov", "movs"] and high is None:
+                return value
+            return None
+
+        preds = g.predecessors(i)
+        if len(preds) != 1:
+            return None
+        i = preds[0]
+    return None
+
+# The number of times round the loop, for the first value of the induction
+# variable which is compared being first, and each following compare being
+# step further on, while the variable cond limit holds
+def solveTrips(first, step, cond, limit):
+    if cond in ["lo", "ls", "hi", "hs"] and (first < 0 or limit < 0):
+        return None
+    cond = {"lo": "lt", "ls": "le", "hi": "gt", "hs": "ge"}.get(cond, cond)
+
+    holds = {"eq": lambda v: v == limit, "ne": lambda v: v != limit,
+             "lt": lambda v: v < limit, "le": lambda v: v <= limit,
+             "gt": lambda v: v > limit, "ge": lambda v: v >= limit}[cond]
+    if not holds(first):
+        return 1
+
+    if cond == "eq":
+        return 2 if step != 0 else None
+    if cond == "ne":
+        if step == 0 or (limit - first) % step != 0 or (limit - first) // step < 0:
+            return None
+        return (limit - first) // step + 1
+    if cond in ["lt", "le"]:
+        if step <= 0:
+            return None
+        if cond == "le":
+            limit += 1
+        return -(-(limit - first) // step) + 1
+    if cond in ["gt", "ge"]:
+        if step >= 0:
+            return None
+        if cond == "ge":
+            limit -= 1
+        return -(-(first - limit) // -step) + 1
+
+# The flag setting instruction which the conditional branch at the end of bb
+# tests, or None if it isn't in the block
+def flagSetter(bb):
+    for insn in reversed(bb.instructions[:-1]):
+        if insn.isCall():
+            return None
+        if insn.opinfo.base in flag_setters:
+            return insn
+    return None
+
+# Try to find the trip count of a loop of c, returning None if it can't be
+# shown
+def loopTrips(c, g, loop):
+    h = g.id(loop.header)
+    members = set(g.id(bb) for bb in loop.members)
+
+    # Single entry, through the header
+    for i in members:
+        if i != h and any(p not in members for p in g.predecessors(i)):
+            return None
+    outside = [p for p in g.predecessors(h) if p not in members]
+    if len(outside) != 1:
+        return None
+    preheader = outside[0]
+
+    # Single exit, from a two way branch
+    exits = [i for i in members if g.outDegree(i) == 0 or any(j not in members for j in g.successors(i))]
+    if len(exits) != 1:
+        return None
+    e = exits[0]
+    exit_bb = g.blocks[e]
+    succs = g.successors(e)
+    if len(succs) != 2 or all(j not in members for j in succs):
+        return None
+
+    branch = exit_bb.instructions[-1]
+    if not branch.isBranch() or branch.isUnconditional():
+        return None
+    target = branch.branchDestination()
+    taken = [j for j in succs if g.blocks[j].instructions[0].label == target]
+    if len(taken) != 1:
+        return None
+    taken_stays = taken[0] in members
+
+    # The blocks which end an iteration, and the blocks run on every
+    # iteration, which dominate all of them
+    latches = [i for i in members if h in g.successors(i)]
+    def everyIteration(i):
+        bb = g.blocks[i]
+        return bb.loop_nest[:1] == [loop.header] and all(c.dominates(bb, g.blocks[l]) for l in latches)
+    if not everyIteration(e):
+        return None
+
+    # Work out the register, what it is compared with and the condition
+    # under which the loop continues
+    base = branch.opinfo.base
+    if base in ["cbz", "cbnz"]:
+        reg = register(operandList(branch)[0])
+        cond = "eq" if base == "cbz" else "ne"
+        limit = 0
+        compare = branch
+    else:
+        cond = synonyms.get(branch.opinfo.cond, branch.opinfo.cond)
+        compare = flagSetter(exit_bb)
+        if compare is None or cond not in swapped:
+            return None
+        ops = operandList(compare)
+        if compare.opinfo.base == "cmp" and len(ops) == 2:
+            reg = register(ops[0])
+            limit = immediate(ops[1])
+            if limit is None:
+                other = register(ops[1])
+                # Compared the other way round
+                if loopStep(loop, other) is not None and loopStep(loop, reg) is None:
+                    reg, other = other, reg
+                    cond = swapped[cond]
+                if any(writesRegister(insn, other) for bb in loop.members for insn in bb.instructions):
+                    return None
+                limit = constantAtEnd(g, preheader, other)
+                if limit is None:
+                    return None
+        elif stepOf(compare) is not None and cond in ["eq", "ne", "lt", "ge", "gt", "le"]:
+            # The update itself sets the flags, so compares with zero
+            reg = stepOf(compare)[0]
+            limit = 0
+        else:
+            return None
+
+    if not taken_stays:
+        cond = negated[cond]
+
+    # The register must change by a constant, once on each iteration
+    updates = [(bb, k, insn) for bb in loop.members for k, insn in enumerate(bb.instructions)
+               if writesRegister(insn, reg)]
+    if len(updates) != 1:
+        return None
+    update_bb, update_pos, update = updates[0]
+    s = stepOf(update)
+    if s is None or s[0] != reg or not everyIteration(g.id(update_bb)):
+        return None
+    step = s[1]
+
+    start = constantAtEnd(g, preheader, reg)
+    if start is None:
+        return None
+
+    # Whether the compare sees the register before or after this
+    # iteration's update
+    if update_bb is exit_bb:
+        updated = update_pos <= exit_bb.instructions.index(compare)
+    else:
+        updated = c.dominates(update_bb, exit_bb)
+
+    first = start + step if updated else start
+    return solveTrips(first, step, cond, limit)
+
+# Whether reg is updated by a constant step somewhere in the loop
+def loopStep(loop, reg):
+    for bb in loop.members:
+        for insn in bb.instructions:
+            s = stepOf(insn)
+            if s is not None and s[0] == reg:
+                return s
+    return None
+
+# The trip counts of the loops of c which could be worked out, by header
+def tripCounts(c):
+    c.findLoops()
+    g = c.graph()
+
+    trips = {}
+    for loop in c.loops:
+        n = loopTrips(c, g, loop)
+        if n is not None and n > 0:
+            trips[loop.header] = n
+    return trips
+
+# Check that a single counted loop is found, and that its header is only
+# weighted by the one extra exit test over its body
+if __name__ == "__main__":
+    import sys, os, tempfile
+    import arm, rammanager
+
+    n = 100
+    fd, fname = tempfile.mkstemp(suffix=".s")
+    f = os.fdopen(fd, "w")
+    f.write("\t.thumb_func\n\t.type\tf, %function\nf:\n\tpush\t{r4, lr}\n\tmovs\tr3, #0\n")
+    f.write(".L6:\n\tcmp\tr0, #5\n\tbeq\t.L7\n\tadds\tr0, r0, r3\n")
+    f.write(".L7:\n\tadds\tr3, r3, #1\n\tcmp\tr3, #{}\n\tbne\t.L6\n".format(n))
+    f.write("\tpop\t{r4, pc}\n\t.size\tf, .-f\n")
+    f.close()
+
+    insns, lines, calls = arm.loadInstructions(fname)
+    os.remove(fname)
+    c = rammanager.constructCFGs(insns, calls)[0]
+
+    trips = tripCounts(c)
+    local = rammanager.localIterations(c, 10)
+    header = c.loops[0].header
+    body = [k for bb, k in zip(c.basicblocks, local) if bb in c.loops[0].members and bb is not header]
+    head = local[c.basicblocks.index(header)]
+
+    print "Trip counts:", trips.values()
+    print "Iterations:", local
+    if trips.get(header) != n or max(body) < n or head > max(body) * (n + 1) / float(n):
+        print "The header's iterations don't match its body's"
+        sys.exit(1)